@@ -2,8 +2,8 @@ from model import BaseNet
 import tensorflow as tf
 
 class AlexNet(BaseNet):
-    def __init__(self,num_default_boxes,num_classes):
-        super().__init__(num_default_boxes,num_classes)
+    def __init__(self,num_default_boxes,num_classes,**kwargs):
+        super().__init__(num_default_boxes,num_classes,**kwargs)
     
     def graph(self,x,phase):
         """
@@ -0,0 +1,147 @@
+import time
+import queue
+import random
+import traceback
+import multiprocessing
+import numpy as np
+
+
+class BatchLoader:
+    """
+    Assembles batches ahead of time in worker processes.
+
+    Every batch is written into one slot of a ring of shared memory buffers, the training loop reads
+    the slot in place through numpy views, nothing is pickled or copied. A slot goes back to the
+    workers when the consumer asks for the next batch, so a batch must not be used after that.
+
+    Args:
+    fill_batch - fill_batch(name,start,end,arrays) writes the batch of data set name into the arrays,
+                 it runs in the workers which are forked so it can use anything the parent has
+    specs - list of (shape,dtype) of the arrays of one batch, the first dimension is the batch size
+    num_workers - number of worker processes
+    prefetch_depth - number of batches that can be ready and waiting, this is the number of slots
+    worker_init - optional function that runs once in every worker
+    poll_secs - how often a consumer that is waiting for a batch checks that the workers are alive
+    """
+
+    def __init__(self,fill_batch,specs,num_workers,prefetch_depth,worker_init=None,poll_secs=1.0):
+        # fork so that the workers share the data sets, image store etc. with the parent
+        ctx = multiprocessing.get_context("fork")
+
+        self._fill_batch  = fill_batch
+        self._worker_init = worker_init
+        self._poll_secs   = poll_secs
+        self._specs       = [(tuple(shape),np.dtype(dtype)) for shape,dtype in specs]
+        self._num_slots   = max(prefetch_depth,1) + num_workers
+        self._slots       = []
+        self._buffers     = []
+        for _ in range(self._num_slots):
+            buffers = [ctx.RawArray("b",max(int(np.prod(shape))*dtype.itemsize,1)) for shape,dtype in self._specs]
+            self._buffers.append(buffers)
+            self._slots.append(self._views(buffers))
+
+        self._tasks   = ctx.Queue()
+        self._free    = ctx.Queue()
+        self._ready   = ctx.Queue()
+        self._seq     = 0
+        self.last_wait  = 0.0
+        self.total_wait = 0.0
+
+        for slot in range(self._num_slots):
+            self._free.put(slot)
+
+        self._workers = [ctx.Process(target=self._work,args=(i,)) for i in range(num_workers)]
+        for w in self._workers:
+            w.daemon = True
+            w.start()
+
+    def _views(self,buffers):
+        return [np.frombuffer(b,dtype=dtype,count=int(np.prod(shape))).reshape(shape)
+                for b,(shape,dtype) in zip(buffers,self._specs)]
+
+    def _work(self,worker_i):
+        # Forked workers start with the parent's random state, make them differ
+        random.seed()
+        np.random.seed()
+        if self._worker_init != None:
+            self._worker_init(worker_i)
+
+        while True:
+            # Take a slot before a task so that the oldest task always has a slot to be written to
+            slot = self._free.get()
+            task = self._tasks.get()
+            if task == None:
+                return
+
+            seq, name, start, end, batch_size = task
+            try:
+                arrays = [a[:batch_size] for a in self._slots[slot]]
+                for a in arrays:
+                    a.fill(0)
+                self._fill_batch(name,start,end,arrays)
+                self._ready.put((seq,slot,None))
+            except Exception:
+                self._ready.put((seq,slot,traceback.format_exc()))
+
+    def batches(self,name,ranges,batch_size):
+        """ Generator of the batches of data set name, in order.
+
+        Args:
+        ranges - list of (start,end) positions in the data set
+        batch_size - size of the arrays of each batch, at most the size the loader was created with
+
+        Yields the list of arrays of each batch. last_wait is set to the time spent waiting for it.
+        """
+        first = self._seq
+        for start,end in ranges:
+            self._tasks.put((self._seq,name,start,end,batch_size))
+            self._seq += 1
+
+        pending = {}
+        slot    = None
+        try:
+            for seq in range(first,self._seq):
+                t = time.time()
+                while seq not in pending:
+                    ready_seq, ready_slot, error = self._next_ready()
+                    if ready_seq < first:
+                        # left over from an earlier call that stopped early
+                        self._free.put(ready_slot)
+                        continue
+                    pending[ready_seq] = (ready_slot,error)
+                slot, error = pending.pop(seq)
+                self.last_wait   = time.time() - t
+                self.total_wait += self.last_wait
+
+                if error != None:
+                    raise RuntimeError("Batch loader worker failed:\n"+error)
+
+                yield [a[:batch_size] for a in self._slots[slot]]
+                self._free.put(slot)
+                slot = None
+        finally:
+            if slot != None:
+                self._free.put(slot)
+            for ready_slot,_ in pending.values():
+                self._free.put(ready_slot)
+
+    def _next_ready(self):
+        """ The next (seq,slot,error) from the workers. A worker that died, e.g. killed for running out
+        of memory, never delivers its batch, so rather than wait forever this raises once one has. """
+        while True:
+            try:
+                return self._ready.get(timeout=self._poll_secs)
+            except queue.Empty:
+                dead = [(i,w.exitcode) for i,w in enumerate(self._workers) if not w.is_alive()]
+                if dead:
+                    raise RuntimeError("Batch loader workers died (worker, exit code): {}".format(dead))
+
+    def close(self):
+        for _ in self._workers:
+            self._tasks.put(None)
+            # a worker blocked on a free slot needs one to see the stop task
+            self._free.put(0)
+        for w in self._workers:
+            w.join(5)
+            if w.is_alive():
+                w.terminate()
@@ -0,0 +1,132 @@
+import os
+import glob
+import shutil
+import pickle
+import threading
+import tensorflow as tf
+
+
+class AsyncCheckpointer:
+    """
+    Writes checkpoints of the training graph from a background thread.
+
+    save() copies the values of the variables out of the training session, which only takes a
+    sess.run, and returns. A thread then writes them with a Saver of a separate graph that holds
+    variables of the same names, so the files are regular checkpoints that the Saver of the
+    training graph (or tf.train.import_meta_graph + restore) can read. The meta graph of the
+    training graph is exported once and copied next to every checkpoint.
+
+    Only one write is in flight, save() waits for the previous one to finish first.
+
+    Args:
+    saver - the Saver of the training graph, its meta graph is the one copied next to the checkpoints
+    run_dir - directory of the checkpoints and of the "checkpoint" state file
+    max_to_keep - number of checkpoints to keep, older ones are deleted, None or 0 keeps all. Checkpoints
+                  saved with keep=True do not count and are never deleted, they are marked with a
+                  prefix.keep file so that this still holds after a resume
+    var_list - the variables the saver saves, all global variables by default
+    """
+
+    def __init__(self,saver,run_dir,max_to_keep=5,var_list=None):
+        self.run_dir     = run_dir
+        self.max_to_keep = max_to_keep
+        self._vars       = list(var_list if var_list != None else tf.global_variables())
+        self._names      = [v.op.name for v in self._vars]
+
+        self._meta_fname = run_dir+"/graph.meta"
+        # without the devices of distributed training, so that Inference can import it anywhere
+        saver.export_meta_graph(self._meta_fname,clear_devices=True)
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._shadow = [tf.Variable(tf.zeros(v.get_shape(),dtype=v.dtype.base_dtype),trainable=False)
+                            for v in self._vars]
+            self._shadow_saver = tf.train.Saver(dict(zip(self._names,self._shadow)),max_to_keep=None)
+        self._sess = tf.Session(graph=self._graph)
+
+        self._kept   = []
+        self._keep   = []
+        self._thread = None
+        self._error  = None
+
+        state = tf.train.get_checkpoint_state(run_dir)
+        if state != None:
+            for path in state.all_model_checkpoint_paths:
+                if os.path.exists(path+".keep"):
+                    self._keep.append(path)
+                else:
+                    self._kept.append(path)
+
+    def save(self,sess,prefix,extra=None,keep=False):
+        """ Snapshot the variables and write them to prefix in the background.
+
+        Args:
+        sess - the training session
+        prefix - checkpoint path, e.g. <run_dir>/model-step-100
+        extra - optional picklable object written to prefix.extra.pkl, e.g. the loss history
+        keep - never delete this checkpoint because of max_to_keep
+        """
+        self.wait()
+        values = sess.run(self._vars)
+        self._thread = threading.Thread(target=self._write,args=(values,prefix,extra,keep))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write(self,values,prefix,extra,keep):
+        try:
+            for shadow,value in zip(self._shadow,values):
+                shadow.load(value,self._sess)
+            self._shadow_saver.save(self._sess,prefix,write_meta_graph=False,write_state=False)
+            shutil.copyfile(self._meta_fname,prefix+".meta")
+            if extra != None:
+                with open(prefix+".extra.pkl.tmp","wb") as f:
+                    pickle.dump(extra,f)
+                os.replace(prefix+".extra.pkl.tmp",prefix+".extra.pkl")
+
+            for kept in [self._kept,self._keep]:
+                if prefix in kept:
+                    kept.remove(prefix)
+            if keep:
+                open(prefix+".keep","w").close()
+                self._keep.append(prefix)
+            else:
+                if os.path.exists(prefix+".keep"):
+                    os.remove(prefix+".keep")
+                self._kept.append(prefix)
+                while self.max_to_keep and len(self._kept) > self.max_to_keep:
+                    self._delete(self._kept.pop(0))
+
+            # The state file is written last, it only ever names complete checkpoints
+            paths = [p for p in self._keep+self._kept if p != prefix]+[prefix]
+            tf.train.update_checkpoint_state(self.run_dir,prefix,paths)
+            print("Saved checkpoint",prefix)
+        except Exception as e:
+            self._error = e
+
+    def _delete(self,prefix):
+        for fname in glob.glob(glob.escape(prefix)+".*"):
+            os.remove(fname)
+
+    def wait(self):
+        """ Wait for the checkpoint being written, re-raise its error if it failed """
+        if self._thread != None:
+            self._thread.join()
+            self._thread = None
+        if self._error != None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        self.wait()
+        self._sess.close()
+
+    @staticmethod
+    def latest(run_dir):
+        """ Prefix of the latest checkpoint in run_dir and its extra object, (None,None) if there is none """
+        prefix = tf.train.latest_checkpoint(run_dir)
+        if prefix == None:
+            return None, None
+        extra = None
+        if os.path.exists(prefix+".extra.pkl"):
+            extra = pickle.load(open(prefix+".extra.pkl","rb"))
+        return prefix, extra
@@ -0,0 +1,76 @@
+import numpy as np
+import tensorflow as tf
+
+
+def detection_ops(y_predict_loc,y_predict_conf,default_boxes,num_classes,score_threshold,
+                  iou_threshold,pre_nms_top_k,max_detections):
+    """
+    Post-processing as TensorFlow ops on top of the net outputs, so that only the final detections
+    leave the session: decode the boxes against the default boxes, keep the boxes whose most likely
+    class is not background and whose probability is above score_threshold, keep the pre_nms_top_k
+    best of those and run non max suppression on them per class, like nms.multiclass_nms: boxes of
+    different classes never suppress each other. The detections of each image are padded to
+    max_detections.
+
+    Args:
+    y_predict_loc - (batch_size,num_preds*4) net output
+    y_predict_conf - (batch_size,num_preds*num_classes) net output, logits
+    default_boxes - (num_preds,4) array of default box cx,cy,w,h, see SSDConfig.default_boxes()
+
+    Returns:
+    boxes - (batch_size,max_detections,4) float32 left,top,right,bottom
+    scores - (batch_size,max_detections) float32 probabilities, highest first
+    classes - (batch_size,max_detections) int32
+    count - (batch_size,) int32 number of detections of each image, the rest is padding
+    """
+    default_boxes = np.asarray(default_boxes,dtype=np.float32)
+    num_preds     = default_boxes.shape[0]
+    top_k         = min(pre_nms_top_k,num_preds)
+
+    loc     = tf.reshape(y_predict_loc,[-1,num_preds,4])
+    probs   = tf.nn.softmax(tf.reshape(y_predict_conf,[-1,num_preds,num_classes]))
+    scores  = tf.reduce_max(probs,axis=2)
+    classes = tf.argmax(probs,axis=2,output_type=tf.int32)
+
+    # the same decoding as utils.decode_boxes
+    dboxes  = tf.constant(default_boxes)
+    cx      = loc[:,:,0]*dboxes[:,2] + dboxes[:,0]
+    cy      = loc[:,:,1]*dboxes[:,3] + dboxes[:,1]
+    half_w  = tf.exp(loc[:,:,2])*dboxes[:,2]/2
+    half_h  = tf.exp(loc[:,:,3])*dboxes[:,3]/2
+    boxes   = tf.stack([cx - half_w, cy - half_h, cx + half_w, cy + half_h],axis=2)
+
+    def per_image(args):
+        boxes, scores, classes = args
+        valid   = tf.logical_and(classes > 0, scores > score_threshold)
+        n_valid = tf.minimum(tf.reduce_sum(tf.cast(valid,tf.int32)),top_k)
+
+        # top_k puts the valid boxes first, the others get a score below any probability
+        top_scores, top_idx = tf.nn.top_k(tf.where(valid,scores,-tf.ones_like(scores)),k=top_k)
+        top_idx     = top_idx[:n_valid]
+        top_scores  = top_scores[:n_valid]
+        top_boxes   = tf.gather(boxes,top_idx)
+        top_classes = tf.gather(classes,top_idx)
+
+        # Move the boxes of each class to their own region so that one nms does every class,
+        # as multiclass_nms does
+        # (the max of no boxes is -inf, but then there is nothing to shift)
+        extent  = tf.reduce_max(tf.abs(top_boxes))*2 + 1
+        shifted = top_boxes + tf.expand_dims(tf.cast(top_classes,tf.float32)*extent,1)
+
+        # tf.image.non_max_suppression takes y1,x1,y2,x2
+        keep    = tf.image.non_max_suppression(tf.gather(shifted,[1,0,3,2],axis=1),top_scores,
+                                               max_detections,iou_threshold=iou_threshold)
+        count   = tf.shape(keep)[0]
+        padding = max_detections - count
+
+        out_boxes   = tf.pad(tf.gather(top_boxes,keep),[[0,padding],[0,0]])
+        out_scores  = tf.pad(tf.gather(top_scores,keep),[[0,padding]])
+        out_classes = tf.pad(tf.gather(top_classes,keep),[[0,padding]])
+        out_boxes.set_shape([max_detections,4])
+        out_scores.set_shape([max_detections])
+        out_classes.set_shape([max_detections])
+        return out_boxes, out_scores, out_classes, count
+
+    return tf.map_fn(per_image,(boxes,scores,classes),dtype=(tf.float32,tf.float32,tf.int32,tf.int32),
+                     back_prop=False)
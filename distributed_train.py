@@ -0,0 +1,207 @@
+import os
+import re
+import sys
+import time
+import argparse
+import subprocess
+import numpy as np
+import tensorflow as tf
+
+from ssd_config import SSDConfig
+from image_cache import ImageCache
+from train import SSDTrain
+from session_config import session_config
+
+
+class ReplicaTrain(SSDTrain):
+    """
+    One replica of data-parallel training. The variables live on the parameter server and every
+    replica applies its own gradients to them (asynchronous training). A replica trains on every
+    num_replicas-th image of the training set, starting with image task_index.
+
+    Replica 0 is the chief: it initializes or restores the variables, validates, writes the
+    summaries and the checkpoints, and saves the final model once every replica is done.
+
+    The replicas always work in the run directory that launch() made or was given, restore only
+    says whether the chief restores its latest checkpoint.
+    """
+
+    def __init__(self,dirname,server,cluster,task_index,num_epochs=None,restore=False):
+        SSDTrain.__init__(self,dirname)
+        if num_epochs != None:
+            self.cfg.set("num_epochs",num_epochs)
+        self._server       = server
+        self._task_index   = task_index
+        self._num_replicas = cluster.num_tasks("worker")
+        self._is_chief     = task_index == 0
+        self._restore      = restore
+        self._local_device = "/job:worker/task:{}".format(task_index)
+        self._device_fn    = tf.train.replica_device_setter(worker_device=self._local_device,cluster=cluster)
+
+        # The replicas share the machine, and should not draw the same negatives
+        self._image_cache  = ImageCache(self.cfg.g("image_cache_bytes")//self._num_replicas)
+        seed = self.cfg.g("random_seed")
+        self._rng          = np.random.RandomState(None if seed == None else seed+task_index)
+
+    def _load_data(self,dirname):
+        data, valid_data = SSDTrain._load_data(self,dirname)
+        return data.shard(self._task_index,self._num_replicas), valid_data
+
+    def _session(self):
+        # only talk to the parameter servers and to this replica's own devices
+        config = session_config(self.cfg,device_filters=["/job:ps","/job:worker/task:{}".format(self._task_index)])
+        return tf.Session(self._server.target,config=config)
+
+    def _initialize(self,sess,saver,run_dir,resume):
+        if self._is_chief:
+            return SSDTrain._initialize(self,sess,saver,run_dir,resume if self._restore else None)
+
+        uninitialized = tf.report_uninitialized_variables(tf.global_variables())
+        while len(sess.run(uninitialized)) > 0:
+            print("Replica {} waiting for the chief to initialize the variables".format(self._task_index))
+            time.sleep(1)
+        return sess.run(self._epochs_done), None
+
+    def _done_fname(self,task_index):
+        return "{}/replica-{}.done".format(self.cfg.g("run_dir"),task_index)
+
+    def _end_of_training(self,sess):
+        open(self._done_fname(self._task_index),"w").close()
+        if not self._is_chief:
+            return
+
+        # the final model has the updates of every replica, unless one of them died
+        deadline = time.time() + self.cfg.g("replica_wait_secs")
+        missing  = list(range(self._num_replicas))
+        while True:
+            missing = [i for i in missing if not os.path.exists(self._done_fname(i))]
+            if not missing or time.time() > deadline:
+                break
+            time.sleep(1)
+        if missing:
+            print("Replicas {} did not finish within {}s, saving the final model without them".format(
+                  missing,self.cfg.g("replica_wait_secs")))
+        for task_index in range(self._num_replicas):
+            if os.path.exists(self._done_fname(task_index)):
+                os.remove(self._done_fname(task_index))
+
+
+def cluster_spec(num_replicas,port):
+    """ One parameter server and num_replicas workers on localhost, on consecutive ports """
+    return tf.train.ClusterSpec({"ps":     ["localhost:{}".format(port)],
+                                 "worker": ["localhost:{}".format(port+1+i) for i in range(num_replicas)]})
+
+
+def run_task(args):
+    cluster = cluster_spec(args.replicas,args.port)
+    server  = tf.train.Server(cluster,job_name=args.job,task_index=args.task)
+    if args.job == "ps":
+        server.join()
+        return
+
+    # resume=run_dir puts every replica in the run directory of launch()
+    ReplicaTrain(args.dirname,server,cluster,args.task,args.num_epochs,args.restore).train_the_net(resume=args.run_dir)
+
+
+def launch(args):
+    """ Start the parameter server and the replicas, wait for the replicas to finish. If a replica
+    fails (or the parameter server exits) the others are stopped instead of waiting for it forever.
+    Returns the exit code and the aggregate images/sec, see replica_throughput() """
+    # only a run directory given by the user has checkpoints to restore
+    restore = args.run_dir != None
+    if args.run_dir == None:
+        # every replica works in the same run directory
+        cfg = SSDConfig(args.dirname)
+        cfg.save_at_beginning_of_run()
+        args.run_dir = cfg.g("run_dir")
+    print("Training {} replicas in {}".format(args.replicas,args.run_dir))
+
+    def start(job,task):
+        log = open("{}/{}-{}.log".format(args.run_dir,job,task),"w")
+        cmd = [sys.executable,os.path.abspath(__file__),args.dirname,"--job",job,"--task",str(task),
+               "--replicas",str(args.replicas),"--port",str(args.port),"--run_dir",args.run_dir]
+        if args.num_epochs != None:
+            cmd += ["--num_epochs",str(args.num_epochs)]
+        if restore:
+            cmd += ["--restore"]
+        return subprocess.Popen(cmd,stdout=log,stderr=subprocess.STDOUT)
+
+    start_time = time.time()
+    ps         = start("ps",0)
+    workers    = [start("worker",i) for i in range(args.replicas)]
+    codes      = [None]*len(workers)
+    try:
+        while None in codes:
+            codes  = [w.poll() for w in workers]
+            failed = [i for i,c in enumerate(codes) if c not in (None,0)]
+            if failed or ps.poll() != None:
+                print("Replicas {} failed{}, stopping the others".format(failed," and the parameter server exited" if ps.poll() != None else ""))
+                break
+            time.sleep(1)
+    finally:
+        for w in workers:
+            if w.poll() == None:
+                w.terminate()
+        for w in workers:
+            w.wait()
+        ps.terminate()
+        ps.wait()
+    codes = [w.returncode for w in workers]
+
+    throughput = replica_throughput(args.run_dir,args.replicas)
+    print("Replicas exited with {} after {:.0f}s, {:.1f} images/sec in total, logs are in {}".format(
+          codes,time.time()-start_time,throughput,args.run_dir))
+    return (0 if all(c == 0 for c in codes) else 1), throughput
+
+
+def replica_throughput(run_dir,num_replicas):
+    """ Sum over the replicas of the median images/sec of their epochs, from their logs """
+    total = 0.0
+    for task in range(num_replicas):
+        rates = [float(m) for m in re.findall(r"EPOCH\[ \d+ \] ([\d.]+) images/sec",
+                                              open("{}/worker-{}.log".format(run_dir,task)).read())]
+        if rates:
+            total += float(np.median(rates))
+    return total
+
+
+def scaling(args,replica_counts):
+    """ Train with each number of replicas in turn, in a new run directory each, and print the
+    aggregate images/sec, the speedup and the efficiency relative to the first count """
+    results = []
+    for replicas in replica_counts:
+        args.replicas, args.run_dir = replicas, None
+        code, throughput = launch(args)
+        if code != 0:
+            print("Training with {} replicas failed".format(replicas))
+            return 1
+        results.append((replicas,throughput))
+
+    base_replicas, base = results[0]
+    print("replicas  images/sec  speedup  efficiency")
+    for replicas, throughput in results:
+        speedup = throughput/base if base else 0.0
+        print("{:8d}  {:10.1f}  {:7.2f}  {:9.0%}".format(replicas,throughput,speedup,speedup*base_replicas/replicas))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Data-parallel training with several replicas on this machine.",
+                                     epilog="Example: {} /Users/vivek/work/ssd-code/tiny_voc --replicas 4".format(sys.argv[0]))
+    parser.add_argument("dirname",help="directory containing the configuration yaml file")
+    parser.add_argument("--replicas",type=int,default=2,help="number of training replicas")
+    parser.add_argument("--port",type=int,default=2222,help="first of the replicas+1 localhost ports to use")
+    parser.add_argument("--run_dir",help="run directory to use or resume, a new run is created by default")
+    parser.add_argument("--num_epochs",type=int,help="train this many epochs instead of num_epochs of the configuration")
+    parser.add_argument("--scaling",type=lambda s: [int(v) for v in s.split(",")],
+                        help="measure the images/sec of training with each of these numbers of replicas, e.g. 1,2,4")
+    parser.add_argument("--job",choices=["ps","worker"],help=argparse.SUPPRESS)
+    parser.add_argument("--task",type=int,default=0,help=argparse.SUPPRESS)
+    parser.add_argument("--restore",action="store_true",help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scaling != None:
+        sys.exit(scaling(args,args.scaling))
+    if args.job == None:
+        sys.exit(launch(args)[0])
+    run_task(args)
@@ -0,0 +1,198 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from ssd_config import SSDConfig
+from session_config import session_config
+from net_factory import NetFactory
+from targets import SparseTargets
+from image_store import load_image
+from utils import fold_batch_norm
+from predictor import load_frozen_graph
+
+
+OUTPUTS = ["y_predict_loc","y_predict_conf"]
+
+# epsilon of tf.contrib.layers.batch_norm
+BATCH_NORM_EPSILON = 0.001
+
+
+class GraphExporter:
+    """
+    Turns a training checkpoint into a frozen inference graph: a GraphDef with only the net, where
+    every batch normalization is folded into the weights and bias of its conv layer and the weights
+    are constants. There is no optimizer, no loss, no input pipeline and no batch norm statistics in
+    it, so it loads faster, is smaller and runs fewer ops per frame.
+
+    The inputs keep their names, "x" and "phase" (a placeholder_with_default that nothing uses any
+    more), and so do the outputs "y_predict_loc" and "y_predict_conf", so that Predictor can run a
+    .pb the way it runs a checkpoint.
+
+    Args:
+    dirname - directory containing the configuration yaml file
+    model_name - checkpoint relative to dirname, e.g. Jul_05_161614_O3K2T/final-model
+    """
+
+    def __init__(self,dirname,model_name="trained-model"):
+        self.dirname    = dirname
+        self.model_name = model_name
+        self.cfg        = SSDConfig(dirname)
+
+    def _net(self,**kwargs):
+        cfg = self.cfg
+        return NetFactory.get_net(cfg.g("net"))(num_default_boxes=cfg.g("num_default_boxes"),
+                                                num_classes=cfg.g("num_classes"),**kwargs)
+
+    def _x_shape(self):
+        cfg = self.cfg
+        return (None,cfg.g("image_height"),cfg.g("image_width"),cfg.g("n_channels"))
+
+    def folded_params(self,images=None):
+        """ Restore the checkpoint into the net (the variables have the names training gave them, the
+        net is the first thing the training graph builds) and fold every layer.
+
+        Args: images - optional batch to run through the checkpoint, as reference for verify()
+        Returns - list of (weight,bias) per conv layer, and the outputs for images
+        """
+        with tf.Graph().as_default():
+            x     = tf.placeholder(tf.float32,self._x_shape(),name="x")
+            phase = tf.placeholder(tf.bool,name="phase")
+            net   = self._net()
+            y_predict_loc, y_predict_conf = net.graph(x,phase)
+
+            with tf.Session(config=session_config(self.cfg)) as sess:
+                saver = tf.train.Saver(tf.global_variables())
+                saver.restore(sess,self.dirname+"/"+self.model_name)
+
+                params = []
+                for name, weight, bias, bn in net.layers:
+                    w, b, gamma, beta, mean, var = sess.run([weight,bias,bn["gamma"],bn["beta"],
+                                                             bn["moving_mean"],bn["moving_variance"]])
+                    params.append(fold_batch_norm(w,b,gamma,beta,mean,var,BATCH_NORM_EPSILON))
+
+                reference = None
+                if images is not None:
+                    reference = sess.run([y_predict_loc,y_predict_conf],feed_dict={x:images,phase:False})
+
+        print("Folded {} conv layers".format(len(params)))
+        return params, reference
+
+    def inference_graph(self,params):
+        """ The GraphDef of the net with the folded params as constants, constant folded """
+        graph = tf.Graph()
+        with graph.as_default():
+            x     = tf.placeholder(tf.float32,self._x_shape(),name="x")
+            phase = tf.placeholder_with_default(False,[],name="phase")
+            net   = self._net(batch_norm=False,folded_params=params)
+            net.graph(x,phase)
+
+        graph_def = tf.graph_util.extract_sub_graph(graph.as_graph_def(),OUTPUTS+["phase"])
+        return TransformGraph(graph_def,["x","phase"],OUTPUTS,
+                              ["remove_nodes(op=Identity)","fold_constants(ignore_errors=true)","sort_by_execution_order"])
+
+    def export(self,output,images=None):
+        """ Write the frozen graph to output
+        Returns - the outputs of the checkpoint for images, see folded_params() """
+        params, reference = self.folded_params(images)
+        graph_def         = self.inference_graph(params)
+        with open(output+".tmp","wb") as f:
+            f.write(graph_def.SerializeToString())
+        os.replace(output+".tmp",output)
+        print("Wrote {} ({} nodes, {:.1f} MB)".format(output,len(graph_def.node),os.path.getsize(output)/1e6))
+        return reference
+
+
+def time_model(cfg,load,images,runs):
+    """ Seconds to load a model with load(graph,sess) and the median seconds per frame """
+    graph = tf.Graph()
+    t     = time.time()
+    with graph.as_default():
+        sess = tf.Session(graph=graph,config=session_config(cfg))
+        load(graph,sess)
+    load_time = time.time() - t
+
+    x       = graph.get_tensor_by_name("x:0")
+    phase   = graph.get_tensor_by_name("phase:0")
+    fetches = [graph.get_tensor_by_name(name+":0") for name in OUTPUTS]
+    times   = []
+    for i in range(runs+1):
+        t       = time.time()
+        outputs = sess.run(fetches,feed_dict={x:images[i % len(images):][:1],phase:False})
+        times.append(time.time()-t)
+    outputs = sess.run(fetches,feed_dict={x:images,phase:False})
+    sess.close()
+    # the first run allocates, leave it out
+    return load_time, float(np.median(times[1:])), outputs
+
+
+def verify(exporter,output,images,reference,runs=20,rtol=1e-3,atol=1e-3):
+    """ Compare the frozen graph with the checkpoint on images: load time, file size, latency
+    and the largest difference of the outputs. Returns whether the outputs match within tolerance """
+    cfg   = exporter.cfg
+    path  = exporter.dirname+"/"+exporter.model_name
+
+    def load_checkpoint(graph,sess):
+        saver = tf.train.import_meta_graph(path+".meta",clear_devices=True)
+        saver.restore(sess,path)
+
+    def load_frozen(graph,sess):
+        load_frozen_graph(output,graph)
+
+    ckpt_load, ckpt_frame, _ = time_model(cfg,load_checkpoint,images,runs)
+    pb_load, pb_frame, outputs = time_model(cfg,load_frozen,images,runs)
+    ckpt_size = sum(os.path.getsize(os.path.join(os.path.dirname(path),f)) for f in os.listdir(os.path.dirname(path) or ".")
+                    if f.startswith(os.path.basename(path)+".") and f != os.path.basename(output))
+
+    print("                 checkpoint   frozen")
+    print("load time        {:8.3f}s  {:8.3f}s".format(ckpt_load,pb_load))
+    print("size             {:8.1f}MB {:8.1f}MB".format(ckpt_size/1e6,os.path.getsize(output)/1e6))
+    print("latency / frame  {:8.2f}ms {:8.2f}ms".format(ckpt_frame*1000,pb_frame*1000))
+
+    ok = True
+    for name, ref, out in zip(OUTPUTS,reference,outputs):
+        diff  = np.abs(ref-out).max()
+        close = np.allclose(out,ref,rtol=rtol,atol=atol)
+        ok    = ok and close
+        print("{} max abs difference {:.2e} {}".format(name,diff,"ok" if close else "MISMATCH"))
+    return ok
+
+
+def sample_images(cfg,dirname,count):
+    """ count normalized validation images, random ones if there is no validation set """
+    shape = (cfg.g("image_height"),cfg.g("image_width"),cfg.g("n_channels"))
+    try:
+        names = SparseTargets.load(dirname,"val").img_names[:count]
+    except (IOError,OSError):
+        print("No validation set, verifying on random images")
+        return np.random.uniform(-1,1,(count,)+shape).astype(np.float32)
+    return load_images(cfg,names)
+
+
+def load_images(cfg,names):
+    """ Images of images_path as a normalized float32 batch """
+    shape  = (cfg.g("image_height"),cfg.g("image_width"),cfg.g("n_channels"))
+    images = [load_image(cfg.g("images_path")+"/"+name,*shape) for name in names]
+    return (np.asarray(images,dtype=np.float32) - 128)/128
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a training checkpoint as a frozen inference graph with "
+                                                 "the batch normalization folded into the conv layers.",
+                                     epilog="Example: {} /Users/vivek/work/ssd-code/tiny_voc Jul_05_161614_O3K2T/final-model".format(sys.argv[0]))
+    parser.add_argument("dirname",help="directory containing the configuration yaml file")
+    parser.add_argument("model_name",help="checkpoint relative to dirname")
+    parser.add_argument("--output",help="file to write, <model_name>.pb in dirname by default")
+    parser.add_argument("--verify",type=int,default=8,help="compare with the checkpoint on this many validation images, 0 to skip")
+    args = parser.parse_args()
+
+    exporter = GraphExporter(args.dirname,args.model_name)
+    output   = args.output or args.dirname+"/"+args.model_name+".pb"
+    images   = sample_images(exporter.cfg,args.dirname,args.verify) if args.verify > 0 else None
+    reference = exporter.export(output,images)
+
+    if images is not None and not verify(exporter,output,images,reference):
+        sys.exit(1)
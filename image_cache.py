@@ -0,0 +1,45 @@
+from collections import OrderedDict
+
+
+class ImageCache:
+    """
+    Least recently used cache of decoded images with a budget in bytes.
+    Images that would not fit in the budget on their own are not cached.
+    """
+
+    def __init__(self,max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes    = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self._images   = OrderedDict()
+
+    def __len__(self):
+        return len(self._images)
+
+    def get(self,key,load):
+        """ Return the cached image for key, calling load() to read it on a miss """
+        img = self._images.get(key)
+        if img is not None:
+            self.hits += 1
+            self._images.move_to_end(key)
+            return img
+
+        self.misses += 1
+        img = load()
+
+        if img.nbytes <= self.max_bytes:
+            while self.nbytes + img.nbytes > self.max_bytes:
+                _, evicted   = self._images.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+            self._images[key] = img
+            self.nbytes += img.nbytes
+
+        return img
+
+    def stats(self):
+        """ Counters for logging """
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "images": len(self._images), "bytes": self.nbytes, "max_bytes": self.max_bytes}
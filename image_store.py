@@ -0,0 +1,112 @@
+import os
+import sys
+import numpy as np
+import cv2 as cv
+import matplotlib.image as mpimg
+
+from ssd_config import SSDConfig
+from targets import SparseTargets
+
+
+def load_image(fname,height,width,channels=3):
+    """ Read an image as a uint8 array of shape (height,width,channels), resizing it if needed """
+    img = mpimg.imread(fname)
+
+    # matplotlib reads png files as floats in [0,1]
+    if img.dtype != np.uint8:
+        img = np.clip(np.round(img*255),0,255).astype(np.uint8)
+    if img.ndim == 2:
+        img = np.stack([img]*channels,axis=2)
+    img = img[:,:,:channels]
+
+    if img.shape[0] != height or img.shape[1] != width:
+        # cv.resize takes the size as (width,height)
+        img = cv.resize(img,(width,height))
+
+    return img
+
+
+class ImageStore:
+    """
+    Decoded and resized images of a data set in one uint8 file that is memory-mapped read-only.
+    Image i is the (height,width,channels) block at offset i*height*width*channels, the index maps
+    image names to i. Several processes can share one store, the OS page cache does the caching.
+    """
+
+    def __init__(self,fname):
+        index          = np.load(fname+".idx.npz")
+        self.fname     = fname
+        self.shape     = tuple(int(v) for v in index["shape"])
+        self.rows      = dict((name,i) for i,name in enumerate(index["img_names"]))
+        self._images   = np.memmap(fname, dtype=np.uint8, mode="r", shape=(len(self.rows),)+self.shape)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self,img_name):
+        return img_name in self.rows
+
+    def get(self,img_name):
+        """ The image as a read-only (height,width,channels) uint8 view into the store """
+        return self._images[self.rows[img_name]]
+
+    @staticmethod
+    def path(cfg):
+        return "{}/images-{}x{}x{}.u8".format(cfg.g("dirname"),cfg.g("image_height"),cfg.g("image_width"),cfg.g("n_channels"))
+
+    @staticmethod
+    def build(fname,img_names,images_path,height,width,channels):
+        """ Decode every image once and write them to fname. Images already in an existing store are copied
+        over instead of decoded again. """
+        img_names = sorted(set(img_names))
+        shape     = (height,width,channels)
+
+        old = None
+        if os.path.exists(fname) and os.path.exists(fname+".idx.npz"):
+            old = ImageStore(fname)
+            if old.shape != shape:
+                old = None
+
+        tmp_fname = "{}.{}.tmp".format(fname,os.getpid())
+        images    = np.memmap(tmp_fname, dtype=np.uint8, mode="w+", shape=(max(len(img_names),1),)+shape)
+
+        for i,img_name in enumerate(img_names):
+            if old != None and img_name in old:
+                images[i] = old.get(img_name)
+            else:
+                images[i] = load_image(images_path+"/"+img_name,height,width,channels)
+            if i % 1000 == 0:
+                print("ImageStore: {}/{} images".format(i,len(img_names)))
+
+        images.flush()
+        del images
+
+        with open(tmp_fname+".idx.npz","wb") as f:
+            np.savez(f, img_names=np.array(img_names,dtype=str), shape=np.array(shape))
+        os.replace(tmp_fname,fname)
+        os.replace(tmp_fname+".idx.npz",fname+".idx.npz")
+
+        return ImageStore(fname)
+
+    @staticmethod
+    def build_for_config(cfg,batch_types=("train","val")):
+        """ Build the store for every image referenced by the preprocessed data sets """
+        img_names = []
+        for batch_type in batch_types:
+            img_names += list(SparseTargets.load(cfg.g("dirname"),batch_type,cfg.g("num_preds")).img_names)
+
+        return ImageStore.build(ImageStore.path(cfg),img_names,cfg.g("images_path"),
+                                cfg.g("image_height"),cfg.g("image_width"),cfg.g("n_channels"))
+
+
+if __name__ == "__main__":
+    if (len(sys.argv) < 2 ):
+        print("Decode the training and validation images into one memory-mapped file.")
+        print("Usage:")
+        print("{} <directory-containing-configuration-yaml-file>".format(sys.argv[0]))
+        print("Example:")
+        print("{} {}".format(sys.argv[0],"/Users/vivek/work/ssd-code/tiny_voc"))
+        sys.exit()
+
+    store = ImageStore.build_for_config(SSDConfig(sys.argv[1]))
+    print("Wrote {} images to {}".format(len(store),store.fname))
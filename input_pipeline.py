@@ -0,0 +1,82 @@
+import tensorflow as tf
+
+
+class SSDInputPipeline:
+    """
+    tf.data input pipeline that replaces feeding batches through feed_dict.
+
+    The sparse targets of each image come from a Python generator, reading, decoding, resizing and
+    normalizing the image, densifying the targets and picking the random negatives for the
+    confidence loss mask happen in a parallel map inside the graph. Batches are prefetched.
+
+    All data sets share one reinitializable iterator: run init_ops[name] before going through
+    data set name, the tensors in outputs then return its batches until tf.errors.OutOfRangeError.
+    """
+
+    def __init__(self,cfg,datasets,batch_size,random_negatives=True):
+        """
+        Args:
+        cfg - SSDConfig
+        datasets - dict of name -> SparseTargets
+        batch_size - number of images in a batch, the last batch of a data set can be smaller
+        random_negatives - whether to build the confidence loss mask, it is all zeros otherwise
+        """
+        self.cfg = cfg
+        self.random_negatives = random_negatives
+
+        types  = (tf.float32, tf.float32, tf.int32, tf.int32, tf.int32)
+        shapes = (tf.TensorShape([None,cfg.g("image_height"),cfg.g("image_width"),cfg.g("n_channels")]),
+                  tf.TensorShape([None,cfg.g("num_loc")]),
+                  tf.TensorShape([None,cfg.g("num_conf")]),
+                  tf.TensorShape([None,1]),
+                  tf.TensorShape([None,cfg.g("num_conf")]))
+
+        self.iterator = tf.data.Iterator.from_structure(types,shapes)
+        self.init_ops = dict((name,self.iterator.make_initializer(self._dataset(data,batch_size)))
+                             for name,data in datasets.items())
+        self.outputs  = self.iterator.get_next()
+
+    def _generator(self,data):
+        images_path = self.cfg.g("images_path")
+        def gen():
+            for i in range(len(data)):
+                lo, hi = data.indptr[i], data.indptr[i+1]
+                yield (images_path+"/"+data.img_names[i], data.indices[lo:hi], data.labels[lo:hi],
+                       data.loc[lo:hi], data.n_matched[i])
+        return gen
+
+    def _parse(self,fname,indices,labels,loc,n_matched):
+        cfg       = self.cfg
+        num_preds = cfg.g("num_preds")
+
+        img = tf.image.decode_image(tf.read_file(fname),channels=cfg.g("n_channels"))
+        img.set_shape([None,None,cfg.g("n_channels")])
+        img = tf.image.resize_images(img,[cfg.g("image_height"),cfg.g("image_width")])
+        img = (img - 128.0)/128.0
+
+        indices = tf.expand_dims(indices,1)
+        y_conf  = tf.scatter_nd(indices,labels,[num_preds])
+        y_loc   = tf.reshape(tf.scatter_nd(indices,loc,[num_preds,4]),[num_preds*4])
+
+        if not self.random_negatives:
+            return img, y_loc, y_conf, tf.reshape(n_matched,[1]), tf.zeros([num_preds],tf.int32)
+
+        # positives plus neg_pos_ratio*n_matched random background boxes, as _get_yconf_masks does
+        positives   = tf.greater(y_conf,0)
+        n_negatives = tf.minimum(n_matched*cfg.g("neg_pos_ratio"),
+                                 num_preds - tf.reduce_sum(tf.cast(positives,tf.int32)))
+        noise       = tf.where(positives,-tf.ones([num_preds]),tf.random_uniform([num_preds]))
+        _, chosen   = tf.nn.top_k(noise,k=n_negatives)
+        y_conf_loss_mask = tf.cast(positives,tf.int32) + \
+                           tf.scatter_nd(tf.expand_dims(chosen,1),tf.ones_like(chosen),[num_preds])
+
+        return img, y_loc, y_conf, tf.reshape(n_matched,[1]), y_conf_loss_mask
+
+    def _dataset(self,data,batch_size):
+        dataset = tf.data.Dataset.from_generator(self._generator(data),
+                                                 (tf.string, tf.int32, tf.int32, tf.float32, tf.int32),
+                                                 (tf.TensorShape([]), tf.TensorShape([None]), tf.TensorShape([None]),
+                                                  tf.TensorShape([None,4]), tf.TensorShape([])))
+        dataset = dataset.map(self._parse,num_parallel_calls=self.cfg.g("input_parallel_calls"))
+        dataset = dataset.batch(batch_size)
+        return dataset.prefetch(self.cfg.g("prefetch_depth"))
@@ -9,9 +9,19 @@ class IllegalArgumentError(ValueError):
     pass
 
 class BaseNet:
-    def __init__(self,num_default_boxes,num_classes):
+    def __init__(self,num_default_boxes,num_classes,batch_norm=True,folded_params=None):
+        """
+        batch_norm : whether the conv layers have batch normalization
+        folded_params : optional list of (weight,bias) arrays, one per conv layer in the order graph()
+                        creates them, used as constants instead of variables. With batch_norm=False
+                        these are the weights with the batch normalization folded in, see export_graph.py
+        """
         self.num_default_boxes = num_default_boxes
         self.num_classes = num_classes
+        self.batch_norm = batch_norm
+        self.folded_params = iter(folded_params) if folded_params != None else None
+        # (name, weight, bias, dict of batch norm variables) of every conv layer graph() creates
+        self.layers = []
         pass
 
     def conv_layer_optional_pooling(self, x_tensor,n_outputs,n_ksize,n_strides,name,phase,
@@ -36,16 +46,28 @@ class BaseNet:
         
         num_channels = int(x_tensor.shape[-1])
     
-        filter_weight = tf.Variable(tf.truncated_normal(list(n_ksize)+[num_channels,n_outputs],mean=0,stddev=0.001))
-        filter_bias = tf.Variable(tf.zeros(n_outputs))
+        if self.folded_params != None:
+            weight, bias  = next(self.folded_params)
+            filter_weight = tf.constant(weight,dtype=tf.float32)
+            filter_bias   = tf.constant(bias,dtype=tf.float32)
+        else:
+            filter_weight = tf.Variable(tf.truncated_normal(list(n_ksize)+[num_channels,n_outputs],mean=0,stddev=0.001))
+            filter_bias = tf.Variable(tf.zeros(n_outputs))
     
         conv_layer = tf.nn.conv2d(x_tensor,filter_weight,[1]+list(n_strides)+[1],padding_type,name=name)
         conv_layer = tf.nn.bias_add(conv_layer,filter_bias)
 
-        # Add batch normalization
-        
-        h1 = tf.contrib.layers.batch_norm(conv_layer,center=True, scale=True,
-                                          is_training = phase)
+        bn_vars = {}
+        if self.batch_norm:
+            # Add batch normalization
+            before = set(tf.global_variables())
+            h1 = tf.contrib.layers.batch_norm(conv_layer,center=True, scale=True,
+                                              is_training = phase)
+            # gamma, beta, moving_mean and moving_variance
+            bn_vars = dict((v.op.name.split("/")[-1],v) for v in tf.global_variables() if v not in before)
+        else:
+            h1 = conv_layer
+        self.layers.append((name,filter_weight,filter_bias,bn_vars))
                                           
         
         conv_layer = tf.nn.relu(h1)
@@ -0,0 +1,149 @@
+import numpy as np
+
+from utils import decode_boxes
+
+
+def _overlaps(coords, area, rows, cols, iou_threshold):
+    """ (len(rows),len(cols)) boolean, whether the iou of boxes rows and cols is above iou_threshold.
+    iou > t is tested as intersection*(1+t) > t*(area1+area2), so there is no division and boxes
+    without area overlap nothing. When most pairs do not even overlap horizontally, as with many
+    spread out candidates, only the pairs that do get the rest of the test. """
+    x1, y1, x2, y2 = coords
+    w    = np.minimum(x2[rows,None], x2[cols]) - np.maximum(x1[rows,None], x1[cols])
+    wide = w > 0
+    if np.count_nonzero(wide) > wide.size//4:
+        h = np.minimum(y2[rows,None], y2[cols]) - np.maximum(y1[rows,None], y1[cols])
+        return np.maximum(w, 0)*np.maximum(h, 0)*(1 + iou_threshold) > iou_threshold*(area[rows,None] + area[cols])
+
+    r, c       = np.nonzero(wide)
+    rows, cols = rows[r], cols[c]
+    h          = np.minimum(y2[rows], y2[cols]) - np.maximum(y1[rows], y1[cols])
+    overlaps   = np.zeros(w.shape, dtype=bool)
+    overlaps[r, c] = np.maximum(h, 0)*w[r, c]*(1 + iou_threshold) > iou_threshold*(area[rows] + area[cols])
+    return overlaps
+
+
+def nms(boxes, scores, iou_threshold, max_detections=None, block_size=256):
+    """ Greedy non max suppression: take the box with the highest score, drop the boxes that overlap
+    it by more than iou_threshold, repeat with the remaining boxes.
+
+    The boxes are sorted by score and handled a block at a time, blocks of 32 boxes growing to
+    block_size. Within a block a box is kept if no kept box before it overlaps it, which is solved
+    for the whole block at once by repeating kept = not overlapped by an earlier kept box until it
+    stops changing (box j is settled after at most j rounds, usually it takes a few). The kept boxes
+    then drop every later box they overlap, and the next block is taken from the boxes that are left.
+
+    nms_benchmark.py compares it with non_max_suppression_fast, which used overlap over area rather
+    than iou and keeps fewer boxes. Over several runs of 10000 candidates this takes 107-141ms
+    against 115-173ms when few of them overlap, and 3.1-5.1ms against 1.5-2.6ms when they crowd
+    around a few objects. There it stays about twice as slow: it sorts every candidate by score,
+    stably so that ties keep their order, and compares a block of boxes at a time.
+
+    Args:
+    boxes - (n,4) array of left,top,right,bottom coordinates
+    scores - (n,) array
+    iou_threshold - boxes with a larger intersection over union with a kept box are suppressed
+    max_detections - optional maximum number of boxes to keep
+
+    Returns:
+    indices of the kept boxes, highest score first
+    """
+    order  = np.argsort(-np.asarray(scores).reshape(-1), kind="stable")
+    boxes  = np.asarray(boxes, dtype=np.float32).reshape(-1,4)[order]
+    coords = [np.ascontiguousarray(boxes[:,k]) for k in range(4)]
+    area   = (coords[2] - coords[0]) * (coords[3] - coords[1])
+
+    # positions in score order of the boxes that are not suppressed yet
+    remaining = np.arange(len(order))
+    keep      = []
+    n_kept    = 0
+    size      = min(32, block_size)
+    while len(remaining):
+        block, remaining = remaining[:size], remaining[size:]
+        size = min(size*2, block_size)
+        # a box can only suppress the boxes after it
+        overlap = np.triu(_overlaps(coords, area, block, block, iou_threshold), 1)
+
+        alive = np.ones(len(block), dtype=bool)
+        while True:
+            still = ~overlap[alive].any(axis=0)
+            if (still == alive).all():
+                break
+            alive = still
+        kept = block[alive]
+
+        if max_detections != None:
+            kept = kept[:max_detections - n_kept]
+        keep.append(kept)
+        n_kept += len(kept)
+
+        if (max_detections != None and n_kept >= max_detections) or not len(remaining):
+            break
+        # in chunks of growing size: when the first kept boxes suppress most of the others, as with
+        # crowded detections, the rest are only compared with what is left
+        start, chunk = 0, 1
+        while start < len(kept) and len(remaining):
+            overlaps  = _overlaps(coords, area, kept[start:start+chunk], remaining, iou_threshold)
+            remaining = remaining[~overlaps.any(axis=0)]
+            start, chunk = start + chunk, chunk*2
+
+    return order[np.concatenate(keep)] if keep else order[:0]
+
+
+def multiclass_nms(boxes, scores, classes, iou_threshold, pre_nms_top_k=None, max_detections=None):
+    """ nms() separately for every class: boxes of different classes never suppress each other.
+
+    Args:
+    boxes, scores, iou_threshold, max_detections - see nms(), max_detections is over all classes
+    classes - (n,) array of the class of each box
+    pre_nms_top_k - optional, only the pre_nms_top_k boxes with the highest scores go into nms
+
+    Returns:
+    indices of the kept boxes and their scores, highest score first
+    """
+    boxes   = np.asarray(boxes, dtype=np.float32).reshape(-1,4)
+    scores  = np.asarray(scores, dtype=np.float32).reshape(-1)
+    classes = np.asarray(classes).reshape(-1)
+
+    candidates = np.arange(len(scores))
+    if pre_nms_top_k != None and len(candidates) > pre_nms_top_k:
+        candidates = np.argpartition(-scores, pre_nms_top_k-1)[:pre_nms_top_k]
+
+    if len(candidates) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+    # Move the boxes of each class to their own region so that one nms() does every class
+    cand_boxes = boxes[candidates]
+    extent     = np.abs(cand_boxes).max() * 2 + 1
+    shifted    = cand_boxes + (classes[candidates] * extent)[:,None].astype(np.float32)
+
+    keep = candidates[nms(shifted, scores[candidates], iou_threshold, max_detections)]
+    return keep, scores[keep]
+
+
+def batched_nms(detections, iou_threshold, pre_nms_top_k=None, max_detections=None):
+    """ multiclass_nms() for every image of a batch
+
+    Args:
+    detections - list of (boxes, scores, classes) per image, as utils.decode_boxes returns them
+
+    Returns:
+    list of (indices, scores) per image
+    """
+    return [multiclass_nms(boxes, scores, classes, iou_threshold, pre_nms_top_k, max_detections)
+            for boxes, scores, classes in detections]
+
+
+def decode_and_nms(loc, conf, probs, default_boxes, threshold, iou_threshold, pre_nms_top_k=None,
+                   max_detections=None):
+    """ The detections of a batch on the host: utils.decode_boxes(), then batched_nms()
+
+    Args:
+    loc, conf, probs, default_boxes, threshold - see utils.decode_boxes()
+
+    Returns:
+    list of (boxes, scores, classes) per image, the kept boxes in score order
+    """
+    detections = decode_boxes(loc, conf, probs, default_boxes, threshold)
+    kept       = batched_nms(detections, iou_threshold, pre_nms_top_k, max_detections)
+    return [(boxes[keep], scores, classes[keep]) for (boxes, _, classes), (keep, scores) in zip(detections, kept)]
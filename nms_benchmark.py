@@ -0,0 +1,106 @@
+"""
+Time nms.multiclass_nms against non_max_suppression_fast, the nms the repository used before, on
+thousands of candidate boxes. It is kept here only as the reference to time against.
+The worst case of greedy nms is many candidates that barely overlap, every kept box has to be
+compared with every remaining one.
+
+Usage: python nms_benchmark.py [<repeats>]
+"""
+import sys
+import time
+import numpy as np
+
+from nms import multiclass_nms
+
+
+# Malisiewicz et al.
+def non_max_suppression_fast(boxes, overlapThresh):
+    # if there are no boxes, return an empty list
+    if len(boxes) == 0:
+        return []
+    
+    boxes = np.array(boxes, dtype=np.float32)
+    
+    # if the bounding boxes integers, convert them to floats --
+    # this is important since we'll be doing a bunch of divisions
+    if boxes.dtype.kind == "i":
+        boxes = boxes.astype("float")
+ 
+    # initialize the list of picked indexes 
+    pick = []
+ 
+    # grab the coordinates of the bounding boxes
+    x1 = boxes[:,0]
+    y1 = boxes[:,1]
+    x2 = boxes[:,2]
+    y2 = boxes[:,3]
+ 
+    # compute the area of the bounding boxes and sort the bounding
+    # boxes by the bottom-right y-coordinate of the bounding box
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+    idxs = np.argsort(y2)
+ 
+    # keep looping while some indexes still remain in the indexes
+    # list
+    while len(idxs) > 0:
+        # grab the last index in the indexes list and add the
+        # index value to the list of picked indexes
+        last = len(idxs) - 1
+        i = idxs[last]
+        pick.append(i)
+ 
+        # find the largest (x, y) coordinates for the start of
+        # the bounding box and the smallest (x, y) coordinates
+        # for the end of the bounding box
+        xx1 = np.maximum(x1[i], x1[idxs[:last]])
+        yy1 = np.maximum(y1[i], y1[idxs[:last]])
+        xx2 = np.minimum(x2[i], x2[idxs[:last]])
+        yy2 = np.minimum(y2[i], y2[idxs[:last]])
+ 
+        # compute the width and height of the bounding box
+        w = np.maximum(0, xx2 - xx1 + 1)
+        h = np.maximum(0, yy2 - yy1 + 1)
+ 
+        # compute the ratio of overlap
+        overlap = (w * h) / area[idxs[:last]]
+ 
+        # delete all indexes from the index list that have
+        idxs = np.delete(idxs, np.concatenate(([last],
+            np.where(overlap > overlapThresh)[0])))
+ 
+    # return only the bounding boxes that were picked using the
+    # integer data type
+    return boxes[pick].astype("int")
+
+
+def candidates(n, overlap, seed=0):
+    """ n boxes in a 640x480 image, overlap="low" spreads them out so that few get suppressed
+    (the worst case, nms runs once per box), "high" crowds them like detections of a few people """
+    rng  = np.random.RandomState(seed)
+    size = rng.uniform(8, 24, (n,2)) if overlap == "low" else rng.uniform(40, 120, (n,2))
+    xy   = rng.uniform(0, [640,480], (n,2)) if overlap == "low" else \
+           rng.uniform(0, 60, (n,2)) + rng.randint(0, 5, (n,1)) * 120
+    boxes = np.hstack([xy, xy+size]).astype(np.float32)
+    return boxes, rng.uniform(0, 1, n).astype(np.float32), np.ones(n, dtype=np.int32)
+
+
+def best_time(f, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.time()
+        f()
+        times.append(time.time() - t)
+    return min(times)*1000
+
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print("{:>6} {:>8} {:>12} {:>12} {:>10} {:>10}".format("boxes","overlap","fast (ms)","nms (ms)","fast kept","nms kept"))
+    for overlap in ["low","high"]:
+        for n in [100, 1000, 3000, 10000]:
+            boxes, scores, classes = candidates(n, overlap)
+            t_fast = best_time(lambda: non_max_suppression_fast(boxes, 0.3), repeat)
+            t_nms  = best_time(lambda: multiclass_nms(boxes, scores, classes, 0.3), repeat)
+            print("{:>6} {:>8} {:>12.2f} {:>12.2f} {:>10} {:>10}".format(
+                  n, overlap, t_fast, t_nms,
+                  len(non_max_suppression_fast(boxes, 0.3)), len(multiclass_nms(boxes, scores, classes, 0.3)[0])))
@@ -0,0 +1,193 @@
+import os
+import sys
+import threading
+import numpy as np
+import tensorflow as tf
+import cv2 as cv
+
+from inference import Inference
+from image_store import load_image
+from session_config import session_config
+from detection_ops import detection_ops
+from nms import decode_and_nms
+
+
+def load_frozen_graph(fname,graph=None):
+    """ Import a graph written by export_graph.py into graph (or the default graph) """
+    graph_def = tf.GraphDef()
+    with open(fname,"rb") as f:
+        graph_def.ParseFromString(f.read())
+    with (graph or tf.get_default_graph()).as_default():
+        tf.import_graph_def(graph_def,name="")
+
+
+class Predictor(Inference):
+    """
+    Inference with a model that stays loaded. The meta graph is imported, the checkpoint restored and
+    the post-processing ops built once, on the first call to predict(). After that a prediction is
+    one sess.run. The graph is finalized, and tf.Session.run can be called from several threads, so
+    one Predictor can be shared by threads.
+
+    Args:
+    dirname - directory containing the configuration yaml file
+    model_name - checkpoint relative to dirname, e.g. Jul_05_161614_O3K2T/final-model, or a frozen
+                 graph written by export_graph.py, e.g. Jul_05_161614_O3K2T/final-model.pb
+    in_graph_nms - decode the boxes and run non max suppression in the session (see detection_ops),
+                   in_graph_nms of the configuration by default
+    """
+
+    def __init__(self,dirname,model_name="trained-model",in_graph_nms=None):
+        Inference.__init__(self,dirname)
+        self.model_name   = model_name
+        self.in_graph_nms = self.cfg.g("in_graph_nms") if in_graph_nms == None else in_graph_nms
+        self._lock        = threading.Lock()
+        self._sess        = None
+
+    def _load(self):
+        with self._lock:
+            if self._sess != None:
+                return
+
+            cfg   = self.cfg
+            path  = self.dirname+"/"+self.model_name
+            graph = tf.Graph()
+            with graph.as_default():
+                sess  = tf.Session(graph=graph,config=session_config(cfg))
+                if path.endswith(".pb"):
+                    load_frozen_graph(path,graph)
+                else:
+                    saver = tf.train.import_meta_graph(path+".meta",clear_devices=True)
+                    saver.restore(sess,path)
+
+                self._x     = graph.get_tensor_by_name("x:0")
+                self._phase = graph.get_tensor_by_name("phase:0")
+                y_pred_conf = graph.get_tensor_by_name("y_predict_conf:0")
+                y_pred_loc  = graph.get_tensor_by_name("y_predict_loc:0")
+
+                all_probabilities   = tf.nn.softmax(tf.reshape(y_pred_conf,[-1,cfg.g("num_preds"),cfg.g("num_classes")]))
+                probs1, preds_conf1 = tf.nn.top_k(all_probabilities)
+                self._fetches = [tf.reshape(preds_conf1,[-1,cfg.g("num_preds")]),
+                                 y_pred_loc,
+                                 tf.reshape(probs1,[-1,cfg.g("num_preds")])]
+                if self.in_graph_nms:
+                    self._detection_fetches = detection_ops(y_pred_loc,y_pred_conf,cfg.default_boxes(),cfg.g("num_classes"),
+                                                            cfg.g("pred_conf_threshold"),cfg.g("nms_iou_threshold"),
+                                                            cfg.g("pre_nms_top_k"),cfg.g("max_detections"))
+                graph.finalize()
+
+            # set last, it is what tells the other threads the model is ready
+            self._sess = sess
+
+    def prepare_image(self,image):
+        """ A file name, relative to images_path or not, or an image array as a normalized float32
+        (image_height,image_width,n_channels) array """
+        cfg = self.cfg
+        height, width, channels = cfg.g("image_height"), cfg.g("image_width"), cfg.g("n_channels")
+
+        if isinstance(image,str):
+            fname = image if os.path.exists(image) else cfg.g("images_path")+"/"+image
+            image = load_image(fname,height,width,channels)
+        else:
+            image = np.asarray(image)
+            if image.dtype != np.uint8 and image.max() <= 1.0:
+                # matplotlib style floats in [0,1]
+                image = image*255
+            if image.shape[0] != height or image.shape[1] != width:
+                # cv.resize takes the size as (width,height)
+                image = cv.resize(image,(width,height))
+
+        return (np.asarray(image,dtype=np.float32) - 128)/128
+
+    def predict(self,image):
+        """
+        Args: image - a file name or an image array
+        Returns - predicted_conf, predicted_loc, predicted_probs, as run_inference does
+        """
+        return self.predict_batch([image])
+
+    def predict_batch(self,images,batch_size=None,fetches=None):
+        """ Predict several images, inference_batch_size (or batch_size) images per sess.run
+        Args: images - list of file names or image arrays
+              fetches - other tensors to run than the net outputs, e.g. the detection ops
+        Returns - predicted_conf, predicted_loc, predicted_probs (or the fetches) with one row per image
+        """
+        if self._sess == None:
+            self._load()
+        fetches    = fetches or self._fetches
+        if len(images) == 0:
+            # no rows, with the shapes and types a sess.run would have
+            return [np.zeros([0]+[d or 0 for d in f.shape.as_list()[1:]],dtype=f.dtype.as_numpy_dtype) for f in fetches]
+
+        cfg        = self.cfg
+        batch_size = batch_size or cfg.g("inference_batch_size")
+        batch      = np.empty([min(batch_size,len(images)),cfg.g("image_height"),cfg.g("image_width"),cfg.g("n_channels")],
+                              dtype=np.float32)
+        outputs    = []
+        for start in range(0,len(images),batch_size):
+            count = min(batch_size,len(images)-start)
+            for i in range(count):
+                batch[i] = self.prepare_image(images[start+i])
+            outputs.append(self._sess.run(fetches,feed_dict={self._x:batch[:count],self._phase:0}))
+
+        if len(outputs) == 1:
+            return outputs[0]
+        return [np.concatenate(out) for out in zip(*outputs)]
+
+    def detect_batch(self,images,batch_size=None):
+        """ The boxes of each image with a probability above pred_conf_threshold, after per class non
+        max suppression (nms_iou_threshold, pre_nms_top_k, max_detections). With in_graph_nms this
+        happens in the session, otherwise on the host.
+        Returns - list of (boxes, scores, classes) per image, highest score first
+        """
+        if len(images) == 0:
+            return []
+        if self._sess == None:
+            self._load()
+        fetches = self._detection_fetches if self.in_graph_nms else None
+        return self._detections(self.predict_batch(images,batch_size,fetches))
+
+    def detect_prepared(self,batch):
+        """ detect_batch() for a batch that is already prepared, a float32 array of prepare_image()
+        results, in one sess.run. For callers that prepare the images in other threads. """
+        if len(batch) == 0:
+            return []
+        if self._sess == None:
+            self._load()
+        fetches = self._detection_fetches if self.in_graph_nms else self._fetches
+        return self._detections(self._sess.run(fetches,feed_dict={self._x:batch,self._phase:0}))
+
+    def _detections(self,outputs):
+        if self.in_graph_nms:
+            boxes, scores, classes, count = outputs
+            return [(boxes[i,:n], scores[i,:n], classes[i,:n]) for i,n in enumerate(count)]
+
+        cfg                    = self.cfg
+        p_conf, p_loc, p_probs = outputs
+        return decode_and_nms(p_loc,p_conf,p_probs,cfg.default_boxes(),cfg.g("pred_conf_threshold"),
+                              cfg.g("nms_iou_threshold"),cfg.g("pre_nms_top_k"),cfg.g("max_detections"))
+
+    def close(self):
+        with self._lock:
+            if self._sess != None:
+                self._sess.close()
+                self._sess = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    if (len(sys.argv) < 4 ):
+        print("Predict the boxes of images with a model that is loaded once.")
+        print("Usage:")
+        print("{} <directory-containing-configuration-yaml-file> <model-name-relative-to-directory> <image> [<image> ...]".format(sys.argv[0]))
+        print("Example:")
+        print("{} {} {} {}".format(sys.argv[0],"/Users/vivek/work/ssd-code/tiny_voc","Jul_05_161614_O3K2T/final-model","set00_V000_0.png"))
+        sys.exit()
+
+    with Predictor(sys.argv[1],sys.argv[2]) as predictor:
+        for image, (boxes, scores, classes) in zip(sys.argv[3:],predictor.detect_batch(sys.argv[3:])):
+            print(image,len(boxes),"boxes")
@@ -0,0 +1,169 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+
+from ssd_config import SSDConfig
+from session_config import session_config
+from targets import SparseTargets
+from export_graph import GraphExporter, OUTPUTS, load_images
+from predictor import load_frozen_graph
+from utils import match_detections
+from nms import decode_and_nms
+
+
+class Quantizer:
+    """
+    Post-training 8-bit quantization of the detector for CPU serving. The frozen inference graph
+    (export_graph.py, batch norm already folded) is converted to TensorFlow Lite with the weights and
+    activations in int8. The activation ranges come from running calibration images, a sample of the
+    validation set, through the float model. Inputs and outputs stay float32, so the images are
+    prepared the same way as for the float model.
+
+    Args:
+    dirname - directory containing the configuration yaml file
+    model_name - frozen graph (.pb) relative to dirname, or a checkpoint, which is exported first
+    """
+
+    def __init__(self,dirname,model_name):
+        self.dirname = dirname
+        self.cfg     = SSDConfig(dirname)
+        if not model_name.endswith(".pb"):
+            GraphExporter(dirname,model_name).export(dirname+"/"+model_name+".pb")
+            model_name = model_name+".pb"
+        self.model_name = model_name
+
+    def split_validation(self,n_calibration,n_eval):
+        """ Names of n_calibration random validation images to calibrate on and n_eval other ones to
+        compare the models on """
+        names = SparseTargets.load(self.dirname,"val").img_names
+        seed  = self.cfg.g("random_seed")
+        names = np.random.RandomState(seed).permutation(names)
+        return names[:n_calibration], names[n_calibration:n_calibration+n_eval]
+
+    def convert(self,output,calibration=None):
+        """ Write the TensorFlow Lite model to output, int8 calibrated on the calibration images
+        (a normalized batch), or float32 without them """
+        cfg       = self.cfg
+        converter = tf.lite.TFLiteConverter.from_frozen_graph(self.dirname+"/"+self.model_name,["x"],OUTPUTS,
+                                                              {"x":[1,cfg.g("image_height"),cfg.g("image_width"),cfg.g("n_channels")]})
+        if calibration is not None:
+            def representative_dataset():
+                for image in calibration:
+                    yield [image[None]]
+            converter.optimizations              = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset     = representative_dataset
+            # every op in int8, fail rather than silently leave layers in float
+            converter.target_spec.supported_ops  = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+        t     = time.time()
+        model = converter.convert()
+        with open(output+".tmp","wb") as f:
+            f.write(model)
+        os.replace(output+".tmp",output)
+        print("Wrote {} ({:.1f} MB) in {:.1f}s".format(output,len(model)/1e6,time.time()-t))
+        return output
+
+
+class TFLiteModel:
+    """ Runs a model written by Quantizer one image at a time, the outputs as the frozen graph has them """
+
+    def __init__(self,fname):
+        self.interpreter = tf.lite.Interpreter(model_path=fname)
+        self.interpreter.allocate_tensors()
+        self._input      = self.interpreter.get_input_details()[0]["index"]
+        outputs          = dict((d["name"],d["index"]) for d in self.interpreter.get_output_details())
+        self._outputs    = [outputs[name] for name in OUTPUTS]
+
+    def run(self,image):
+        """ Returns - y_predict_loc, y_predict_conf of one normalized image, with a batch dimension """
+        self.interpreter.set_tensor(self._input,image[None])
+        self.interpreter.invoke()
+        return [self.interpreter.get_tensor(i) for i in self._outputs]
+
+
+def detections(cfg,y_predict_loc,y_predict_conf):
+    """ The boxes after non max suppression, as Predictor.detect_batch returns them """
+    # the softmax and top 1 class that Predictor runs in the graph
+    probs  = np.exp(y_predict_conf.reshape(len(y_predict_conf),cfg.g("num_preds"),cfg.g("num_classes")))
+    probs /= probs.sum(axis=2,keepdims=True)
+    return decode_and_nms(y_predict_loc,probs.argmax(axis=2),probs.max(axis=2),cfg.default_boxes(),cfg.g("pred_conf_threshold"),
+                          cfg.g("nms_iou_threshold"),cfg.g("pre_nms_top_k"),cfg.g("max_detections"))
+
+
+def run_models(cfg,frozen,tflite_models,images):
+    """ Run the frozen graph and every TensorFlow Lite model on images one at a time
+    Returns - {name: (median seconds per image, y_predict_loc, y_predict_conf)} """
+    results = {}
+    with tf.Graph().as_default() as graph:
+        load_frozen_graph(frozen,graph)
+        x       = graph.get_tensor_by_name("x:0")
+        fetches = [graph.get_tensor_by_name(name+":0") for name in OUTPUTS]
+        with tf.Session(graph=graph,config=session_config(cfg)) as sess:
+            results["frozen graph"] = time_runs(lambda image: sess.run(fetches,feed_dict={x:image[None]}),images)
+
+    for name, fname in tflite_models:
+        model         = TFLiteModel(fname)
+        results[name] = time_runs(model.run,images)
+    return results
+
+
+def time_runs(run,images):
+    run(images[0])
+    times, locs, confs = [], [], []
+    for image in images:
+        t         = time.time()
+        loc, conf = run(image)
+        times.append(time.time()-t)
+        locs.append(loc)
+        confs.append(conf)
+    return float(np.median(times)), np.concatenate(locs), np.concatenate(confs)
+
+
+def compare(cfg,results,reference,quantized,iou_threshold=0.5):
+    """ Print the latency of every model, and how well the detections of the quantized model agree
+    with the reference: the fraction of the reference detections it finds (same class, overlap of at
+    least iou_threshold) and the fraction of its detections that the reference has """
+    ref_time = results[reference][0]
+    for name, (seconds, _, _) in sorted(results.items(),key=lambda r: -r[1][0]):
+        print("{:16s} {:8.2f}ms / image  {:5.2f}x".format(name,seconds*1000,ref_time/seconds))
+
+    _, ref_loc, ref_conf = results[reference]
+    _, q_loc, q_conf     = results[quantized]
+    ref_dets             = detections(cfg,ref_loc,ref_conf)
+    q_dets               = detections(cfg,q_loc,q_conf)
+
+    matched  = sum(match_detections(rb,rc,qb,qc,iou_threshold) for (rb,_,rc),(qb,_,qc) in zip(ref_dets,q_dets))
+    n_ref    = sum(len(d[0]) for d in ref_dets)
+    n_q      = sum(len(d[0]) for d in q_dets)
+    recall    = matched/n_ref if n_ref else 1.0
+    precision = matched/n_q if n_q else 1.0
+    print("{} vs {} on {} images: {} vs {} detections, recall {:.3f}, precision {:.3f}".format(
+          quantized,reference,len(ref_dets),n_q,n_ref,recall,precision))
+    print("max abs difference y_predict_loc {:.3f} y_predict_conf {:.3f}".format(np.abs(ref_loc-q_loc).max(),
+                                                                                np.abs(ref_conf-q_conf).max()))
+    return recall, precision
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantize a model to int8 with calibration on validation images and "
+                                                 "compare its speed and detections with the float model.",
+                                     epilog="Example: {} /Users/vivek/work/ssd-code/tiny_voc Jul_05_161614_O3K2T/final-model".format(sys.argv[0]))
+    parser.add_argument("dirname",help="directory containing the configuration yaml file")
+    parser.add_argument("model_name",help="checkpoint or frozen graph (.pb) relative to dirname")
+    parser.add_argument("--calibration",type=int,default=100,help="number of validation images to calibrate on")
+    parser.add_argument("--eval",type=int,default=50,help="number of other validation images to compare the models on, 0 to skip")
+    args = parser.parse_args()
+
+    quantizer = Quantizer(args.dirname,args.model_name)
+    base      = args.dirname+"/"+quantizer.model_name[:-len(".pb")]
+    calib, evaluation = quantizer.split_validation(args.calibration,args.eval)
+
+    int8  = quantizer.convert(base+"-int8.tflite",load_images(quantizer.cfg,calib))
+    if args.eval > 0:
+        float32 = quantizer.convert(base+"-float.tflite")
+        results = run_models(quantizer.cfg,args.dirname+"/"+quantizer.model_name,
+                             [("tflite float",float32),("tflite int8",int8)],load_images(quantizer.cfg,evaluation))
+        compare(quantizer.cfg,results,"frozen graph","tflite int8")
@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+import pickle
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2 as cv
+
+from predictor import Predictor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"tools"))
+from converter import SeqReader
+
+
+class SeqInference:
+    """
+    Inference straight from Caltech .seq files, without extracting them to jpg files first. The frames
+    are memoryviews into the memory mapped .seq file (see SeqReader in tools/converter.py), decoded and
+    prepared by a pool of threads (cv.imdecode and cv.resize release the GIL), and inference_batch_size
+    of them at a time go through a Predictor while the pool decodes the next ones. The detections of
+    each frame go to one pickle per sequence.
+
+    Args:
+    dirname - directory containing the configuration yaml file
+    model_name - checkpoint or frozen graph relative to dirname, see Predictor
+    workers - decoding threads
+    """
+
+    def __init__(self,dirname,model_name="trained-model",workers=4):
+        self.predictor = Predictor(dirname,model_name)
+        self.cfg       = self.predictor.cfg
+        self.workers   = workers
+
+    def _decode(self,frame):
+        """ An encoded frame as a prepared image """
+        image = cv.imdecode(np.frombuffer(frame,dtype=np.uint8),cv.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Could not decode a frame of {} bytes".format(len(frame)))
+        # opencv decodes to BGR, the net is trained on RGB
+        return self.predictor.prepare_image(cv.cvtColor(image,cv.COLOR_BGR2RGB))
+
+    def _prepared_batches(self,pool,frames,batch_size):
+        """ Generator of batches of prepared frames. At most two batches are being decoded ahead
+        of the one that is returned, so memory stays bounded however long the sequence is. """
+        cfg     = self.cfg
+        pending = collections.deque()
+        frames  = iter(frames)
+        batch   = np.empty([batch_size,cfg.g("image_height"),cfg.g("image_width"),cfg.g("n_channels")],dtype=np.float32)
+
+        def fill():
+            while len(pending) < 3*batch_size:
+                frame = next(frames,None)
+                if frame is None:
+                    return
+                pending.append(pool.submit(self._decode,frame))
+
+        fill()
+        while pending:
+            count = min(batch_size,len(pending))
+            for i in range(count):
+                batch[i] = pending.popleft().result()
+            fill()
+            yield batch[:count]
+
+    def run_sequence(self,seq_path,output,batch_size=None):
+        """ Detect the boxes of every frame of seq_path and write them to output, a pickle of a dict
+        with "seq" and "frames", a list of (boxes, scores, classes) per frame as Predictor.detect_batch
+        returns them
+        Returns - number of frames """
+        batch_size = batch_size or self.cfg.g("inference_batch_size")
+        detections = []
+        with SeqReader(seq_path) as reader, ThreadPoolExecutor(self.workers) as pool:
+            for batch in self._prepared_batches(pool,reader,batch_size):
+                detections.extend(self.predictor.detect_prepared(batch))
+
+        with open(output+".tmp","wb") as f:
+            pickle.dump({"seq":seq_path,"frames":detections},f)
+        os.replace(output+".tmp",output)
+        return len(detections)
+
+    def run_folder(self,folder,output_dir,batch_size=None):
+        """ run_sequence() for every .seq file under folder, e.g. set00/V000.seq goes to
+        output_dir/set00_V000.pkl. Sequences whose output exists already are skipped. """
+        os.makedirs(output_dir,exist_ok=True)
+        for root, dirs, files in sorted(os.walk(folder)):
+            for fname in sorted(f for f in files if f.endswith(".seq")):
+                seq_path = os.path.join(root,fname)
+                name     = os.path.relpath(seq_path,folder)[:-len(".seq")].replace(os.sep,"_")
+                output   = os.path.join(output_dir,name+".pkl")
+                if os.path.exists(output):
+                    print("Skipping {}, {} exists".format(seq_path,output))
+                    continue
+
+                t        = time.time()
+                n_frames = self.run_sequence(seq_path,output,batch_size)
+                elapsed  = time.time() - t
+                print("{} {} frames in {:.1f}s, {:.1f} frames/sec -> {}".format(seq_path,n_frames,elapsed,
+                                                                               n_frames/max(elapsed,1e-9),output))
+
+    def close(self):
+        self.predictor.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detect the boxes of every frame of Caltech .seq files, reading the "
+                                                 "frames straight from the .seq files.",
+                                     epilog="Example: {} /Users/vivek/work/ssd-code/tiny_voc Jul_05_161614_O3K2T/final-model "
+                                            "caltech/set06 detections".format(sys.argv[0]))
+    parser.add_argument("dirname",help="directory containing the configuration yaml file")
+    parser.add_argument("model_name",help="checkpoint or frozen graph (.pb) relative to dirname")
+    parser.add_argument("seqs",help="a .seq file or a folder to search for .seq files")
+    parser.add_argument("output_dir",help="where to write the detections, one pickle per sequence")
+    parser.add_argument("--workers",type=int,default=4,help="decoding threads")
+    parser.add_argument("--batch_size",type=int,help="frames per sess.run, inference_batch_size by default")
+    args = parser.parse_args()
+
+    seq_inference = SeqInference(args.dirname,args.model_name,args.workers)
+    if os.path.isdir(args.seqs):
+        seq_inference.run_folder(args.seqs,args.output_dir,args.batch_size)
+    else:
+        os.makedirs(args.output_dir,exist_ok=True)
+        output = os.path.join(args.output_dir,os.path.basename(args.seqs)[:-len(".seq")]+".pkl")
+        print(args.seqs,seq_inference.run_sequence(args.seqs,output,args.batch_size),"frames")
+    seq_inference.close()
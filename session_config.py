@@ -0,0 +1,8 @@
+import tensorflow as tf
+
+
+def session_config(cfg,**kwargs):
+    """ tf.ConfigProto with the thread settings of cfg, kwargs are passed on to ConfigProto """
+    return tf.ConfigProto(intra_op_parallelism_threads=cfg.g("intra_op_threads"),
+                          inter_op_parallelism_threads=cfg.g("inter_op_threads"),
+                          **kwargs)
@@ -1,31 +1,172 @@
 import yaml
 import time, random, string
 import os
+import json
+import hashlib
+import numpy as np
+
+# Settings that older configuration files may not have.
+DEFAULTS = {
+    "preprocess_workers": 1,
+    "random_seed": None,
+    "use_image_store": False,
+    "image_cache_bytes": 2*1024**3,
+    "loader_workers": 0,
+    "prefetch_depth": 2,
+    "input_pipeline": "feed_dict",
+    "input_parallel_calls": 4,
+    "negative_mining": "random",
+    "debug_stats_period": 0,
+    "checkpoint_every_secs": 0,
+    "checkpoint_max_to_keep": 5,
+    "micro_batch_size": None,
+    "intra_op_threads": 0,
+    "inter_op_threads": 0,
+    "inference_batch_size": 8,
+    "in_graph_nms": False,
+    "nms_iou_threshold": 0.3,
+    "pre_nms_top_k": 200,
+    "max_detections": 50,
+    "replica_wait_secs": 600,
+}
+
+# Written by tune.py next to ssd_config.yaml
+TUNED_PROFILE = "tuned_profile.yaml"
+# The settings a tuned profile may fill in, they change speed but not what is computed
+TUNED_KEYS = ["intra_op_threads","inter_op_threads","prefetch_depth","inference_batch_size"]
 
 class SSDConfig:
     def __init__(self,dirname):
-        self._c = yaml.load(open(dirname+"/ssd_config.yaml","r"))
+        self._c = yaml.safe_load(open(dirname+"/ssd_config.yaml","r"))
         self._c["dirname"] = dirname
         # TODO assert that it has all the vars
 
+        # The tuned profile only fills in what the configuration file leaves empty
+        profile = dirname+"/"+TUNED_PROFILE
+        if os.path.exists(profile):
+            for k,v in (yaml.safe_load(open(profile,"r")) or {}).items():
+                if k in TUNED_KEYS and self._c.get(k) is None:
+                    self._c[k] = v
+
+        for k in DEFAULTS:
+            self._c.setdefault(k,DEFAULTS[k])
+
         self._c["num_default_boxes"] = len(self._c["default_box_scales"])
 
         total = 0
 
         for i in self._c["feature_maps"]:
             total += i[0]*i[1]*self._c["num_default_boxes"]
-            
+
         self._c["num_conf"]  = total
         self._c["num_preds"] = total
         self._c["num_loc"]   = total*4
+
+        self._default_boxes = None
+        self._default_boxes64 = None
+        self._feature_map_offsets = None
+        self._default_box_cells = None
         pass
 
     def g(self,var):
         return self._c[var]
 
+    def set(self,var,value):
+        self._c[var] = value
+
+    def _geometry_hash(self):
+        """ Hash of every setting that changes the position or size of a default box """
+        geometry = [self._c[k] for k in ["image_width","image_height","feature_maps","default_box_scales"]]
+        return hashlib.sha1(json.dumps(geometry).encode("utf-8")).hexdigest()[:16]
+
+    def _compile_default_boxes(self):
+        """ Build the default box table in the order the net outputs its predictions:
+        feature map, row, column, default box scale.
+
+        Returns:
+        boxes - (num_preds,4) float64 array of cx,cy,w,h in image coordinates
+        offsets - (num_feature_maps+1,) int array, default boxes of feature map i are boxes[offsets[i]:offsets[i+1]]
+        cells - (num_preds,4) float32 array of the left,top,right,bottom of the feature map cell of every default box
+        """
+        boxes   = []
+        cells   = []
+        offsets = [0]
+        scales  = np.array(self._c["default_box_scales"], dtype=np.float64)
+
+        for feat_map in self._c["feature_maps"]:
+            # width and height of a cell
+            cell_w = self._c["image_width"]/feat_map[0]
+            cell_h = self._c["image_height"]/feat_map[1]
+
+            rows, cols = np.meshgrid(np.arange(feat_map[0]), np.arange(feat_map[1]), indexing="ij")
+
+            dbox = np.zeros([feat_map[0], feat_map[1], len(scales), 4])
+            dbox[...,0] = (rows[...,None] + 0.5 + scales[:,0])*cell_w
+            dbox[...,1] = (cols[...,None] + 0.5 + scales[:,1])*cell_h
+            dbox[...,2] = cell_w*scales[:,2]
+            dbox[...,3] = cell_h*scales[:,3]
+            boxes.append(dbox.reshape(-1,4))
+            offsets.append(offsets[-1] + boxes[-1].shape[0])
+
+            cell = np.stack([rows*cell_w, cols*cell_h, (rows+1)*cell_w, (cols+1)*cell_h], axis=-1)
+            cells.append(np.repeat(cell.reshape(-1,4), len(scales), axis=0))
+
+        return (np.concatenate(boxes), np.array(offsets, dtype=np.int64),
+                np.concatenate(cells).astype(np.float32))
+
+    def _load_default_boxes(self):
+        """ Load the default box table from the config directory, building and saving it on a miss """
+        fname = "{}/default_boxes-{}.npz".format(self._c["dirname"], self._geometry_hash())
+
+        try:
+            cached = np.load(fname)
+            # tables saved in float32 are rebuilt
+            if cached["boxes"].dtype == np.float64:
+                return cached["boxes"], cached["offsets"], cached["cells"]
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+
+        boxes, offsets, cells = self._compile_default_boxes()
+
+        # Write to a temporary file first so that concurrent readers never see half a file.
+        tmp_fname = "{}.{}.tmp".format(fname, os.getpid())
+        try:
+            with open(tmp_fname, "wb") as f:
+                np.savez(f, boxes=boxes, offsets=offsets, cells=cells)
+            os.replace(tmp_fname, fname)
+        except OSError:
+            # read-only config directory, just use the table we built
+            pass
+
+        return boxes, offsets, cells
+
+    def default_boxes(self,dtype=np.float32):
+        """ (num_preds,4) array of default box cx,cy,w,h, index i is prediction i of the net. float32 for
+        decoding the predictions, np.float64 gives the exact table that the targets are encoded with """
+        if self._default_boxes is None:
+            self._default_boxes64, self._feature_map_offsets, self._default_box_cells = self._load_default_boxes()
+            self._default_boxes = self._default_boxes64.astype(np.float32)
+        return self._default_boxes64 if dtype == np.float64 else self._default_boxes
+
+    def feature_map_offsets(self):
+        """ Index of the first default box of each feature map, followed by num_preds """
+        self.default_boxes()
+        return self._feature_map_offsets
+
+    def default_box_cells(self):
+        """ (num_preds,4) float32 array of the left,top,right,bottom of the feature map cell of every default box """
+        self.default_boxes()
+        return self._default_box_cells
+
     def _run_name(self):
         return time.strftime("%b_%d_%H%M%S_") + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(5))
-    
+
+    def resume_run(self,run_dir):
+        """ Continue the run in run_dir instead of starting a new one """
+        run_dir = run_dir.rstrip("/")
+        self._c["run_name"] = os.path.basename(run_dir)
+        self._c["run_dir"]  = run_dir
+
     def save_at_beginning_of_run(self):
         # create a run_name and
         self._c["run_name"] = self._run_name()
@@ -35,6 +176,6 @@ class SSDConfig:
             os.makedirs(self._c["run_dir"])
         except OSError:
             pass
-        
+
         yaml.dump(self._c, open(self._c["run_dir"]+"/"+self._c["run_name"]+".yaml","w"))
-        
+
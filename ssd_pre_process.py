@@ -1,8 +1,9 @@
 import random
 import numpy as np
-from utils import iou
-import pickle
+from utils import iou_matrix
+import multiprocessing
 from dataset_factory import DatasetFactory
+from targets import SparseTargets
 
 
 class SSDPreProcess:
@@ -27,24 +28,6 @@ class SSDPreProcess:
         """
         return np.log(gt/def_box_l)
 
-    def _gt_diff_defbox_normalized(self,cx_real,cy_real,dbox_w,dbox_h,box):
-        """
-        Get the normalized 
-        """
-        # center of gt
-        gt_cx = box[0] + box[2]/2
-        gt_cy = box[1] + box[3]/2
-
-        # h,w of gt
-        gt_w = box[2]
-        gt_h = box[3]
-
-        gt_normalized = [self._normalize_center(gt_cx,cx_real,dbox_w),\
-        self._normalize_center(gt_cy,cy_real,dbox_h),\
-        self._normalize_wh(gt_w,dbox_w),\
-        self._normalize_wh(gt_h,dbox_h)]
-        return gt_normalized
-
     def _get_label(self,lbl):
         """
         Return the label. Here I'm not distinguishing between person and people for now.
@@ -52,14 +35,6 @@ class SSDPreProcess:
         return self.dataset.get_label_num(lbl)
 
     
-    def _get_default_box_real_coords(self,cx_real,cy_real,dbox_w,dbox_h):
-        # Calculate real coordinates of left-top point and right-bottom using above    
-        def_l_x = cx_real - dbox_w*1.0/2
-        def_l_y = cy_real - dbox_h*1.0/2
-        def_r_x = cx_real + dbox_w*1.0/2
-        def_r_y = cy_real + dbox_h*1.0/2
-        return [def_l_x,def_l_y,def_r_x,def_r_y]
-
     def calc_default_box_sizes(self):
         # k default boxes 4
         # m feature maps 4 
@@ -75,116 +50,182 @@ class SSDPreProcess:
         
             
     
-    def pre_process_and_write_images(self,img_data,dirname,name,keys=None):
+    def _default_box_corners(self,dboxes):
+        """ Convert (N,4) cx,cy,w,h default boxes into left-top and right-bottom coordinates """
+        return np.stack([dboxes[:,0] - dboxes[:,2]*1.0/2,
+                         dboxes[:,1] - dboxes[:,3]*1.0/2,
+                         dboxes[:,0] + dboxes[:,2]*1.0/2,
+                         dboxes[:,1] + dboxes[:,3]*1.0/2], axis=1)
+
+    def _match_default_boxes(self,dboxes,dbox_corners,bboxes,labels,threshold=0.3):
+        """ Match every default box against every ground truth box of one image.
+
+        Args:
+        dboxes - (num_preds,4) default boxes as cx,cy,w,h
+        dbox_corners - the same default boxes as left,top,right,bottom
+        bboxes - ground truth boxes as left,top,width,height
+        labels - numerical label of each ground truth box
+        threshold - minimum iou for a default box to match a ground truth box
+
+        Returns:
+        y_conf - (num_preds,) int array with the label of the matched gt box (0 = background)
+        y_loc - (num_preds*4,) float array of normalized offsets to the matched gt box
+        n_matched - number of (default box, gt box) pairs above the threshold
+        matched - (num_preds,gt) boolean matrix of the matching pairs
+        When a default box matches several gt boxes the last one wins, as in the original loop.
         """
-        Create an output pickle file of hashes (one per image) containing: names of file, y_conf, y_loc, n_matched
+        num_preds = dboxes.shape[0]
+        y_conf    = np.zeros(num_preds, dtype=np.int64)
+        y_loc     = np.zeros([num_preds,4], dtype=np.float64)
+
+        if len(bboxes) == 0:
+            return y_conf, y_loc.reshape(-1), 0, np.zeros([num_preds,0],dtype=bool)
+
+        box    = np.asarray(bboxes, dtype=np.float64).reshape(-1,4)
+        bbox   = np.concatenate([box[:,:2], box[:,:2] + box[:,2:]], axis=1)
+        matched = iou_matrix(dbox_corners, bbox) > threshold
+
+        has_match = matched.any(axis=1)
+        # index of the last matching gt box for every default box
+        gt_index  = box.shape[0] - 1 - np.argmax(matched[:,::-1], axis=1)
+        gt_index  = gt_index[has_match]
+        dbox      = dboxes[has_match]
+
+        # Note: the encoding uses box (left,top,width,height) and not bbox
+        gt_cx = box[gt_index,0] + box[gt_index,2]/2
+        gt_cy = box[gt_index,1] + box[gt_index,3]/2
+
+        y_conf[has_match] = np.asarray(labels, dtype=np.int64)[gt_index]
+        y_loc[has_match]  = np.stack([self._normalize_center(gt_cx,dbox[:,0],dbox[:,2]),
+                                      self._normalize_center(gt_cy,dbox[:,1],dbox[:,3]),
+                                      self._normalize_wh(box[gt_index,2],dbox[:,2]),
+                                      self._normalize_wh(box[gt_index,3],dbox[:,3])], axis=1)
+
+        return y_conf, y_loc.reshape(-1), int(matched.sum()), matched
+
+    def __getstate__(self):
+        # Worker processes only need the config, not the (potentially huge) dataset lists.
+        state = self.__dict__.copy()
+        state["dataset"] = None
+        return state
+
+    def _encode_images(self,items):
+        """ Match and encode a shard of images. This runs inside the worker processes.
+
+        Args:
+        items - list of (image name, gt boxes, numerical labels)
+
+        Returns:
+        A list of (image name, indices of the matched default boxes, their labels, their encoded locations,
+        n_matched, indices of the default boxes of every matched (default box, gt box) pair)
         """
-        num_preds = self.cfg.g("num_preds")
-        
-        matched_boxes = []
+        dboxes       = self.cfg.default_boxes(np.float64)
+        dbox_corners = self._default_box_corners(dboxes)
+
+        encoded = []
+        for img_info, bboxes, labels in items:
+            y_conf, y_loc, n_matched, matched = self._match_default_boxes(dboxes,dbox_corners,bboxes,labels)
+            keep = np.flatnonzero(matched.any(axis=1))
+            encoded.append((img_info, keep, y_conf[keep], y_loc.reshape(-1,4)[keep], n_matched, np.nonzero(matched.T)[1]))
+        return encoded
+
+    def _shards(self,items,num_workers):
+        """ Split items into contiguous shards, a few per worker so that slow shards even out """
+        shard_size = max(1, len(items)//(num_workers*4))
+        return [items[i:i+shard_size] for i in range(0,len(items),shard_size)]
+
+    def pre_process_and_write_images(self,img_data,dirname,name,keys=None,num_workers=None):
+        """
+        Create <dirname>/<name>.npz containing the names of the files, y_conf, y_loc and n_matched of every image
+        with matched default boxes. Only matched default boxes are stored, see targets.SparseTargets.
+
+        num_workers - number of processes to encode the images with. Defaults to preprocess_workers from the
+                      config, 0 means one per core. The output is the same for any number of workers.
+        """
+        img_names = []
+        n_matches = []
+        indptr    = [0]
+        indices   = []
+        labels    = []
+        locs      = []
 
         if keys == None:
             keys = list(img_data.keys())
 
+        if num_workers == None:
+            num_workers = self.cfg.g("preprocess_workers")
+        if num_workers == 0:
+            num_workers = multiprocessing.cpu_count()
+
+        dboxes       = self.cfg.default_boxes(np.float64)
+        dbox_corners = self._default_box_corners(dboxes)
+        # Shared between all images, these are the same for every image.
+        debug_dbox_corners = dbox_corners.tolist()
+        debug_dbox_cells   = self.cfg.default_box_cells().tolist()
+
         # TODO make this into one hash for simpler tx/rx
         debug_matched_default_boxes = {}
         debug_gt_boxes = {}
         debug_default_boxes= {}
         debug_cells = {}
         debug_images = keys
-    
-        for img_info in keys:
-            debug_matched_default_boxes[img_info] = []
-            debug_gt_boxes[img_info] = []
-            debug_default_boxes[img_info]= []
-            debug_cells[img_info] = []
-    
-            y_conf = [0] * num_preds   # We only have 1 class
-            y_loc = [0] * num_preds * 4 #
-            has_matched_boxes = False
-            n_matched = 0
-
-            for ibox, box in enumerate(img_data[img_info]['bboxes']):
-                print("BOX = ",box)
-                y_index = 0
-                bbox = [box[0],box[1],box[2]+box[0],box[3]+box[1]]
-                debug_gt_boxes[img_info].append(bbox)
-                for feat_map in self.cfg.g("feature_maps"):
-                    for feature_map_row in range(feat_map[0]):
-                        for feature_map_col in range(feat_map[1]):
-                            for default_box_scale in self.cfg.g("default_box_scales"):
-                                # width and height of a cell
-                                cell_w = self.cfg.g("image_width")/feat_map[0]
-                                cell_h = self.cfg.g("image_height")/feat_map[1]
-                            
-                                # center of cell in real coordinates (also center of dbox)
-                                # cx_real = (feature_map_row + 0.5)*cell_w
-                                # cy_real = (feature_map_col + 0.5)*cell_h
-    
-                                dbox_cx_real = (feature_map_row + 0.5 +default_box_scale[0] )*cell_w
-                                dbox_cy_real = (feature_map_col + 0.5 + default_box_scale[1])*cell_h
-    
-                                debug_cells[img_info].append([feature_map_row*cell_w, feature_map_col*cell_h,(feature_map_row+1)*cell_w, (feature_map_col+1)*cell_h])
-                                
-                                # Convert offsets into real
-                                dbox_real = self._get_default_box_real_coords(dbox_cx_real,
-                                                                        dbox_cy_real,
-                                                                        cell_w*default_box_scale[2],
-                                                                        cell_h*default_box_scale[3])
-                                debug_default_boxes[img_info].append(dbox_real)
-                                # Note: Format is different. dbox_real is left,top coords and right,bottom coords
-                                # box is left,top,width and height. 
-                                iou_t = iou(dbox_real[0],
-                                            dbox_real[1],
-                                            dbox_real[2],
-                                            dbox_real[3],
-                                            bbox[0],bbox[1],bbox[2],bbox[3])
-                                if(iou_t > 0.3):
-                                    n_matched += 1
-                                    has_matched_boxes = True
-                                    debug_matched_default_boxes[img_info].append(dbox_real)
-                                    y_conf[y_index] = self._get_label(img_data[img_info]['labels'][ibox])
-                                    # Note in this call we pass in box instead of bbox
-                                    y_loc[y_index*4 : (y_index*4+4) ] = \
-                                        self._gt_diff_defbox_normalized(dbox_cx_real,
-                                                                dbox_cy_real, cell_w*default_box_scale[2],
-                                                                cell_h*default_box_scale[3], box)
-    
-                                    print(n_matched,") feat_map=",feat_map,
-                                      " row=",feature_map_row," col=",feature_map_col," scale=",default_box_scale,
-                                    "y_loc_entry=",y_loc[y_index*4 : y_index*4+4 ],"y_loc_x-=",y_index*4,"y-loc-y",(y_index*4+4) )
-                                
-                                y_index += 1
-                            
-            if(has_matched_boxes):
-                npy_loc = np.array(y_loc,dtype=np.float32)
-                print("{ y_loc non_zero:",np.where(npy_loc !=0.0)[0])
-                print("{ y_loc non_zero values:",npy_loc[np.where(npy_loc != 0.0)[0]])
-                npy_conf = np.array(y_conf,dtype=np.float32)
-                print("{ y_conf non_zero:",np.where(npy_conf !=0.0)[0])
-                print("{ y_conf non_zero values:",npy_conf[np.where(npy_conf != 0.0)[0]])
-                print("n_matched:",n_matched)
-                print("}")
-                matched_boxes.append({
-                    "img_name":img_info,
-                    "y_loc":y_loc,
-                    "y_conf":y_conf,
-                    "n_matched":n_matched
-                })
+
+        # Labels are resolved here so the workers never need the dataset.
+        items  = [(img_info,
+                   img_data[img_info]['bboxes'],
+                   [self._get_label(lbl) for lbl in img_data[img_info]['labels']]) for img_info in keys]
+        shards = self._shards(items,num_workers)
+
+        pool = None
+        if num_workers > 1 and len(shards) > 1:
+            pool    = multiprocessing.Pool(min(num_workers,len(shards)))
+            results = pool.imap(self._encode_images, shards)
+        else:
+            results = map(self._encode_images, shards)
+
+        # imap returns the shards in order so the output does not depend on the number of workers
+        for shard in results:
+            for img_info, dbox_indices, dbox_labels, dbox_locs, n_matched, matched_indices in shard:
+                bboxes = img_data[img_info]['bboxes']
+
+                debug_gt_boxes[img_info] = [[b[0],b[1],b[2]+b[0],b[3]+b[1]] for b in bboxes]
+                debug_matched_default_boxes[img_info] = dbox_corners[matched_indices].tolist()
+                debug_default_boxes[img_info] = debug_dbox_corners if len(bboxes) else []
+                debug_cells[img_info] = debug_dbox_cells if len(bboxes) else []
+
+                if n_matched > 0:
+                    print(img_info,"n_matched:",n_matched,"y_conf non_zero:",dbox_indices[dbox_labels != 0])
+                    img_names.append(img_info)
+                    n_matches.append(n_matched)
+                    indices.append(dbox_indices)
+                    labels.append(dbox_labels)
+                    locs.append(dbox_locs)
+                    indptr.append(indptr[-1] + len(dbox_indices))
+
+        if pool != None:
+            pool.close()
+            pool.join()
+
+        matched_boxes = SparseTargets(img_names, n_matches, indptr,
+                                      np.concatenate(indices) if indices else [],
+                                      np.concatenate(labels) if labels else [],
+                                      np.concatenate(locs) if locs else np.zeros([0,4]),
+                                      self.cfg.g("num_preds"))
 
         # subprocess.call("mkdir -p {}".format(dirname),shell=True)
-        pickle.dump(matched_boxes,open(dirname+"/"+name+".pkl","wb"))
+        matched_boxes.save(dirname+"/"+name+".npz")
     
         # everything starting with debug_ is for debugging!
         return matched_boxes, debug_gt_boxes, debug_matched_default_boxes, debug_default_boxes, debug_cells, debug_images
 
     
 
-    def create_data_set(self,n):
+    def create_data_set(self,n,seed=None,num_workers=None):
         """ Create a data set with n test images, n/5 validation images and n/5 from test set.
         Args:
         n - Number of test images
-        directory - Name of directory to create and store the splits
+        seed - seed for sampling the images, defaults to random_seed from the config
+        num_workers - number of processes used to encode the images, see pre_process_and_write_images
 
         Returns:
         A dictionary of the form:
@@ -206,20 +247,24 @@ class SSDPreProcess:
         # test from a separate set
         total_test  = n
     
+        if seed == None:
+            seed = self.cfg.g("random_seed")
+        rng = random.Random(seed)
+
         # TODO We should check if we are trying to sample more that whats available
-        all_train   = dict((a,glist["train"][a]) for a in random.sample(list(glist["train"].keys()),total_train))
+        all_train   = dict((a,glist["train"][a]) for a in rng.sample(list(glist["train"].keys()),total_train))
     
         train_items = list(all_train.items())
     
         train       = dict(train_items[ 0 : n ])
         val         = dict(train_items[ n : (n + max(n//5,1))])
-        test        = dict((a,glist["test"][a]) for a in random.sample(list(glist["test"].keys()),total_test))
+        test        = dict((a,glist["test"][a]) for a in rng.sample(list(glist["test"].keys()),total_test))
 
         print(train_items)
         
-        self.pre_process_and_write_images(train,self.cfg.g("dirname"),"train")
-        self.pre_process_and_write_images(val,self.cfg.g("dirname"),"val")
-        self.pre_process_and_write_images(test,self.cfg.g("dirname"),"test")
+        self.pre_process_and_write_images(train,self.cfg.g("dirname"),"train",num_workers=num_workers)
+        self.pre_process_and_write_images(val,self.cfg.g("dirname"),"val",num_workers=num_workers)
+        self.pre_process_and_write_images(test,self.cfg.g("dirname"),"test",num_workers=num_workers)
     
         print("test len",len(test))
         print("train len",len(train))
@@ -0,0 +1,121 @@
+import os
+import pickle
+import numpy as np
+
+
+class SparseTargets:
+    """
+    Training targets (y_conf, y_loc, n_matched) of a data set. Only the matched default boxes of
+    each image are stored, in CSR form: the default boxes of image i are
+    indices[indptr[i]:indptr[i+1]] with labels and encoded locations at the same positions.
+    """
+
+    def __init__(self,img_names,n_matched,indptr,indices,labels,loc,num_preds):
+        self.img_names = np.asarray(img_names, dtype=str)
+        self.n_matched = np.asarray(n_matched, dtype=np.int32)
+        self.indptr    = np.asarray(indptr, dtype=np.int64)
+        self.indices   = np.asarray(indices, dtype=np.int32)
+        self.labels    = np.asarray(labels, dtype=np.int32)
+        self.loc       = np.asarray(loc, dtype=np.float32).reshape(-1,4)
+        self.num_preds = int(num_preds)
+
+    def __len__(self):
+        return len(self.img_names)
+
+    @staticmethod
+    def from_dense(img_names,n_matched,y_confs,y_locs,num_preds):
+        """ Build the targets from per image dense y_conf and y_loc arrays. A default box is kept
+        if it has a label or an encoded location. """
+        indptr  = [0]
+        indices = []
+        labels  = []
+        loc     = []
+        for y_conf, y_loc in zip(y_confs,y_locs):
+            y_conf = np.asarray(y_conf)
+            y_loc  = np.asarray(y_loc, dtype=np.float64).reshape(-1,4)
+            keep   = np.flatnonzero((y_conf != 0) | (y_loc != 0).any(axis=1))
+            indices.append(keep)
+            labels.append(y_conf[keep])
+            loc.append(y_loc[keep])
+            indptr.append(indptr[-1] + len(keep))
+
+        return SparseTargets(img_names, n_matched, indptr,
+                             np.concatenate(indices) if indices else [],
+                             np.concatenate(labels) if labels else [],
+                             np.concatenate(loc) if loc else np.zeros([0,4]),
+                             num_preds)
+
+    def save(self,fname):
+        np.savez(fname,
+                 img_names=self.img_names,
+                 n_matched=self.n_matched,
+                 indptr=self.indptr,
+                 indices=self.indices,
+                 labels=self.labels,
+                 loc=self.loc,
+                 num_preds=self.num_preds)
+
+    @staticmethod
+    def load(dirname,name,num_preds=None):
+        """ Load <dirname>/<name>.npz, or convert an old style <dirname>/<name>.pkl list of records. """
+        fname = dirname+"/"+name+".npz"
+        if os.path.exists(fname):
+            f = np.load(fname)
+            return SparseTargets(f["img_names"], f["n_matched"], f["indptr"], f["indices"],
+                                 f["labels"], f["loc"], f["num_preds"])
+
+        records = pickle.load(open(dirname+"/"+name+".pkl","rb"))
+        if num_preds == None:
+            num_preds = len(records[0]["y_conf"]) if records else 0
+        return SparseTargets.from_dense([m["img_name"] for m in records],
+                                        [m["n_matched"] for m in records],
+                                        [m["y_conf"] for m in records],
+                                        [m["y_loc"] for m in records],
+                                        num_preds)
+
+    def take(self,rows):
+        """ The targets of the images at positions rows, in that order """
+        rows    = np.asarray(rows, dtype=np.int64)
+        starts  = self.indptr[rows]
+        counts  = self.indptr[rows+1] - starts
+        indptr  = np.concatenate([[0],np.cumsum(counts)])
+        # positions of the matched boxes of the chosen images
+        pos     = np.repeat(starts - indptr[:-1], counts) + np.arange(indptr[-1])
+        return SparseTargets(self.img_names[rows], self.n_matched[rows], indptr,
+                             self.indices[pos], self.labels[pos], self.loc[pos], self.num_preds)
+
+    def shard(self,index,count):
+        """ Every count-th image starting with image index """
+        return self.take(np.arange(index,len(self),count))
+
+    def densify(self,start,end,y_conf,y_loc,n_matched=None):
+        """ Write the targets of images start..end into the (zeroed) batch arrays.
+        Args:
+        y_conf - (batch_size,num_preds) array
+        y_loc - (batch_size,num_preds*4) array
+        n_matched - optional (batch_size,1) array
+
+        Returns the number of images written, less than end-start at the end of the data set.
+        """
+        end   = min(end,len(self))
+        count = max(end - start,0)
+        if count == 0:
+            return 0
+
+        lo, hi = self.indptr[start], self.indptr[end]
+        rows   = np.repeat(np.arange(count), np.diff(self.indptr[start:end+1]))
+        cols   = self.indices[lo:hi]
+
+        y_conf[rows,cols] = self.labels[lo:hi]
+        y_loc.reshape(y_loc.shape[0],-1,4)[rows,cols] = self.loc[lo:hi]
+        if n_matched is not None:
+            n_matched[:count,0] = self.n_matched[start:end]
+
+        return count
+
+    def dense(self,i):
+        """ y_conf and y_loc of image i as dense arrays """
+        y_conf = np.zeros([1,self.num_preds], dtype=np.int32)
+        y_loc  = np.zeros([1,self.num_preds*4], dtype=np.float32)
+        self.densify(i,i+1,y_conf,y_loc)
+        return y_conf[0], y_loc[0]
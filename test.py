@@ -1,6 +1,7 @@
 import pickle
 import unittest
 from inference import Inference
+from targets import SparseTargets
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 import numpy as np
@@ -20,10 +21,11 @@ class TestPreProcess(unittest.TestCase):
         y_probs = list(y_pred_conf)
         
         # Read the values from the file
-        p = pickle.load(open("t1/train.pkl","rb"))
-        image_name = p[0]["img_name"]
-        y_pred_loc = p[0]["y_loc"]
-        y_pred_conf = p[0]["y_conf"]
+        p = SparseTargets.load("t1","train")
+        image_name = p.img_names[0]
+        y_pred_conf, y_pred_loc = p.dense(0)
+        y_pred_loc = [y_pred_loc]
+        y_pred_conf = [y_pred_conf]
 
         img = mpimg.imread("/home/ubuntu/tensorflow_ssd/data/images/"+image_name)
 
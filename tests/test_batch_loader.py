@@ -0,0 +1,49 @@
+import os
+import signal
+import unittest
+import numpy as np
+
+from batch_loader import BatchLoader
+
+
+def fill_batch(name,start,end,arrays):
+    if name == "broken":
+        raise ValueError("broken batch")
+    if name == "killed":
+        # as the OOM killer would
+        os.kill(os.getpid(), signal.SIGKILL)
+    arrays[0][:end-start,0] = np.arange(start,end)
+
+
+class TestBatchLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.loader = BatchLoader(fill_batch,[([4,1],np.int32)],num_workers=3,prefetch_depth=2,poll_secs=0.1)
+
+    def tearDown(self):
+        self.loader.close()
+
+    def test_batches_arrive_in_order(self):
+        ranges = [(s,s+4) for s in range(0,40,4)]
+        for epoch in range(2):
+            starts = [int(b[0][0,0]) for b in self.loader.batches("train",ranges,4)]
+            self.assertEqual(starts, list(range(0,40,4)))
+
+    def test_smaller_batches_and_early_stop(self):
+        for i,b in enumerate(self.loader.batches("train",[(s,s+4) for s in range(0,40,4)],4)):
+            if i == 1:
+                break
+        batches = [b[0][:,0].tolist() for b in self.loader.batches("val",[(0,2),(2,3)],2)]
+        self.assertEqual(batches, [[0,1],[2,0]])
+
+    def test_worker_errors_are_raised(self):
+        with self.assertRaises(RuntimeError):
+            list(self.loader.batches("broken",[(0,4)],4))
+
+    def test_dead_workers_are_raised(self):
+        with self.assertRaisesRegex(RuntimeError, "died"):
+            list(self.loader.batches("killed",[(0,4)],4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import sys
+import struct
+import pickle
+import shutil
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),"tools"))
+from converter import SeqReader, convert, merge_annotations, read_seq
+
+
+def write_seq(path, frames, trailer=16):
+    """ A .seq file with a 1024 byte header, and each frame as its size, its bytes and a trailer """
+    header  = b"\0"*4 + b"Norpix seq".ljust(24, b"\0") + struct.pack("@ii", 3, 1024) + b"\0"*512
+    # w, h, bdepth, bitdepth_real, size, format (102 = jpg), num_frames, 0, true_size
+    header += struct.pack("@9i", 640, 480, 8, 8, 0, 102, len(frames), 0, 0)
+    header += struct.pack("@d", 30.0)
+    header  = header.ljust(1024, b"\0")
+    with open(path, "wb") as f:
+        f.write(header)
+        for frame in frames:
+            f.write(struct.pack("@I", len(frame) + 4))
+            f.write(frame)
+            f.write(b"\0"*trailer)
+
+
+class TestSeq(unittest.TestCase):
+
+    def setUp(self):
+        self.dir    = tempfile.mkdtemp()
+        self.path   = os.path.join(self.dir, "V000.seq")
+        self.frames = [bytes(bytearray([i+1])*(100 + 37*i)) for i in range(5)]
+        write_seq(self.path, self.frames)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read_seq(self):
+        self.assertEqual(read_seq(self.path), self.frames)
+
+
+class TestSeqReader(unittest.TestCase):
+
+    def setUp(self):
+        self.dir    = tempfile.mkdtemp()
+        self.path   = os.path.join(self.dir, "V000.seq")
+        self.frames = [bytes(bytearray([i+1])*(100 + 37*i)) for i in range(5)]
+        write_seq(self.path, self.frames)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_random_access(self):
+        with SeqReader(self.path) as reader:
+            self.assertEqual(len(reader), 5)
+            self.assertIsInstance(reader.frame(3), memoryview)
+            self.assertEqual(reader.frame(3).tobytes(), self.frames[3])
+            self.assertEqual(reader.frame(-1).tobytes(), self.frames[-1])
+            self.assertEqual([f.tobytes() for f in reader], self.frames)
+
+    def test_index_is_saved_and_reused(self):
+        with SeqReader(self.path, persist_index=True) as reader:
+            index = reader.index
+        self.assertTrue(os.path.exists(self.path + ".idx.npy"))
+
+        with SeqReader(self.path) as reader:
+            self.assertIsNotNone(reader._load_index())
+            self.assertTrue((reader.index == index).all())
+
+    def test_stale_index_is_rebuilt(self):
+        SeqReader(self.path, persist_index=True).close()
+        frames = self.frames[::-1]
+        write_seq(self.path, frames)
+        # the index is older than the rewritten file
+        mtime = os.path.getmtime(self.path + ".idx.npy")
+        os.utime(self.path, (mtime + 10, mtime + 10))
+
+        with SeqReader(self.path) as reader:
+            self.assertEqual([f.tobytes() for f in reader], frames)
+
+    def test_without_persisting(self):
+        with SeqReader(self.path) as reader:
+            self.assertEqual(reader.frame(0).tobytes(), self.frames[0])
+        self.assertFalse(os.path.exists(self.path + ".idx.npy"))
+
+
+class TestConvert(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.frames = {}
+        for set_id in [0, 1]:
+            os.makedirs(os.path.join(self.dir, "set{:02}".format(set_id)))
+            os.makedirs(os.path.join(self.dir, "annotations", "set{:02}".format(set_id)))
+            for seq in ["V000", "V001"]:
+                frames = [bytes(bytearray([set_id*10 + i + 1])*(50 + i)) for i in range(3)]
+                write_seq(os.path.join(self.dir, "set{:02}".format(set_id), seq + ".seq"), frames)
+                self.frames[(set_id, seq)] = frames
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_convert_and_resume(self):
+        convert(self.dir, "train", [0, 1], workers=2)
+        img_path = os.path.join(self.dir, "trainimages")
+        self.assertEqual(len(os.listdir(img_path)), 12)
+        with open(os.path.join(img_path, "img01010002.jpg"), "rb") as f:
+            self.assertEqual(f.read(), self.frames[(1, "V001")][2])
+        self.assertTrue(os.path.exists(os.path.join(self.dir, "trainannotations.pkl")))
+
+        # a done sequence is not written again
+        os.remove(os.path.join(img_path, "img00000000.jpg"))
+        convert(self.dir, "train", [0, 1], workers=2)
+        self.assertFalse(os.path.exists(os.path.join(img_path, "img00000000.jpg")))
+
+    def test_merge_annotations(self):
+        shard_dir = os.path.join(self.dir, "shards")
+        os.makedirs(shard_dir)
+        for name in ["set00_V000", "set00_V001", "set01_V000"]:
+            with open(os.path.join(shard_dir, name + ".pkl"), "wb") as f:
+                pickle.dump({"name": name}, f)
+
+        anno_path = os.path.join(self.dir, "annotations.pkl")
+        merge_annotations(shard_dir, [0], anno_path)
+        with open(anno_path, "rb") as f:
+            anno = pickle.load(f)
+        self.assertEqual(sorted(anno.keys()), ["00"])
+        self.assertEqual(anno["00"]["01"], {"name": "set00_V001"})
@@ -0,0 +1,46 @@
+import unittest
+import numpy as np
+
+from utils import decode_boxes
+from nms import batched_nms
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+
+@unittest.skipIf(tf is None, "needs TensorFlow")
+class TestDetectionOpsParity(unittest.TestCase):
+
+    def test_same_detections_as_host_nms(self):
+        from detection_ops import detection_ops
+        rng         = np.random.RandomState(0)
+        num_preds   = 400
+        num_classes = 4
+        # clustered default boxes so that boxes of different classes overlap
+        dboxes      = np.column_stack([rng.uniform(100,140,num_preds), rng.uniform(100,140,num_preds),
+                                       rng.uniform(30,40,num_preds), rng.uniform(30,40,num_preds)]).astype(np.float32)
+        loc         = (rng.randn(2,num_preds*4)*0.1).astype(np.float32)
+        logits      = (rng.randn(2,num_preds*num_classes)*3).astype(np.float32)
+
+        with tf.Graph().as_default(), tf.Session() as sess:
+            boxes, scores, classes, count = sess.run(detection_ops(tf.constant(loc),tf.constant(logits),dboxes,num_classes,
+                                                                   0.5,0.3,200,50))
+
+        probs    = np.exp(logits.reshape(2,num_preds,num_classes))
+        probs   /= probs.sum(axis=2,keepdims=True)
+        found    = decode_boxes(loc,probs.argmax(axis=2),probs.max(axis=2),dboxes,0.5)
+        kept     = batched_nms(found,0.3,200,50)
+        for i,((h_boxes,_,h_classes),(keep,h_scores)) in enumerate(zip(found,kept)):
+            n = count[i]
+            self.assertEqual(n, len(keep))
+            # several classes survive in the same place
+            self.assertGreater(len(set(h_classes[keep])), 1)
+            np.testing.assert_array_equal(classes[i,:n], h_classes[keep])
+            np.testing.assert_allclose(scores[i,:n], h_scores, rtol=1e-5)
+            np.testing.assert_allclose(boxes[i,:n], h_boxes[keep], rtol=1e-4, atol=1e-3)
+
+
+if __name__ == "__main__":
+    unittest.main()
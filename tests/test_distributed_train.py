@@ -0,0 +1,38 @@
+import unittest
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+
+@unittest.skipIf(tf is None, "needs TensorFlow")
+class TestGradientAccumulatorPlacement(unittest.TestCase):
+
+    def devices(self, local_device):
+        """ Devices of a variable and of its gradient accumulators, built the way a replica builds them """
+        from train import SSDTrain
+        cluster = tf.train.ClusterSpec({"ps": ["localhost:2222"],
+                                        "worker": ["localhost:2223", "localhost:2224"]})
+        trainer = SSDTrain.__new__(SSDTrain)
+        trainer._local_device = local_device
+        with tf.Graph().as_default():
+            with tf.device(tf.train.replica_device_setter(worker_device="/job:worker/task:1", cluster=cluster)):
+                w    = tf.Variable(tf.ones([3]), name="w")
+                loss = tf.reduce_sum(w*w)
+                trainer._accumulate_gradients(tf.train.GradientDescentOptimizer(0.1), loss, [],
+                                              tf.train.get_or_create_global_step())
+            return w.device, [v.device for v in tf.local_variables()]
+
+    def test_accumulators_stay_on_the_replica(self):
+        w_device, accumulator_devices = self.devices("/job:worker/task:1")
+        self.assertIn("/job:ps", w_device)
+        self.assertEqual(len(accumulator_devices), 1)
+        for device in accumulator_devices:
+            self.assertIn("/job:worker/task:1", device)
+
+    def test_replica_device_setter_alone_shares_them(self):
+        # what happened before: every replica added into the same accumulators on the parameter server
+        _, accumulator_devices = self.devices(None)
+        for device in accumulator_devices:
+            self.assertIn("/job:ps", device)
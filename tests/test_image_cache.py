@@ -0,0 +1,35 @@
+import unittest
+import numpy as np
+
+from image_cache import ImageCache
+
+
+class TestImageCache(unittest.TestCase):
+
+    def test_lru_eviction_within_budget(self):
+        cache = ImageCache(max_bytes=300)
+        loads = []
+        def loader(key):
+            def load():
+                loads.append(key)
+                return np.zeros(100, dtype=np.uint8)
+            return load
+
+        for key in ["a","b","c","a","d","b"]:
+            cache.get(key, loader(key))
+
+        # "b" was evicted by "d" because "a" had been used more recently
+        self.assertEqual(loads, ["a","b","c","d","b"])
+        stats = cache.stats()
+        self.assertEqual((stats["hits"],stats["misses"],stats["evictions"]), (1,5,2))
+        self.assertLessEqual(stats["bytes"], 300)
+
+    def test_image_larger_than_budget_is_not_cached(self):
+        cache = ImageCache(max_bytes=10)
+        img = cache.get("big", lambda: np.zeros(100, dtype=np.uint8))
+        self.assertEqual(img.shape, (100,))
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
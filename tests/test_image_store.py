@@ -0,0 +1,38 @@
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import cv2 as cv
+
+from image_store import ImageStore, load_image
+
+
+class TestImageStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.names = []
+        for i in range(3):
+            img = (rng.rand(48,64,3)*255).astype(np.uint8)
+            cv.imwrite("{}/img{}.png".format(self.dirname,i), img)
+            self.names.append("img{}.png".format(i))
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_store_matches_decoded_images(self):
+        store = ImageStore.build(self.dirname+"/images.u8", self.names, self.dirname, 24, 32, 3)
+        self.assertEqual(len(store), 3)
+        for name in self.names:
+            img = store.get(name)
+            self.assertEqual(img.shape, (24,32,3))
+            self.assertFalse(img.flags.writeable)
+            np.testing.assert_array_equal(img, load_image(self.dirname+"/"+name, 24, 32))
+
+        # A second process opens the same file
+        np.testing.assert_array_equal(ImageStore(self.dirname+"/images.u8").get("img1.png"), store.get("img1.png"))
+
+
+if __name__ == "__main__":
+    unittest.main()
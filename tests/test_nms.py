@@ -0,0 +1,87 @@
+import unittest
+import numpy as np
+
+from nms import nms, multiclass_nms, batched_nms, decode_and_nms
+from utils import iou_matrix, decode_boxes
+
+
+def reference_nms(boxes, scores, iou_threshold):
+    """ Plain greedy nms over a full iou matrix """
+    ious    = iou_matrix(boxes, boxes)
+    keep    = []
+    for i in np.argsort(-scores, kind="stable"):
+        if all(ious[i,j] <= iou_threshold for j in keep):
+            keep.append(i)
+    return keep
+
+
+def random_boxes(rng, n):
+    xy = rng.uniform(0, 600, (n,2))
+    wh = rng.uniform(5, 80, (n,2))
+    return np.hstack([xy, xy+wh]).astype(np.float32), rng.uniform(0, 1, n).astype(np.float32)
+
+
+class TestNMS(unittest.TestCase):
+
+    def test_matches_reference(self):
+        rng = np.random.RandomState(0)
+        for n in [0, 1, 50, 400]:
+            boxes, scores = random_boxes(rng, n)
+            np.testing.assert_array_equal(nms(boxes, scores, 0.3), reference_nms(boxes, scores, 0.3))
+
+    def test_crowded_boxes_and_block_sizes(self):
+        rng = np.random.RandomState(3)
+        # chains of overlapping boxes, so that boxes suppressed in a block come back within it
+        xy  = rng.uniform(0, 60, (600,2)) + rng.randint(0, 4, (600,1))*100
+        wh  = rng.uniform(20, 60, (600,2))
+        boxes, scores = np.hstack([xy, xy+wh]).astype(np.float32), rng.uniform(0, 1, 600).astype(np.float32)
+        for block_size in [1, 7, 64, 256]:
+            for threshold in [0.1, 0.3, 0.6]:
+                np.testing.assert_array_equal(nms(boxes, scores, threshold, block_size=block_size),
+                                              reference_nms(boxes, scores, threshold))
+
+    def test_score_order_and_caps(self):
+        boxes  = np.array([[0,0,10,10],[1,1,11,11],[50,50,60,60],[100,100,110,110]], dtype=np.float32)
+        scores = np.array([0.6, 0.9, 0.5, 0.7], dtype=np.float32)
+        np.testing.assert_array_equal(nms(boxes, scores, 0.3), [1,3,2])
+        np.testing.assert_array_equal(nms(boxes, scores, 0.3, max_detections=2), [1,3])
+
+        keep, kept_scores = multiclass_nms(boxes, scores, [1,1,1,1], 0.3, pre_nms_top_k=2)
+        np.testing.assert_array_equal(keep, [1,3])
+        np.testing.assert_allclose(kept_scores, [0.9,0.7])
+
+    def test_classes_do_not_suppress_each_other(self):
+        boxes  = np.array([[0,0,10,10],[1,1,11,11],[0,0,10,10]], dtype=np.float32)
+        scores = np.array([0.9, 0.8, 0.7], dtype=np.float32)
+        keep, _ = multiclass_nms(boxes, scores, [1,2,1], 0.3)
+        np.testing.assert_array_equal(keep, [0,1])
+
+    def test_batch(self):
+        rng = np.random.RandomState(1)
+        detections = [random_boxes(rng, n) + (np.ones(n, dtype=np.int32),) for n in [30, 0, 10]]
+        results = batched_nms(detections, 0.3, max_detections=5)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(results[1][0]), 0)
+        for (boxes, scores, _), (keep, kept_scores) in zip(detections, results):
+            np.testing.assert_array_equal(keep, reference_nms(boxes, scores, 0.3)[:5])
+            np.testing.assert_array_equal(kept_scores, scores[keep])
+
+    def test_decode_and_nms(self):
+        rng           = np.random.RandomState(2)
+        default_boxes = np.concatenate([rng.uniform(50, 200, (40, 2)), rng.uniform(20, 60, (40, 2))], axis=1)
+        loc           = rng.normal(0, 0.1, (2, 40*4)).astype(np.float32)
+        conf          = rng.randint(0, 3, (2, 40))
+        probs         = rng.uniform(0, 1, (2, 40)).astype(np.float32)
+
+        results = decode_and_nms(loc, conf, probs, default_boxes, 0.3, 0.4, max_detections=6)
+        self.assertEqual(len(results), 2)
+        for (boxes, scores, classes), (kept_boxes, kept_scores, kept_classes) in \
+                zip(decode_boxes(loc, conf, probs, default_boxes, 0.3), results):
+            keep, _ = multiclass_nms(boxes, scores, classes, 0.4, max_detections=6)
+            np.testing.assert_array_equal(kept_boxes, boxes[keep])
+            np.testing.assert_array_equal(kept_scores, scores[keep])
+            np.testing.assert_array_equal(kept_classes, classes[keep])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import shutil
+import unittest
+import yaml
+import numpy as np
+
+from test_ssd_pre_process import make_config_dir
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+
+@unittest.skipIf(tf is None, "needs TensorFlow")
+class TestPredictorEmptyInput(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = make_config_dir()
+        cfg = yaml.safe_load(open(self.dirname+"/ssd_config.yaml"))
+        cfg.update({"n_channels": 3, "num_classes": 2, "pred_conf_threshold": 0.8})
+        yaml.dump(cfg, open(self.dirname+"/ssd_config.yaml","w"))
+
+        # a stand-in for an exported net, with its input and output names
+        num_preds = 200
+        with tf.Graph().as_default() as graph:
+            x     = tf.placeholder(tf.float32, (None,480,640,3), name="x")
+            tf.placeholder_with_default(False, [], name="phase")
+            mean  = tf.reshape(tf.reduce_mean(x, [1,2,3]), [-1,1])
+            tf.identity(mean*tf.zeros([1,num_preds*4]), name="y_predict_loc")
+            tf.identity(mean*tf.zeros([1,num_preds*2]), name="y_predict_conf")
+            tf.train.write_graph(graph.as_graph_def(), self.dirname, "model.pb", as_text=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_empty_input(self):
+        from predictor import Predictor
+        for in_graph_nms in [False, True]:
+            with Predictor(self.dirname, "model.pb", in_graph_nms=in_graph_nms) as predictor:
+                conf, loc, probs = predictor.predict_batch([])
+                self.assertEqual(conf.shape, (0,200))
+                self.assertEqual(loc.shape, (0,800))
+                self.assertEqual(probs.shape, (0,200))
+                self.assertEqual(predictor.detect_batch([]), [])
+                self.assertEqual(len(predictor.detect_batch([np.zeros((480,640,3),dtype=np.uint8)])), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
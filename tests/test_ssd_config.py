@@ -0,0 +1,32 @@
+import shutil
+import unittest
+import yaml
+
+from ssd_config import SSDConfig, TUNED_PROFILE
+from test_ssd_pre_process import make_config_dir
+
+
+class TestTunedProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = make_config_dir()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_profile_between_config_and_defaults(self):
+        cfg = yaml.safe_load(open(self.dirname+"/ssd_config.yaml"))
+        cfg.update({"inter_op_threads": 3, "prefetch_depth": None})
+        yaml.dump(cfg, open(self.dirname+"/ssd_config.yaml","w"))
+        yaml.dump({"intra_op_threads": 8, "inter_op_threads": 1, "prefetch_depth": 4},
+                  open(self.dirname+"/"+TUNED_PROFILE,"w"))
+
+        cfg = SSDConfig(self.dirname)
+        self.assertEqual(cfg.g("intra_op_threads"), 8)
+        # the configuration file wins, empty settings do not count
+        self.assertEqual(cfg.g("inter_op_threads"), 3)
+        self.assertEqual(cfg.g("prefetch_depth"), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import unittest
+import yaml
+import numpy as np
+
+from ssd_config import SSDConfig
+from ssd_pre_process import SSDPreProcess
+from utils import iou, iou_matrix
+
+
+def make_config_dir():
+    dirname = tempfile.mkdtemp()
+    yaml.dump({"image_width": 640, "image_height": 480,
+               "feature_maps": [[5,4],[10,8]],
+               "default_box_scales": [[0.0,0.0,0.9,1.5],[0.2,-0.2,0.9,0.8]]},
+              open(dirname+"/ssd_config.yaml","w"))
+    return dirname
+
+
+class FakeDataset:
+    def get_label_num(self,lbl):
+        return 1 if lbl == "person" else 0
+
+
+class TestMatchDefaultBoxes(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = make_config_dir()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def make_pre_process(self):
+        pre = SSDPreProcess.__new__(SSDPreProcess)
+        pre.cfg = SSDConfig(self.dirname)
+        pre.dataset = FakeDataset()
+        return pre
+
+    def test_iou_matrix_matches_iou(self):
+        a = [[1,2,3,4],[2,1,4,3],[404.0,140.0,476.0,260.0]]
+        b = [[2,1,4,3],[4,2,6,4],[428.90,136.16,485.20,277.99]]
+        m = iou_matrix(a,b)
+        for i in range(3):
+            for j in range(3):
+                self.assertAlmostEqual(m[i,j], iou(*(a[i]+b[j])))
+
+    def test_default_box_order(self):
+        cfg    = SSDConfig(self.dirname)
+        dboxes = cfg.default_boxes()
+        self.assertEqual(dboxes.shape, (cfg.g("num_preds"),4))
+        self.assertEqual(dboxes.dtype, np.float32)
+        self.assertEqual(list(cfg.feature_map_offsets()), [0, 40, 200])
+        # feature map 0, row 1, col 2, scale 1
+        cell_w, cell_h = 640/5, 480/4
+        np.testing.assert_allclose(dboxes[(1*4 + 2)*2 + 1],
+                                   [(1.7)*cell_w, (2.3)*cell_h, 0.9*cell_w, 0.8*cell_h], rtol=1e-6)
+        # feature map 1, row 9, col 7, scale 0
+        cell_w, cell_h = 640/10, 480/8
+        np.testing.assert_allclose(dboxes[40 + (9*8 + 7)*2],
+                                   [9.5*cell_w, 7.5*cell_h, 0.9*cell_w, 1.5*cell_h], rtol=1e-6)
+
+    def test_default_box_cells(self):
+        cfg    = SSDConfig(self.dirname)
+        cells  = cfg.default_box_cells()
+        dboxes = cfg.default_boxes()
+        self.assertEqual(cells.shape, dboxes.shape)
+        # feature map 1, row 9, col 7, scale 1
+        cell_w, cell_h = 640/10, 480/8
+        np.testing.assert_allclose(cells[40 + (9*8 + 7)*2 + 1], [9*cell_w, 7*cell_h, 10*cell_w, 8*cell_h], rtol=1e-6)
+        # the centers of scale 0 boxes (no offset) are the centers of their cells
+        np.testing.assert_allclose((cells[::2,:2] + cells[::2,2:])/2, dboxes[::2,:2], rtol=1e-5)
+
+    def test_default_boxes_are_cached(self):
+        boxes = SSDConfig(self.dirname).default_boxes()
+        cached = [f for f in os.listdir(self.dirname) if f.startswith("default_boxes-")]
+        self.assertEqual(len(cached), 1)
+        np.testing.assert_array_equal(SSDConfig(self.dirname).default_boxes(), boxes)
+
+    def test_default_boxes_float64(self):
+        cfg    = SSDConfig(self.dirname)
+        dboxes = cfg.default_boxes(np.float64)
+        self.assertEqual(dboxes.dtype, np.float64)
+        # feature map 0, row 1, col 2, scale 1, without float32 rounding
+        cell_w, cell_h = 640/5, 480/4
+        self.assertEqual(list(dboxes[(1*4 + 2)*2 + 1]), [(1 + 0.5 + 0.2)*cell_w, (2 + 0.5 - 0.2)*cell_h, cell_w*0.9, cell_h*0.8])
+        np.testing.assert_array_equal(cfg.default_boxes(), dboxes.astype(np.float32))
+        # and the same after a reload from the cache
+        np.testing.assert_array_equal(SSDConfig(self.dirname).default_boxes(np.float64), dboxes)
+
+    def test_matched_box_is_encoded(self):
+        pre    = self.make_pre_process()
+        dboxes = pre.cfg.default_boxes(np.float64)
+        # A ground truth box that is exactly default box 7
+        cx, cy, w, h = dboxes[7]
+        gt = [cx - w/2, cy - h/2, w, h]
+        y_conf, y_loc, n_matched, matched = pre._match_default_boxes(dboxes, pre._default_box_corners(dboxes), [gt], [1])
+
+        self.assertEqual(y_conf[7], 1)
+        self.assertEqual(n_matched, matched.sum())
+        self.assertTrue(n_matched >= 1)
+        np.testing.assert_allclose(y_loc[7*4:7*4+4], [0,0,0,0], atol=1e-12)
+        self.assertEqual(np.count_nonzero(y_conf), matched.any(axis=1).sum())
+
+    def test_no_ground_truth(self):
+        pre    = self.make_pre_process()
+        dboxes = pre.cfg.default_boxes(np.float64)
+        y_conf, y_loc, n_matched, _ = pre._match_default_boxes(dboxes, pre._default_box_corners(dboxes), [], [])
+        self.assertEqual(n_matched, 0)
+        self.assertFalse(y_conf.any() or y_loc.any())
+
+
+if __name__ == "__main__":
+    unittest.main()
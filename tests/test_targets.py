@@ -0,0 +1,69 @@
+import pickle
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from targets import SparseTargets
+
+
+def make_records(num_preds, n):
+    rng = np.random.RandomState(0)
+    records = []
+    for i in range(n):
+        y_conf = np.zeros(num_preds, dtype=np.int64)
+        y_loc  = np.zeros(num_preds*4)
+        matched = rng.choice(num_preds, 3, replace=False)
+        y_conf[matched[:2]] = 1
+        y_loc.reshape(-1,4)[matched] = rng.randn(3,4)
+        records.append({"img_name":"img{}.jpg".format(i), "y_conf":y_conf.tolist(),
+                        "y_loc":y_loc.tolist(), "n_matched":3})
+    return records
+
+
+class TestSparseTargets(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_densify_matches_records(self):
+        records = make_records(50, 7)
+        pickle.dump(records, open(self.dirname+"/train.pkl","wb"))
+        SparseTargets.load(self.dirname,"train").save(self.dirname+"/train.npz")
+        targets = SparseTargets.load(self.dirname,"train")
+
+        self.assertEqual(len(targets), 7)
+        self.assertEqual(targets.indices.shape[0], 7*3)
+
+        y_conf    = np.zeros([4,50])
+        y_loc     = np.zeros([4,200])
+        n_matched = np.zeros([4,1])
+        # the last batch is not full
+        count = targets.densify(4,8,y_conf,y_loc,n_matched)
+        self.assertEqual(count, 3)
+        for i in range(3):
+            np.testing.assert_array_equal(y_conf[i], records[4+i]["y_conf"])
+            np.testing.assert_allclose(y_loc[i], records[4+i]["y_loc"], rtol=1e-6)
+            self.assertEqual(targets.img_names[4+i], records[4+i]["img_name"])
+        self.assertFalse(y_conf[3].any() or y_loc[3].any())
+        np.testing.assert_array_equal(n_matched[:,0], [3,3,3,0])
+
+    def test_shard(self):
+        records = make_records(50, 7)
+        targets = SparseTargets.from_dense([m["img_name"] for m in records], [m["n_matched"] for m in records],
+                                           [m["y_conf"] for m in records], [m["y_loc"] for m in records], 50)
+
+        shards = [targets.shard(i,3) for i in range(3)]
+        self.assertEqual([len(s) for s in shards], [3,2,2])
+        self.assertEqual(sorted(sum([list(s.img_names) for s in shards],[])), sorted(targets.img_names))
+        for i in range(len(shards[1])):
+            y_conf, y_loc = shards[1].dense(i)
+            np.testing.assert_array_equal(y_conf, records[1+3*i]["y_conf"])
+            np.testing.assert_allclose(y_loc, records[1+3*i]["y_loc"], rtol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+import numpy as np
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+
+class Config:
+    def __init__(self, **values):
+        self.values = values
+
+    def g(self, var):
+        return self.values[var]
+
+
+@unittest.skipIf(tf is None, "needs TensorFlow")
+class TestHardNegativeMask(unittest.TestCase):
+
+    def mask(self, loss, y_conf, num_matched, neg_pos_ratio):
+        from train import SSDTrain
+        trainer     = SSDTrain.__new__(SSDTrain)
+        trainer.cfg = Config(num_preds=len(loss[0]), neg_pos_ratio=neg_pos_ratio)
+        with tf.Graph().as_default(), tf.Session() as sess:
+            mask = trainer._hard_negative_mask(tf.constant(loss, dtype=tf.float32), tf.constant(y_conf, dtype=tf.int32),
+                                               tf.constant(num_matched, dtype=tf.int32))
+            return sess.run(mask)
+
+    def test_hardest_negatives_and_positives(self):
+        loss   = [[0.1, 5.0, 0.3, 2.0, 0.2, 9.0]]
+        y_conf = [[0, 0, 0, 0, 0, 1]]
+        np.testing.assert_array_equal(self.mask(loss, y_conf, [[1]], 2), [[0, 1, 0, 1, 0, 1]])
+
+    def test_ties_keep_exactly_neg_pos_ratio_negatives(self):
+        # every negative has the same loss, a threshold on the loss would keep all of them
+        loss   = [[1.0, 1.0, 1.0, 1.0, 1.0, 0.5], [2.0, 2.0, 2.0, 2.0, 2.0, 2.0]]
+        y_conf = [[0, 0, 0, 0, 0, 1], [1, 0, 0, 0, 0, 0]]
+        mask   = self.mask(loss, y_conf, [[1], [1]], 3)
+        np.testing.assert_array_equal(mask.sum(axis=1), [4, 4])
+        np.testing.assert_array_equal(mask[:,5], [1, 0])
+        np.testing.assert_array_equal(mask[:,0], [1, 1])
+
+    def test_no_matches_no_negatives(self):
+        np.testing.assert_array_equal(self.mask([[3.0, 1.0, 2.0]], [[0, 0, 0]], [[0]], 3), [[0, 0, 0]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import math
+import unittest
+import numpy as np
+
+from utils import decode_boxes, fold_batch_norm, match_detections
+
+
+def decode_box(norm_box, dbox):
+    """ One box the way Inference.get_coordinates decodes it """
+    cx = norm_box[0]*dbox[2] + dbox[0]
+    cy = norm_box[1]*dbox[3] + dbox[1]
+    w  = math.exp(norm_box[2])*dbox[2]
+    h  = math.exp(norm_box[3])*dbox[3]
+    return [cx - w/2, cy - h/2, cx + w/2, cy + h/2]
+
+
+class TestDecodeBoxes(unittest.TestCase):
+
+    def test_matches_per_box_decoding(self):
+        rng       = np.random.RandomState(0)
+        num_preds = 300
+        dboxes    = np.column_stack([rng.uniform(0,640,num_preds), rng.uniform(0,480,num_preds),
+                                     rng.uniform(10,100,num_preds), rng.uniform(10,100,num_preds)])
+        loc       = rng.randn(3,num_preds*4)*0.5
+        conf      = rng.randint(0,2,(3,num_preds))
+        probs     = rng.uniform(0,1,(3,num_preds))
+        # no detections in the second image
+        probs[1]  = 0.1
+
+        detections = decode_boxes(loc, conf, probs, dboxes, 0.8)
+        self.assertEqual(len(detections), 3)
+
+        for i,(boxes,scores,classes) in enumerate(detections):
+            keep = [ii for ii in range(num_preds) if probs[i][ii] > 0.8 and conf[i][ii] > 0]
+            self.assertEqual(boxes.dtype, np.float32)
+            self.assertEqual(scores.dtype, np.float32)
+            self.assertEqual(boxes.shape, (len(keep),4))
+            expected = [decode_box(loc[i][ii*4:ii*4+4], dboxes[ii]) for ii in keep]
+            np.testing.assert_allclose(boxes, np.array(expected).reshape(-1,4), rtol=1e-4, atol=1e-3)
+            np.testing.assert_allclose(scores, probs[i][keep], rtol=1e-6)
+            np.testing.assert_array_equal(classes, conf[i][keep])
+        self.assertEqual(len(detections[1][0]), 0)
+
+
+class TestFoldBatchNorm(unittest.TestCase):
+
+    def test_matches_conv_then_batch_norm(self):
+        rng = np.random.RandomState(0)
+        x   = rng.randn(20,3*3*4)
+        w   = rng.randn(3,3,4,6)
+        b, gamma, beta, mean = rng.randn(4,6)
+        var = rng.uniform(0.1,2,6)
+
+        # a conv at one position is x times the flattened filter
+        conv     = x.dot(w.reshape(-1,6)) + b
+        expected = gamma*(conv - mean)/np.sqrt(var + 0.001) + beta
+
+        fw, fb = fold_batch_norm(w, b, gamma, beta, mean, var)
+        self.assertEqual(fw.shape, w.shape)
+        self.assertEqual(fw.dtype, np.float32)
+        np.testing.assert_allclose(x.dot(fw.reshape(-1,6)) + fb, expected, rtol=1e-4, atol=1e-4)
+
+
+class TestMatchDetections(unittest.TestCase):
+
+    def test_matches_by_class_and_overlap(self):
+        boxes1   = np.array([[0,0,10,10],[20,20,30,30],[50,50,60,60]])
+        boxes2   = np.array([[1,1,11,11],[20,20,30,30],[100,100,110,110]])
+        # the second pair overlaps fully but has a different class
+        self.assertEqual(match_detections(boxes1, [1,1,1], boxes2, [1,2,1]), 1)
+        self.assertEqual(match_detections(boxes1, [1,2,1], boxes2, [1,2,1]), 2)
+        self.assertEqual(match_detections(boxes1, [1,2,1], boxes2[:0], []), 0)
+
+    def test_each_box_matches_once(self):
+        boxes1 = np.array([[0,0,10,10],[0,0,10,10]])
+        boxes2 = np.array([[0,0,10,10]])
+        self.assertEqual(match_detections(boxes1, [1,1], boxes2, [1]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
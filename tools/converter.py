@@ -1,9 +1,9 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 # This script converts .seq files into .jpg files, .vbb files into .pkl files
 # from Caltech Pedestrian Dataset
-# Based on Python 2.7
+# Based on Python 3
 # Author: Peng Zhang
 # E-mail: hizhangp@gmail.com
 # Caltech Pedestrian Dataset:
@@ -11,51 +11,135 @@
 
 import struct
 import os
-import cPickle
+import mmap
+import numpy as np
+import pickle
+import argparse
 import time
 from scipy.io import loadmat
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
-def read_seq(path):
-    def read_header(ifile):
-        feed = ifile.read(4)
-        norpix = ifile.read(24)
-        version = struct.unpack('@i', ifile.read(4))
-        length = struct.unpack('@i', ifile.read(4))
-        assert(length != 1024)
-        descr = ifile.read(512)
-        params = [struct.unpack('@i', ifile.read(4))[0] for i in range(9)]
-        fps = struct.unpack('@d', ifile.read(8))
-        ifile.read(432)
-        image_ext = {100: 'raw', 102: 'jpg', 201: 'jpg', 1: 'png', 2: 'png'}
-        return {'w': params[0], 'h': params[1], 'bdepth': params[2],
-                'ext': image_ext[params[5]], 'format': params[5],
-                'size': params[4], 'true_size': params[8],
-                'num_frames': params[6]}
-
-    assert path[-3:] == 'seq', path
-    ifile = open(path, 'rb')
-    params = read_header(ifile)
-    bytes = open(path, 'rb').read()
-
-    imgs = []
-    extra = 8
-    s = 1024
-    for i in range(params['num_frames']):
-        tmp = struct.unpack_from('@I', bytes[s:s + 4])[0]
-        I = bytes[s + 4:s + tmp]
-        s += tmp + extra
-        if i == 0:
-            val = struct.unpack_from('@B', bytes[s:s + 1])[0]
-            if val != 0:
-                s -= 4
-            else:
-                extra += 8
-                s += 8
-        imgs.append(I)
+def read_seq_header(ifile):
+    feed = ifile.read(4)
+    norpix = ifile.read(24)
+    version = struct.unpack('@i', ifile.read(4))
+    length = struct.unpack('@i', ifile.read(4))
+    assert(length != 1024)
+    descr = ifile.read(512)
+    params = [struct.unpack('@i', ifile.read(4))[0] for i in range(9)]
+    fps = struct.unpack('@d', ifile.read(8))
+    ifile.read(432)
+    image_ext = {100: 'raw', 102: 'jpg', 201: 'jpg', 1: 'png', 2: 'png'}
+    return {'w': params[0], 'h': params[1], 'bdepth': params[2],
+            'ext': image_ext[params[5]], 'format': params[5],
+            'size': params[4], 'true_size': params[8],
+            'num_frames': params[6]}
+
+
+class SeqReader(object):
+    """ Random access to the encoded frames of a .seq file without reading it.
+
+    The file is memory mapped and the (start, end) byte offsets of every frame
+    are found once, by following the frame sizes. With persist_index they are
+    saved next to the file as <path>.idx.npy, so that opening it again reads no
+    frame at all; by default nothing is written to the dataset. frame(i) and
+    iteration return memoryviews into the mapping: no copy is made and only the
+    pages of the frames that are used are read from disk.
+
+    The memoryviews are only valid while the reader is open, bytes(frame) makes
+    a copy that outlives it.
+    """
+
+    def __init__(self, path, persist_index=False):
+        assert path[-3:] == 'seq', path
+        self.path = path
+        with open(path, 'rb') as ifile:
+            self.params = read_seq_header(ifile)
+            self._mmap = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        self.index = self._load_index()
+        if self.index is None:
+            self.index = self._build_index()
+            if persist_index:
+                self._save_index()
+
+    @property
+    def index_path(self):
+        return self.path + '.idx.npy'
+
+    def _load_index(self):
+        """ The saved offsets, unless they are missing, older than the file or
+        do not fit it """
+        try:
+            if os.path.getmtime(self.index_path) < os.path.getmtime(self.path):
+                return None
+            index = np.load(self.index_path)
+        except (IOError, OSError, ValueError):
+            return None
+        if index.shape != (self.params['num_frames'], 2) or \
+                (len(index) and index[-1, 1] > len(self._mmap)):
+            return None
+        return index
+
+    def _build_index(self):
+        n = self.params['num_frames']
+        index = np.empty((n, 2), dtype=np.int64)
+        extra = 8
+        s = 1024
+        for i in range(n):
+            tmp = struct.unpack_from('@I', self._mmap, s)[0]
+            index[i] = (s + 4, s + tmp)
+            s += tmp + extra
+            if i == 0 and s < len(self._mmap):
+                val = struct.unpack_from('@B', self._mmap, s)[0]
+                if val != 0:
+                    s -= 4
+                else:
+                    extra += 8
+                    s += 8
+        return index
 
-    return imgs
+    def _save_index(self):
+        # the dataset directory may well be read only, the index is only a cache
+        tmp = self.index_path + '.tmp.npy'
+        try:
+            np.save(tmp, self.index)
+            os.replace(tmp, self.index_path)
+        except (IOError, OSError):
+            pass
+
+    def __len__(self):
+        return len(self.index)
+
+    def frame(self, i):
+        start, end = self.index[i]
+        return self._view[start:end]
+
+    def __iter__(self):
+        for start, end in self.index:
+            yield self._view[start:end]
+
+    def close(self):
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # frames are still referenced, the mapping goes when they do
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_seq(path):
+    with SeqReader(path) as reader:
+        return [frame.tobytes() for frame in reader]
 
 
 def read_vbb(path):
@@ -110,57 +194,142 @@ def read_vbb(path):
     return data
 
 
-if __name__ == '__main__':
-    # directory to store data
-    dir_path = './'
-    # phase can be 'train_', 'test_' or 'val_'
-    phase = 'train'
-    # num ranges from 0~11
-    num = [0, 11]
+def _write_atomic(path, data):
+    """ Write data to path through a temporary file, so that path is either
+    complete or missing, never half written """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
 
-    time_flag = time.time()
-    img_save_path = os.path.join(dir_path, phase + 'images')
-    anno_save_path = os.path.join(dir_path, phase + 'annotations.pkl')
-    if os.path.exists(img_save_path):
-        raise KeyError('Already exists : {}'.format(img_save_path))
-    else:
-        os.mkdir(img_save_path)
-    print 'Images will be saved to {}'.format(img_save_path)
-    print 'Annotations will be saved to {}'.format(anno_save_path)
-
-    #  convert .seq file into .jpg
-    for i in range(num[0], num[1]):
-        img_set_path = os.path.join(dir_path, 'set{:02}'.format(i))
-        assert os.path.exists(
-            img_set_path), 'Not exists: '.format(img_set_path)
-        print 'Extracting images from set{:02} ...'.format(i)
-        for j in sorted(os.listdir(img_set_path)):
-            imgs_path = os.path.join(img_set_path, j)
-            imgs = read_seq(imgs_path)
-            for ix, img in enumerate(imgs):
-                img_name = 'img{:02}{}{:04}.jpg'.format(i, j[2:4], ix)
-                img_path = os.path.join(img_save_path, img_name)
-                open(img_path, 'wb+').write(img)
-
-    print 'Images have been saved.'
-
-    # convert .vbb file into .pkl
-    # example: anno['00']['00']['frames'][0][0]['pos']
+
+def convert_seq(set_id, seq_path, img_save_path, done_path):
+    """ Write the frames of one .seq file as jpg files, then the done marker.
+
+    Returns the number of frames written, None if the marker says it is done
+    """
+    if os.path.exists(done_path):
+        return None
+    seq_id = os.path.basename(seq_path)[2:4]
+    with SeqReader(seq_path) as reader:
+        for ix, img in enumerate(reader):
+            img_name = 'img{:02}{}{:04}.jpg'.format(set_id, seq_id, ix)
+            _write_atomic(os.path.join(img_save_path, img_name), img)
+        n_frames = len(reader)
+    _write_atomic(done_path, b'')
+    return n_frames
+
+
+def convert_vbb(vbb_path, shard_path):
+    """ Parse one .vbb file into an annotation shard, a pickle of what
+    read_vbb returns.
+
+    Returns the number of frames, None if the shard exists already
+    """
+    if os.path.exists(shard_path):
+        return None
+    data = read_vbb(vbb_path)
+    _write_atomic(shard_path, pickle.dumps(data))
+    return data['nFrame']
+
+
+def merge_annotations(shard_dir, sets, anno_save_path):
+    """ Merge the shards of the sets into one pickle,
+    e.g. anno['00']['00']['frames'][0][0]['pos'] """
     anno = defaultdict(dict)
-    for i in range(num[0], num[1]):
+    for i in sets:
         anno['{:02}'.format(i)] = defaultdict(dict)
-        anno_set_path = os.path.join(dir_path, 'annotations',
-                                     'set{:02}'.format(i))
-        assert os.path.exists(anno_set_path), \
-            'Not exists: '.format(anno_set_path)
-        print 'Extracting annotations from set{:02} ...'.format(i)
-        for j in sorted(os.listdir(anno_set_path)):
-            anno_path = os.path.join(anno_set_path, j)
-            anno['{:02}'.format(i)][j[2:4]] = read_vbb(anno_path)
+    for fname in sorted(os.listdir(shard_dir)):
+        if not fname.endswith('.pkl'):
+            continue
+        # set00_V000.pkl, the sequence id is the same as in the image names
+        set_name, seq_name = fname[:-4].split('_')
+        set_id, seq_id = set_name[3:], seq_name[2:4]
+        if int(set_id) not in sets:
+            continue
+        with open(os.path.join(shard_dir, fname), 'rb') as f:
+            anno[set_id][seq_id] = pickle.load(f)
+    _write_atomic(anno_save_path, pickle.dumps(anno))
+    return anno
+
+
+def convert(dir_path, phase, sets, workers=None):
+    """ Convert the .seq files of dir_path/setXX into dir_path/<phase>images and
+    the .vbb files of dir_path/annotations/setXX into
+    dir_path/<phase>annotations.pkl, one process per sequence.
 
-    with open(anno_save_path, 'wb') as f:
-        cPickle.dump(anno, f)
+    Every file is written atomically and every sequence is marked done when it
+    is complete (<phase>images.done/, <phase>annotations.shards/), so running
+    it again after an interruption only does what is left.
+    """
+    img_save_path = os.path.join(dir_path, phase + 'images')
+    done_dir = os.path.join(dir_path, phase + 'images.done')
+    shard_dir = os.path.join(dir_path, phase + 'annotations.shards')
+    anno_save_path = os.path.join(dir_path, phase + 'annotations.pkl')
+    for d in [img_save_path, done_dir, shard_dir]:
+        os.makedirs(d, exist_ok=True)
+    print('Images will be saved to {}'.format(img_save_path))
+    print('Annotations will be saved to {}'.format(anno_save_path))
+
+    jobs = {}
+    with ProcessPoolExecutor(workers) as pool:
+        for i in sets:
+            set_name = 'set{:02}'.format(i)
+            img_set_path = os.path.join(dir_path, set_name)
+            anno_set_path = os.path.join(dir_path, 'annotations', set_name)
+            assert os.path.exists(img_set_path), \
+                'Not exists: {}'.format(img_set_path)
+            assert os.path.exists(anno_set_path), \
+                'Not exists: {}'.format(anno_set_path)
 
-    print 'Annotations have been saved.'
+            for j in sorted(os.listdir(img_set_path)):
+                if not j.endswith('.seq'):
+                    continue
+                name = '{}_{}'.format(set_name, j[:-4])
+                job = pool.submit(convert_seq, i,
+                                  os.path.join(img_set_path, j),
+                                  img_save_path,
+                                  os.path.join(done_dir, name))
+                jobs[job] = name + '.seq'
+
+            for j in sorted(os.listdir(anno_set_path)):
+                if not j.endswith('.vbb'):
+                    continue
+                name = '{}_{}'.format(set_name, j[:-4])
+                job = pool.submit(convert_vbb,
+                                  os.path.join(anno_set_path, j),
+                                  os.path.join(shard_dir, name + '.pkl'))
+                jobs[job] = name + '.vbb'
+
+        for job in as_completed(jobs):
+            n_frames = job.result()
+            if n_frames is None:
+                print('{} was done already'.format(jobs[job]))
+            else:
+                print('{} {} frames extracted'.format(jobs[job], n_frames))
 
-    print 'Done, time spends: {}s'.format(int(time.time() - time_flag))
+    merge_annotations(shard_dir, sets, anno_save_path)
+    print('Annotations have been saved.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert the .seq files of the Caltech Pedestrian '
+                    'Dataset into .jpg files and its .vbb files into a .pkl '
+                    'file. Rerunning it after an interruption only converts '
+                    'the sequences that are not done.')
+    parser.add_argument('--dir_path', default='./',
+                        help='directory with the setXX and annotations '
+                             'directories, the output goes there too')
+    parser.add_argument('--phase', default='train',
+                        help='prefix of the output, e.g. train, test or val')
+    parser.add_argument('--sets', type=int, nargs=2, default=[0, 11],
+                        metavar=('FIRST', 'END'),
+                        help='convert sets FIRST to END-1')
+    parser.add_argument('--workers', type=int,
+                        help='processes, the number of cores by default')
+    args = parser.parse_args()
+
+    time_flag = time.time()
+    convert(args.dir_path, args.phase, list(range(*args.sets)), args.workers)
+    print('Done, time spends: {}s'.format(int(time.time() - time_flag)))
@@ -1,4 +1,9 @@
+import os
 import sys
+import time
+import argparse
+import contextlib
+import resource
 import numpy as np
 import tensorflow as tf
 import random
@@ -6,14 +11,19 @@ import pickle
 
 from ssd_config import SSDConfig
 from net_factory import NetFactory
+from targets import SparseTargets
+from image_store import ImageStore, load_image
+from image_cache import ImageCache
+from batch_loader import BatchLoader
+from input_pipeline import SSDInputPipeline
+from checkpoint import AsyncCheckpointer
+from session_config import session_config
 
 import cv2 as cv
 
 import matplotlib.image as mpimg
 from PIL import Image
 
-imgs = {}
-
 class SSDTrain:
 
     def __init__(self,dirname):
@@ -26,86 +36,172 @@ class SSDTrain:
         self._net    = NetFactory.get_net(self.cfg.g("net"))(num_default_boxes= self.cfg.g("num_default_boxes"),
                                                              num_classes= self.cfg.g("num_classes"))
         print("Using NET={} DATASET={}".format(self.cfg.g("net"),self.cfg.g("dataset_name")))
+
+        self._image_cache = ImageCache(self.cfg.g("image_cache_bytes"))
+        self._rng         = np.random.RandomState(self.cfg.g("random_seed"))
+        self._loader      = None
+        self._pipeline    = None
+        self._image_store = None
+        # Replicas of distributed training change these, see distributed_train.py
+        self._is_chief    = True
+        self._device_fn   = None
+        # device of the variables that belong to this process only, e.g. the gradient accumulators
+        self._local_device = None
+        if self.cfg.g("use_image_store"):
+            # Build it first with: python image_store.py <dirname>
+            self._image_store = ImageStore(ImageStore.path(self.cfg))
+            print("Using image store {} with {} images".format(self._image_store.fname,len(self._image_store)))
         
 
-    def _get_yconf_mask(self, y_conf, y_loc, n_matched):
+    def _get_yconf_masks(self, Y_conf, n_matched, out=None):
         """
         We only use neg_pos_ratio times the number of positive gt matches.
         This is not needed for y_loc as y_loc losses are only for matched default boxes that match ground_truth boxes.
-        yconf_mask will contain a 1 for a data point that we will use and 0 for one that we will not.
+        The mask will contain a 1 for a data point that we will use and 0 for one that we will not.
+        The negatives are drawn at random with self._rng, if an image has fewer negatives than it
+        asks for all of them are used.
         
         Args
-        y_conf = array of confidences
-        y_loc  = array of location
-        n_matched = number of matched gt boxes
+        Y_conf = (batch_size,num_conf) array of confidences
+        n_matched = (batch_size,1) number of matched gt boxes of each image
+        out = optional (batch_size,num_conf) array to write the masks into
 
         Returns
-        A mask which specifies the total number of confidences to be used in calculating loss.
+        A mask for the whole batch which specifies the confidences to be used in calculating loss.
         """
-        yconf_mask     = np.array(y_conf, copy = True)
-        zero_indexes   = np.where(yconf_mask == 0)[0]
-        n_negatives    = n_matched*self.cfg.g("neg_pos_ratio")
-        yconf_mask     = np.minimum(yconf_mask,1)
-        the_chosen_few = random.sample(zero_indexes.tolist(),n_negatives)
+        positives   = Y_conf > 0
+        n_negatives = np.minimum(np.reshape(n_matched,-1).astype(np.int64)*self.cfg.g("neg_pos_ratio"),
+                                 Y_conf.shape[1] - positives.sum(axis=1))
+
+        # Sorting random keys gives a random order of the negatives of every row, positives go last.
+        keys        = self._rng.random_sample(Y_conf.shape)
+        keys[positives] = 2.0
+        order       = np.argsort(keys, axis=1)
+        chosen      = np.arange(Y_conf.shape[1])[None,:] < n_negatives[:,None]
 
-        print("n_negatives=",n_negatives);    print("zero_indexes=",zero_indexes.shape)
+        if out is None:
+            out = np.zeros(Y_conf.shape, dtype=np.int32)
+        out[np.arange(Y_conf.shape[0])[:,None], order] = chosen
+        out[positives] = 1
 
-        for i in the_chosen_few:
-            yconf_mask[i] = 1
+        return out
 
-        return yconf_mask
+    def _hard_negatives(self):
+        """ Whether the negatives are mined in the graph instead of sampled on the host """
+        return self.cfg.g("negative_mining") == "hard"
 
     def _get_image(self, fname):
         """
         Args fname : filename of image
 
-        Returns the image as array with dim (w,h,channels) """
-        img = imgs.get(fname)
-
-        if  img == None:
-            img = mpimg.imread(fname)
-            img = (img-128)/128
-            imgs[fname] = img
-    
-        return img
+        Returns the image as uint8 array with dim (h,w,channels), the caller normalizes it """
+        return self._image_cache.get(fname, lambda: load_image(fname,
+                                                               self.cfg.g("image_height"),
+                                                               self.cfg.g("image_width"),
+                                                               self.cfg.g("n_channels")))
     
-    def _batch_gen(self,start,end, batch_size,data,num_conf,num_loc,images_path):
+    def _batch_specs(self,batch_size):
+        """ Shapes and types of the arrays returned by _batch_gen """
+        cfg = self.cfg
+        return [([batch_size,cfg.g("image_height"),cfg.g("image_width"),cfg.g("n_channels")],np.float32),
+                ([batch_size,cfg.g("num_loc")],np.float32),
+                ([batch_size,cfg.g("num_conf")],np.int32),
+                ([batch_size,1],np.int32),
+                ([batch_size,cfg.g("num_conf")],np.int32)]
+
+    def _batch_gen(self,start,end, batch_size,data,num_conf,num_loc,images_path,out=None):
         """
         Args: start - starting position in data
               end - ending position in data
               batch_size - batch size
-              data - contains image_name, y_loc, y_conf, n_matched for each image
+              data - SparseTargets containing image_name, y_loc, y_conf, n_matched for each image
               num_conf - total number of detection confidences
               num_lock - total number of location confidences
               images_path - path to find images
+              out - optional zeroed arrays as described by _batch_specs to write the batch into
         """
-        import pickle
-        import numpy as np
-
-        X_train = np.zeros([batch_size,self.cfg.g("image_height"),self.cfg.g("image_width"),self.cfg.g("n_channels")])
-        Y_conf           = np.zeros([batch_size,num_conf])
-        Y_conf_loss_mask = np.zeros([batch_size,num_conf])
-        Y_loc            = np.zeros([batch_size,num_loc])
-        n_matched        = np.zeros([batch_size,1])
-    
-        for i,m in enumerate(data[start:end]):
-            img            = self._get_image(images_path+"/"+m['img_name'])
+        if out == None:
+            out = [np.zeros(shape,dtype) for shape,dtype in self._batch_specs(batch_size)]
+        X_train, Y_loc, Y_conf, n_matched, Y_conf_loss_mask = out
 
-            if img.shape[0] != self.cfg.g("image_height") or img.shape[1] != self.cfg.g("image_width"):
-                img            = cv.resize(img,(self.cfg.g("image_height"),self.cfg.g("image_width")))
-                
-            X_train[i]     = img
-            Y_loc[i]       = m['y_loc']
-            Y_conf[i]      = m['y_conf']
-            Y_conf_loss_mask[i]= self._get_yconf_mask(m['y_conf'],m['y_loc'], m['n_matched'])
-            n_matched[i]   = m['n_matched']
+        count = data.densify(start,end,Y_conf,Y_loc,n_matched)
+    
+        for i,img_name in enumerate(data.img_names[start:start+count]):
+            if self._image_store != None:
+                img        = self._image_store.get(img_name)
+            else:
+                img        = self._get_image(images_path+"/"+img_name)
+
+            # normalize straight from the uint8 image into the batch
+            np.subtract(img,128,out=X_train[i],dtype=X_train.dtype)
+            X_train[i]    /= 128
+
+        if not self._hard_negatives():
+            self._get_yconf_masks(Y_conf, n_matched, out=Y_conf_loss_mask)
         
         return X_train, Y_loc, Y_conf, n_matched,Y_conf_loss_mask
 
           
+    def _batches(self,name,data,batch_size):
+        """ Generator of (offset, batch, seconds spent waiting for the batch) over the whole data set.
+        The batches come from the batch loader when there is one, the arrays are only valid until the next batch. """
+        cfg     = self.cfg
+        offsets = list(range(0,len(data),batch_size))
+
+        if self._loader != None:
+            batches = self._loader.batches(name,[(offset,offset+batch_size) for offset in offsets],batch_size)
+            for offset,batch in zip(offsets,batches):
+                yield offset, batch, self._loader.last_wait
+            return
+
+        for offset in offsets:
+            t     = time.time()
+            batch = self._batch_gen(offset,offset+batch_size,batch_size,data,cfg.g("num_conf"),cfg.g("num_loc"),cfg.g("images_path"))
+            yield offset, batch, time.time() - t
+
+    def _steps(self,sess,name,data,batch_size,phase_value):
+        """ Generator of (offset, feed_dict, seconds spent waiting for data) for every batch of a data set.
+        With the tf.data pipeline the feed only sets the phase, the batch comes from the iterator. """
+        x, y_loc, y_conf, num_matched, y_conf_loss_mask, phase = self._inputs
+
+        if self._pipeline != None:
+            sess.run(self._pipeline.init_ops[name])
+            for offset in range(0,len(data),batch_size):
+                yield offset, {phase:phase_value}, 0.0
+            return
+
+        for offset, batch, data_wait in self._batches(name,data,batch_size):
+            X_batch, y_batch_loc, y_batch_conf, n_matched_batch, y_conf_mask = batch
+            feed_dict = {x:X_batch,
+                         y_conf:y_batch_conf,
+                         y_loc:y_batch_loc,
+                         num_matched:n_matched_batch,
+                         phase:phase_value}
+            if y_conf_loss_mask is not None:
+                feed_dict[y_conf_loss_mask] = y_conf_mask
+            yield offset, feed_dict, data_wait
+
+    def _start_loader(self,datasets,batch_size):
+        """ Start the worker processes that assemble batches, if loader_workers is set """
+        cfg = self.cfg
+        if cfg.g("loader_workers") <= 0:
+            return None
+
+        def fill_batch(name,start,end,arrays):
+            self._batch_gen(start,end,batch_size,datasets[name],cfg.g("num_conf"),cfg.g("num_loc"),cfg.g("images_path"),out=arrays)
+
+        def worker_init(worker_i):
+            # every worker has its own cache, split the budget between them
+            self._image_cache = ImageCache(cfg.g("image_cache_bytes")//cfg.g("loader_workers"))
+            # and its own random negatives
+            seed = cfg.g("random_seed")
+            self._rng = np.random.RandomState(None if seed == None else seed + worker_i + 1)
+
+        print("Starting {} batch loader workers, prefetch depth {}".format(cfg.g("loader_workers"),cfg.g("prefetch_depth")))
+        return BatchLoader(fill_batch,self._batch_specs(batch_size),cfg.g("loader_workers"),cfg.g("prefetch_depth"),worker_init)
+
     def _len_data(self,dirname,batch_type):
-        training_data = pickle.load(open(dirname+"/"+batch_type+".pkl","rb"))
-        return len(training_data)
+        return len(SparseTargets.load(dirname,batch_type,self.cfg.g("num_preds")))
 
     def _evaluate_testset(self, dirname,sess):
         """ TODO ... using val loss for now. Run evaluate the test set """
@@ -144,7 +240,66 @@ class SSDTrain:
     def _smooth_l1(self,x):
         return tf.where( tf.less_equal(tf.abs(x),1.0), 0.5*x*x,  tf.abs(x) - 0.5)
     
-    def _ssd_graph(self,x,y_loc,y_conf,num_matched,y_conf_loss_mask,phase):
+    def _hard_negative_mask(self,cross_entropy_with_logits,y_conf,num_matched):
+        """
+        Online hard negative mining: keep the positives and the neg_pos_ratio*n_matched background
+        boxes with the highest confidence loss of each image.
+
+        Returns
+        A (batch_size,num_conf) float mask, it has no gradient.
+        """
+        num_preds   = self.cfg.g("num_preds")
+        positives   = tf.greater(y_conf,0)
+        n_negatives = tf.minimum(tf.reshape(num_matched,[-1])*self.cfg.g("neg_pos_ratio"),
+                                 num_preds - tf.reduce_sum(tf.cast(positives,tf.int32),axis=1))
+
+        # cross entropy is never negative, so -1 ranks the positives below every negative
+        neg_loss    = tf.where(positives, -tf.ones_like(cross_entropy_with_logits), tf.stop_gradient(cross_entropy_with_logits))
+        _, order    = tf.nn.top_k(neg_loss,k=num_preds)
+
+        # the first n_negatives boxes of each row of order are the ones we keep, scattered back to
+        # their place. Selecting by rank keeps exactly n_negatives even when losses tie.
+        rows        = tf.tile(tf.expand_dims(tf.range(tf.shape(y_conf)[0]),1),[1,num_preds])
+        selected    = tf.cast(tf.less(tf.expand_dims(tf.range(num_preds),0),tf.expand_dims(n_negatives,1)),tf.float32)
+        hardest     = tf.scatter_nd(tf.stack([rows,order],axis=2),selected,tf.shape(order))
+
+        return tf.maximum(tf.cast(positives,tf.float32),hardest)
+
+    def _accumulate_gradients(self,optimizer,total_loss,extra_update_ops,global_step):
+        """
+        Gradient accumulation: a batch is fed as several micro batches, each one adds its gradients to
+        accumulators and the optimizer is applied once to their sum. The losses are sums over the
+        images so this is the gradient of the whole batch, only the batch norm statistics see the
+        micro batches. The accumulators are local variables, they are not saved in checkpoints.
+
+        Sets self._grad_accum_ops, "zero" runs before the first micro batch and "apply" after the last.
+
+        Returns
+        The op that accumulates the gradients of one micro batch.
+        """
+        grads_and_vars = [(g,v) for g,v in optimizer.compute_gradients(total_loss) if g is not None]
+        # Under replica_device_setter every variable goes to the parameter server, where all the
+        # replicas would add into the same accumulators. Each replica keeps its own.
+        with tf.device(self._local_device) if self._local_device != None else contextlib.ExitStack():
+            accumulators = [tf.Variable(tf.zeros(v.get_shape(),dtype=v.dtype.base_dtype),trainable=False,
+                                        collections=[tf.GraphKeys.LOCAL_VARIABLES],name=v.op.name+"_grad_accum")
+                            for g,v in grads_and_vars]
+
+        with tf.control_dependencies(extra_update_ops):
+            accumulate = tf.group(*[a.assign_add(tf.convert_to_tensor(g)) for a,(g,v) in zip(accumulators,grads_and_vars)])
+
+        self._grad_accum_ops = {
+            "zero":  tf.group(*[a.assign(tf.zeros_like(a)) for a in accumulators]),
+            "apply": optimizer.apply_gradients([(a,v) for a,(g,v) in zip(accumulators,grads_and_vars)],global_step=global_step)
+        }
+        return accumulate
+
+    def _ssd_graph(self,x,y_loc,y_conf,num_matched,y_conf_loss_mask,phase,accum_steps=1):
+        """ Build the net, the loss and the training operation.
+        With y_conf_loss_mask None the negatives for the confidence loss are picked in the graph
+        by online hard negative mining, otherwise y_conf_loss_mask says which confidences to use.
+        With accum_steps > 1 the training operation only accumulates the gradients of a micro batch,
+        see _accumulate_gradients. """
         ## CREATE THE GRAPH
         y_predict_loc, y_predict_conf = self._net.graph(x,phase)
 
@@ -152,12 +307,16 @@ class SSDTrain:
         y_predict_loc_initial = y_predict_loc
         y_predict_conf_initial = y_predict_conf
         
-        y_conf_loss_mask = tf.cast(y_conf_loss_mask,tf.float32)
-        
         y_predict_conf = tf.reshape(y_predict_conf,[-1,self.cfg.g("num_preds"),self.cfg.g("num_classes")])
         print("  predict_conf.shape & y_conf.shape ",y_predict_conf.shape, y_conf.shape)
         
         cross_entropy_with_logits = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=y_predict_conf, labels=y_conf)
+
+        if y_conf_loss_mask is None:
+            y_conf_loss_mask = self._hard_negative_mask(cross_entropy_with_logits,y_conf,num_matched)
+        else:
+            y_conf_loss_mask = tf.cast(y_conf_loss_mask,tf.float32)
+
         conf_loss_arr = y_conf_loss_mask * cross_entropy_with_logits
         Lconf = tf.reduce_sum(conf_loss_arr)
         y_conf_1_column = y_conf
@@ -185,12 +344,21 @@ class SSDTrain:
 
         extra_update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
         
-        with tf.control_dependencies(extra_update_ops): 
-            training_operation = optimizer.minimize(total_loss)
+        global_step = tf.train.get_or_create_global_step()
+        if accum_steps > 1:
+            training_operation = self._accumulate_gradients(optimizer,total_loss,extra_update_ops,global_step)
+        else:
+            self._grad_accum_ops = None
+            with tf.control_dependencies(extra_update_ops): 
+                training_operation = optimizer.minimize(total_loss,global_step=global_step)
+
+        # Saved with the model so that a run can be resumed
+        self._epochs_done = tf.Variable(0,trainable=False,name="epochs_done")
         
         saver =  tf.train.Saver()
         
         debug_stats = { "cross_entropy_with_logits": cross_entropy_with_logits,
+                        "y_conf_loss_mask": y_conf_loss_mask,
                         "Conf-Loss-Before-Reduce-Sum" : conf_loss_arr,
                         "Lbox_coords_before_sum":Lbox_coords_before_sum,
                         "box_mask": matching_box_present_mask,
@@ -206,30 +374,24 @@ class SSDTrain:
 
 
     def _calc_validation_losses(self, sess, epoch_i, train_loss,batch_size,valid_data,x,y_conf,y_loc,num_matched, y_conf_loss_mask, total_loss,phase):
-
-        num_valid_samples       = self._len_data(self.dirname, "val")
+        """ The validation loss per image: total_loss is a sum over the images of a batch, so the
+        losses of the batches are added up and divided by the number of images, whatever the batch
+        size and however many images the last batch has """
+        num_valid_samples       = len(valid_data)
         batch_size              = min(num_valid_samples,batch_size)
-        epoch_validation_losses = []
+        validation_loss_sum     = 0.0
         
-        for valid_offset in range(0, num_valid_samples,batch_size):
-            start = valid_offset
-            end   = valid_offset + batch_size
-            X_valid_batch, y_valid_batch_loc, y_valid_batch_conf, n_valid_matched_batch, y_valid_conf_mask = self._batch_gen(start,end,batch_size, valid_data,self.cfg.g("num_conf"),self.cfg.g("num_loc"), self.cfg.g("images_path"))
-                
-            validation_loss = sess.run([total_loss], feed_dict={x          : X_valid_batch,
-                                                                y_conf     : y_valid_batch_conf,
-                                                                y_loc      : y_valid_batch_loc,
-                                                                num_matched: n_valid_matched_batch,
-                                                                y_conf_loss_mask:y_valid_conf_mask,phase:0})
-            epoch_validation_losses.append(validation_loss)
+        for valid_offset, feed_dict, data_wait in self._steps(sess,"val",valid_data,batch_size,0):
+            validation_loss = sess.run(total_loss, feed_dict=feed_dict)
+            validation_loss_sum += validation_loss
+        validation_loss = validation_loss_sum/max(num_valid_samples,1)
 
         print("============")
-        print("EPOCH {} ValLoss={} TrainLoss={}".format(epoch_i, validation_loss, train_loss) )
+        print("EPOCH {} ValLoss={} per image TrainLoss={}".format(epoch_i, validation_loss, train_loss) )
         print(self.dirname+"/"+"model-vloss-"+str(validation_loss)+"tloss"+str(train_loss)+"EPOCH-",str(epoch_i))
         print("============")
 
-        epoch_validation_loss = np.mean(epoch_validation_losses)
-        return epoch_validation_loss
+        return validation_loss
 
     
     
@@ -260,101 +422,227 @@ class SSDTrain:
 
         
 
-    def train_the_net(self):
+    def _load_data(self,dirname):
+        """ The training and validation targets """
+        # TODO This should go intot the dataset class
+        data                = SparseTargets.load(dirname,"train",self.cfg.g("num_preds"))
+        valid_data          = SparseTargets.load(dirname,"val",self.cfg.g("num_preds"))
+        return data, valid_data
+
+    def _session(self):
+        return tf.Session(config=session_config(self.cfg))
+
+    def _initialize(self,sess,saver,run_dir,resume):
+        """ Restore the latest checkpoint of run_dir when resuming, initialize the variables otherwise.
+
+        Returns
+        The first epoch to train and the loss history of the checkpoint (or None).
+        """
+        prefix, history = AsyncCheckpointer.latest(run_dir) if resume != None else (None,None)
+        if prefix == None:
+            if resume != None:
+                print("No checkpoint in {}, starting from scratch".format(run_dir))
+            sess.run(tf.global_variables_initializer())
+            return 0, None
+
+        saver.restore(sess,prefix)
+        first_epoch = sess.run(self._epochs_done)
+        print("Resuming from {} at epoch {}".format(prefix,first_epoch))
+        return first_epoch, history
+
+    def _end_of_training(self,sess):
+        """ Called before the final model is saved """
+        pass
+
+    def train_the_net(self,resume=None):
+        """
+        Args
+        resume : optional run directory, training continues from its latest checkpoint, with the
+                 epoch count, the optimizer state and the loss history. A checkpoint taken in the
+                 middle of an epoch resumes at the start of that epoch.
+        """
         # Setup the loss for the coordinates and the bl
         cfg = self.cfg
-        cfg.save_at_beginning_of_run()
+        if resume != None:
+            cfg.resume_run(resume)
+        else:
+            cfg.save_at_beginning_of_run()
+        run_dir = cfg.g("run_dir")
 
         dirname = self.cfg.g("dirname")
-        ## INITIALIZATION
-        phase            = tf.placeholder(tf.bool,name='phase') # Whether training or not
-        x                = tf.placeholder(tf.float32,(None, cfg.g("image_height"),
-                                                      cfg.g("image_width"), cfg.g("n_channels")),name="x")
-        y_loc            = tf.placeholder(tf.float32,(None,cfg.g("num_loc")),name="y_loc")
-        y_conf           = tf.placeholder(tf.int32,(None,cfg.g("num_conf")),name="y_conf")
-        num_matched      = tf.placeholder(tf.int32,(None,1),name="num_matched")
-        y_conf_loss_mask = tf.placeholder(tf.int32,(None,cfg.g("num_conf")),name="y_conf_loss_mask")
-
-        saver, debug_stats, total_loss, training_operation = self._ssd_graph(x,y_loc,y_conf,num_matched,y_conf_loss_mask,phase)
-        
-        printed                        = tf.Print(total_loss,[total_loss])
-
 
-        total_loss_summary  = tf.summary.scalar('Total Loss',total_loss)
-        file_writer         = tf.summary.FileWriter(self.cfg.g("run_dir"), tf.get_default_graph())
-        
-        # TODO This should go intot the dataset class
-        data                = pickle.load(open(dirname+"/train.pkl","rb"))
-        valid_data          = pickle.load(open(dirname+"/val.pkl","rb"))
+        data, valid_data    = self._load_data(dirname)
 
         images_path         = cfg.g("images_path");
         batch_size          = cfg.g("batch_size")
         
         all_training_losses = []
         cumulative_losses   = []
+        num_examples        = len(data)
+        batch_size          = min(num_examples,batch_size)
+
+        # Batches are fed as accum_steps micro batches, which bounds the memory of the activations
+        micro_batch_size    = min(cfg.g("micro_batch_size") or batch_size, batch_size)
+        if batch_size % micro_batch_size != 0:
+            raise ValueError("micro_batch_size {} does not divide batch_size {}".format(micro_batch_size,batch_size))
+        accum_steps         = batch_size//micro_batch_size
+        print("batch_size {} in {} micro batches of {}".format(batch_size,accum_steps,micro_batch_size))
+
+        ## INITIALIZATION
+        x_shape          = (None, cfg.g("image_height"), cfg.g("image_width"), cfg.g("n_channels"))
+        phase            = tf.placeholder(tf.bool,name='phase') # Whether training or not
+        # with hard negative mining the mask is built inside the graph, there is nothing to feed
+        y_conf_loss_mask = None
+
+        if cfg.g("input_pipeline") == "tf_data":
+            # The inputs default to the iterator so that they can still be fed by name, e.g. x:0 by Inference
+            self._pipeline   = SSDInputPipeline(cfg,{"train":data,"val":valid_data},micro_batch_size,
+                                                random_negatives=not self._hard_negatives())
+            it_x, it_y_loc, it_y_conf, it_num_matched, it_y_conf_loss_mask = self._pipeline.outputs
+            x                = tf.placeholder_with_default(it_x,x_shape,name="x")
+            y_loc            = tf.placeholder_with_default(it_y_loc,(None,cfg.g("num_loc")),name="y_loc")
+            y_conf           = tf.placeholder_with_default(it_y_conf,(None,cfg.g("num_conf")),name="y_conf")
+            num_matched      = tf.placeholder_with_default(it_num_matched,(None,1),name="num_matched")
+            if not self._hard_negatives():
+                y_conf_loss_mask = tf.placeholder_with_default(it_y_conf_loss_mask,(None,cfg.g("num_conf")),name="y_conf_loss_mask")
+        else:
+            self._pipeline   = None
+            x                = tf.placeholder(tf.float32,x_shape,name="x")
+            y_loc            = tf.placeholder(tf.float32,(None,cfg.g("num_loc")),name="y_loc")
+            y_conf           = tf.placeholder(tf.int32,(None,cfg.g("num_conf")),name="y_conf")
+            num_matched      = tf.placeholder(tf.int32,(None,1),name="num_matched")
+            if not self._hard_negatives():
+                y_conf_loss_mask = tf.placeholder(tf.int32,(None,cfg.g("num_conf")),name="y_conf_loss_mask")
+        self._inputs     = (x, y_loc, y_conf, num_matched, y_conf_loss_mask, phase)
+
+        with tf.device(self._device_fn):
+            saver, debug_stats, total_loss, training_operation = self._ssd_graph(x,y_loc,y_conf,num_matched,y_conf_loss_mask,phase,accum_steps)
+        accum_ops = self._grad_accum_ops
         
-        with tf.Session() as sess:
-            sess.run(tf.global_variables_initializer())
-            num_examples = self._len_data(dirname,"train")
+        tf.summary.scalar('Total Loss',total_loss)
+        tf.summary.scalar('Lconf',debug_stats["Lconf"])
+        tf.summary.scalar('Lbox_coords',debug_stats["Lbox_coords"])
+        merged_summaries    = tf.summary.merge_all()
+        file_writer         = tf.summary.FileWriter(self.cfg.g("run_dir"), tf.get_default_graph()) if self._is_chief else None
+        debug_stats_period  = self.cfg.g("debug_stats_period")
+
+        # Start the workers before the session, they are forked from this process
+        if self._pipeline == None:
+            self._loader    = self._start_loader({"train":data,"val":valid_data},micro_batch_size)
+        
+        checkpoint_every_secs = cfg.g("checkpoint_every_secs")
+        global_step           = tf.train.get_global_step()
+
+        with self._session() as sess:
+            checkpointer = AsyncCheckpointer(saver,run_dir,cfg.g("checkpoint_max_to_keep")) if self._is_chief else None
+            first_epoch, history = self._initialize(sess,saver,run_dir,resume)
+            if history != None:
+                all_training_losses, cumulative_losses = history
+            sess.run(tf.local_variables_initializer())
+            last_checkpoint = time.time()
 
-            for epoch_i in range(self.cfg.g("num_epochs")):
+            for epoch_i in range(first_epoch,self.cfg.g("num_epochs")):
 
                 epoch_train_losses      = []
                 epoch_validation_losses = []
-                batch_size              = min(num_examples,batch_size)
+                epoch_data_wait         = 0.0
+                epoch_start             = time.time()
                 
-                for offset in range(0,num_examples, batch_size):
-                    start = offset
-                    end   = offset + batch_size
-                    X_batch, y_batch_loc, y_batch_conf, n_matched_batch, y_conf_mask = self._batch_gen( start,end,batch_size,data,cfg.g("num_conf"),cfg.g("num_loc"),images_path)
-                    
-                    print(X_batch.shape, y_batch_loc.shape, y_batch_conf.shape, n_matched_batch, y_conf_mask.shape)
-                
-                    _, lprinted, train_loss, debug_out  = sess.run([ training_operation, printed, total_loss, debug_stats],
-                                                                    feed_dict={x:X_batch,
-                                                                    y_conf:y_batch_conf,
-                                                                    y_loc:y_batch_loc,
-                                                                    num_matched:n_matched_batch,
-                                                                    y_conf_loss_mask:y_conf_mask,phase:1})
-                    
+                for offset, feed_dict, data_wait in self._steps(sess,"train",data,micro_batch_size,1):
+                    epoch_data_wait += data_wait
+                    batch_i          = offset//batch_size
+                    micro_i          = (offset % batch_size)//micro_batch_size
+                    last_micro       = micro_i == accum_steps-1 or offset+micro_batch_size >= num_examples
+                    log_summary      = micro_i == 0 and file_writer != None and batch_i % self.cfg.g("tensorboard_batch_log_period") == 0
+                    log_debug        = micro_i == 0 and debug_stats_period > 0 and batch_i % debug_stats_period == 0
+
+                    if micro_i == 0:
+                        batch_losses = np.zeros(3)
+                        if accum_ops != None:
+                            sess.run(accum_ops["zero"])
+
+                    # Only scalars come back to the host, the summaries and the full diagnostics
+                    # are computed in the same run as the training step when they are due.
+                    # With micro batches they are those of the first micro batch of the batch.
+                    fetches = { "train": training_operation,
+                                "losses": [total_loss, debug_stats["Lconf"], debug_stats["Lbox_coords"]] }
+                    if log_summary:
+                        fetches["summary"] = merged_summaries
+                    if log_debug:
+                        fetches["debug"]   = debug_stats
+                        fetches["targets"] = [y_loc,y_conf,num_matched]
+
+                    out = sess.run(fetches, feed_dict=feed_dict)
+                    batch_losses += out["losses"]
+
+                    if log_debug:
+                        y_batch_loc, y_batch_conf, n_matched_batch = out["targets"]
+                        self.debug_output_vars(out["debug"],out["losses"][0],y_batch_loc,y_batch_conf,
+                                               out["debug"]["y_conf_loss_mask"],n_matched_batch)
+
+                    if log_summary:
+                        step = epoch_i*(num_examples//batch_size) + batch_i
+                        file_writer.add_summary(out["summary"], step)
+
+                    if not last_micro:
+                        continue
+                    if accum_ops != None:
+                        sess.run(accum_ops["apply"])
+
+                    train_loss, lconf, lbox_coords = batch_losses
                     epoch_train_losses.append(train_loss)
-                    self.debug_output_vars(debug_out,train_loss,y_batch_loc,y_batch_conf,y_conf_mask,n_matched_batch) 
-
-                    print("EPOCH[",epoch_i,"] index=[",offset//batch_size,"] offset=[",offset,"] batch_size=[",batch_size,"] train_loss=",train_loss)
-
-                    if (offset//batch_size) % self.cfg.g("tensorboard_batch_log_period") == 0:
-                        summary_str = total_loss_summary.eval(feed_dict={x:X_batch,
-                                                                    y_conf:y_batch_conf,
-                                                                    y_loc:y_batch_loc,
-                                                                    num_matched:n_matched_batch,
-                                                                    y_conf_loss_mask:y_conf_mask,phase:0})
-                        step = epoch_i*(num_examples//batch_size) + offset//batch_size
-                        file_writer.add_summary(summary_str, step)
+
+                    print("EPOCH[",epoch_i,"] index=[",batch_i,"] offset=[",offset,"] batch_size=[",batch_size,"] train_loss=",train_loss,
+                          "Lconf=",lconf,"Lbox_coords=",lbox_coords,"data_wait=",data_wait)
+
+                    if self._is_chief and checkpoint_every_secs > 0 and time.time() - last_checkpoint >= checkpoint_every_secs:
+                        checkpointer.save(sess,"{}/model-step-{}".format(run_dir,tf.train.global_step(sess,global_step)),
+                                          extra=[list(all_training_losses),list(cumulative_losses)])
+                        last_checkpoint = time.time()
                     # if (epoch_i >=1):
                     #    for i in (EPOCH,0,-1):
                     #        print(epoch_train_losses[len(epoch_train_losses)-1-(num_examples/batch_size)]) 
                     # print("END ==== LOSSES")
                   
                     
+                epoch_time = time.time() - epoch_start
+                print("EPOCH[",epoch_i,"] waited",epoch_data_wait,"s for data, image cache",self._image_cache.stats())
+                # ru_maxrss is in kilobytes on Linux
+                print("EPOCH[",epoch_i,"] {:.1f} images/sec, micro_batch_size {} x {}, peak RSS {:.0f} MB".format(
+                      num_examples/epoch_time, micro_batch_size, accum_steps,
+                      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0))
                 epoch_train_loss = np.mean(epoch_train_losses)
                 all_training_losses.append([epoch_i,epoch_train_loss])
+                if not self._is_chief:
+                    # the chief keeps the epoch count, the loss history, validates and checkpoints
+                    continue
+                self._epochs_done.load(epoch_i+1,sess)
                 pickle.dump(all_training_losses, open(cfg.g("run_dir")+"/train_losses_till_epoch-"+str(epoch_i),"wb"))
         
                 if (epoch_i % 5 == 0):
                     # After every 5 epochs we can calculate validation loss & accuracy (TODO).
-                    epoch_validation_loss = self._calc_validation_losses(sess, epoch_i,epoch_train_loss,batch_size,valid_data,x,y_conf,y_loc,num_matched, y_conf_loss_mask, total_loss,phase)
+                    epoch_validation_loss = self._calc_validation_losses(sess, epoch_i,epoch_train_loss,micro_batch_size,valid_data,x,y_conf,y_loc,num_matched, y_conf_loss_mask, total_loss,phase)
                     epoch_train_loss      = np.mean(epoch_train_losses)
                     cumulative_losses.append([epoch_i,epoch_train_loss,epoch_validation_loss])
                     pickle.dump(cumulative_losses, open(cfg.g("run_dir")+"/cumulative_losses_till_epoch-"+str(epoch_i),"wb"))
-                    saver.save(sess,"{}/model-vloss-{}-tloss-{}-EPOCH-{}".format(cfg.g("run_dir"),
-                                                                                 str(epoch_validation_loss),
-                                                                                 str(epoch_train_loss),
-                                                                                 str(epoch_i)))
+                    checkpointer.save(sess,"{}/model-vloss-{}-tloss-{}-EPOCH-{}".format(run_dir,
+                                                                                        str(epoch_validation_loss),
+                                                                                        str(epoch_train_loss),
+                                                                                        str(epoch_i)),
+                                      extra=[list(all_training_losses),list(cumulative_losses)])
+                    last_checkpoint = time.time()
                 if train_loss == 0.0:
                     print("BREAKING EARLY")
                     break
-            saver.save(sess,cfg.g("run_dir")+"/final-model")
-            file_writer.close()
+            self._end_of_training(sess)
+            if self._is_chief:
+                checkpointer.save(sess,run_dir+"/final-model",extra=[all_training_losses,cumulative_losses],keep=True)
+                checkpointer.close()
+                file_writer.close()
+
+        if self._loader != None:
+            self._loader.close()
+            self._loader = None
 
             
 
@@ -389,19 +677,18 @@ if __name__ == "__main__":
     # vgg.debug_train_setup()
     # "/Users/vivek/work/ssd-code/tiny_voc"
     
-    if (len(sys.argv) < 2 ):
-        print("Please supply a directory name contraining a configuration file.")
-        print("Usage:")
-        print("{} <directory-containing-configuration-yaml-file>".format(sys.argv[0]))
-        print("Example:")
-        print("{} {}".format(sys.argv[0],"/Users/vivek/work/ssd-code/tiny_voc"))
-        sys.exit()
+    parser = argparse.ArgumentParser(description="Train the SSD net of a data set.",
+                                     epilog="Example: {} /Users/vivek/work/ssd-code/tiny_voc".format(sys.argv[0]))
+    parser.add_argument("dirname",help="directory containing the configuration yaml file")
+    parser.add_argument("--resume",metavar="RUN_DIR",
+                        help="continue the run in RUN_DIR, a path or a run name in dirname, from its latest checkpoint")
+    args = parser.parse_args()
 
     print(sys.argv)
-    dirname = sys.argv[1]
-        
-    train_net = SSDTrain(dirname)
-    
-    train_net.train_the_net()
+    resume = args.resume
+    if resume != None and not os.path.isdir(resume):
+        resume = args.dirname+"/"+resume
 
+    train_net = SSDTrain(args.dirname)
     
+    train_net.train_the_net(resume=resume)
@@ -0,0 +1,183 @@
+import os
+import sys
+import time
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+import yaml
+
+from ssd_config import SSDConfig, TUNED_PROFILE
+from session_config import session_config
+from net_factory import NetFactory
+from train import SSDTrain
+
+
+class Tuner:
+    """
+    Sweeps the session threads, the batch size and the prefetch depth of the configured net on
+    synthetic input and finds the setting with the most images/sec.
+
+    mode "train" times training steps and sweeps the micro batch size (the batch_size of the
+    configuration stays what it is), mode "inference" times forward passes and sweeps
+    inference_batch_size.
+
+    In train mode only the threads and the prefetch depth go into the profile. A micro batch size
+    changes the batch norm statistics and turns on gradient accumulation, so the fastest one is only
+    reported, and used if the user sets micro_batch_size in ssd_config.yaml.
+    """
+
+    def __init__(self,dirname,mode="train"):
+        self.dirname = dirname
+        self.cfg     = SSDConfig(dirname)
+        self.mode    = mode
+
+    def _synthetic_inputs(self,batch_size,prefetch_depth):
+        """ Random images and targets, made in the graph so that feeding costs nothing """
+        cfg       = self.cfg
+        num_preds = cfg.g("num_preds")
+
+        def make(_):
+            x         = tf.random_uniform([cfg.g("image_height"),cfg.g("image_width"),cfg.g("n_channels")],-1.0,1.0)
+            y_conf    = tf.cast(tf.random_uniform([num_preds]) < 0.01,tf.int32)
+            box_mask  = tf.reshape(tf.tile(tf.expand_dims(tf.cast(y_conf,tf.float32),1),[1,4]),[-1])
+            y_loc     = tf.random_normal([num_preds*4])*box_mask
+            n_matched = tf.reshape(tf.reduce_sum(y_conf),[1])
+            mask      = tf.maximum(y_conf,tf.cast(tf.random_uniform([num_preds]) < 0.04,tf.int32))
+            return x, y_loc, y_conf, n_matched, mask
+
+        dataset = tf.data.Dataset.range(1).repeat()
+        dataset = dataset.map(make,num_parallel_calls=cfg.g("input_parallel_calls"))
+        dataset = dataset.batch(batch_size).prefetch(prefetch_depth)
+        return dataset.make_one_shot_iterator().get_next()
+
+    def _step_op(self,inputs,phase):
+        x, y_loc, y_conf, num_matched, mask = inputs
+        if self.mode == "train":
+            trainer     = SSDTrain(self.dirname)
+            trainer.cfg = self.cfg
+            if trainer._hard_negatives():
+                mask = None
+            _, _, total_loss, training_operation = trainer._ssd_graph(x,y_loc,y_conf,num_matched,mask,phase)
+            return [training_operation,total_loss]
+
+        net = NetFactory.get_net(self.cfg.g("net"))(num_default_boxes=self.cfg.g("num_default_boxes"),
+                                                     num_classes=self.cfg.g("num_classes"))
+        y_predict_loc, y_predict_conf = net.graph(x,phase)
+        probs = tf.nn.softmax(tf.reshape(y_predict_conf,[-1,self.cfg.g("num_preds"),self.cfg.g("num_classes")]))
+        return [y_predict_loc,probs]
+
+    def measure(self,intra_op_threads,inter_op_threads,batch_size,prefetch_depth,steps=20,warmup=3):
+        """ Time steps steps after warmup steps.
+
+        Returns
+        dict of the setting and its images_per_sec, p50_ms and p99_ms step latency
+        """
+        cfg = self.cfg
+        cfg.set("intra_op_threads",intra_op_threads)
+        cfg.set("inter_op_threads",inter_op_threads)
+        cfg.set("prefetch_depth",prefetch_depth)
+
+        with tf.Graph().as_default():
+            phase   = tf.placeholder(tf.bool,name="phase")
+            step_op = self._step_op(self._synthetic_inputs(batch_size,prefetch_depth),phase)
+
+            with tf.Session(config=session_config(cfg)) as sess:
+                sess.run([tf.global_variables_initializer(),tf.local_variables_initializer()])
+                feed_dict = {phase:self.mode == "train"}
+
+                times = []
+                for i in range(warmup+steps):
+                    t = time.time()
+                    sess.run(step_op,feed_dict=feed_dict)
+                    if i >= warmup:
+                        times.append(time.time()-t)
+
+        times = np.array(times)
+        return {"intra_op_threads": intra_op_threads,
+                "inter_op_threads": inter_op_threads,
+                "batch_size":       batch_size,
+                "prefetch_depth":   prefetch_depth,
+                "images_per_sec":   float(batch_size*len(times)/times.sum()),
+                "p50_ms":           float(np.percentile(times,50)*1000),
+                "p99_ms":           float(np.percentile(times,99)*1000)}
+
+    def sweep(self,intra,inter,batch_sizes,prefetch,steps=20,warmup=3):
+        """ Measure every combination, returns the results sorted fastest first """
+        results = []
+        for setting in itertools.product(intra,inter,batch_sizes,prefetch):
+            try:
+                r = self.measure(*setting,steps=steps,warmup=warmup)
+            except (tf.errors.ResourceExhaustedError,MemoryError) as e:
+                print("intra={} inter={} batch={} prefetch={} failed: {}".format(*setting,type(e).__name__))
+                continue
+            print("intra={intra_op_threads} inter={inter_op_threads} batch={batch_size} prefetch={prefetch_depth} "
+                  "{images_per_sec:.2f} images/sec p50={p50_ms:.1f}ms p99={p99_ms:.1f}ms".format(**r))
+            results.append(r)
+        return sorted(results,key=lambda r: -r["images_per_sec"])
+
+    def profile(self,best):
+        """ The configuration settings of the best result """
+        profile = {"intra_op_threads": best["intra_op_threads"],
+                   "inter_op_threads": best["inter_op_threads"],
+                   "prefetch_depth":   best["prefetch_depth"]}
+        if self.mode == "inference":
+            profile["inference_batch_size"] = best["batch_size"]
+        return profile
+
+    def write_profile(self,best):
+        """ Merge the best setting into <dirname>/tuned_profile.yaml """
+        fname   = self.dirname+"/"+TUNED_PROFILE
+        profile = {}
+        if os.path.exists(fname):
+            profile = yaml.safe_load(open(fname,"r")) or {}
+        profile.update(self.profile(best))
+
+        with open(fname+".tmp","w") as f:
+            f.write("# Written by tune.py --mode {} on {}\n".format(self.mode,time.strftime("%b_%d_%H%M%S")))
+            f.write("# {images_per_sec:.2f} images/sec, batch {batch_size}, p50 {p50_ms:.1f}ms, p99 {p99_ms:.1f}ms\n".format(**best))
+            yaml.safe_dump(profile,f,default_flow_style=False)
+        os.replace(fname+".tmp",fname)
+        return fname
+
+
+def int_list(s):
+    return [int(v) for v in s.split(",")]
+
+
+if __name__ == "__main__":
+    cores  = multiprocessing.cpu_count()
+    parser = argparse.ArgumentParser(description="Find the fastest session threads, batch size and prefetch depth "
+                                                 "for the net of a configuration, on synthetic input.",
+                                     epilog="Example: {} /Users/vivek/work/ssd-code/tiny_voc --intra 4,8,16 --inter 1,2".format(sys.argv[0]))
+    parser.add_argument("dirname",help="directory containing the configuration yaml file")
+    parser.add_argument("--mode",choices=["train","inference"],default="train")
+    parser.add_argument("--intra",type=int_list,default=sorted(set([1,max(cores//2,1),cores])),help="intra op threads to try")
+    parser.add_argument("--inter",type=int_list,default=[1,2],help="inter op threads to try")
+    parser.add_argument("--batch_sizes",type=int_list,help="(micro) batch sizes to try, by default the configured "
+                                                           "batch_size and its halves that divide it in train mode, 1, 4 and 16 in inference mode")
+    parser.add_argument("--prefetch",type=int_list,default=[1,2],help="prefetch depths to try")
+    parser.add_argument("--steps",type=int,default=20,help="timed steps per setting")
+    parser.add_argument("--warmup",type=int,default=3,help="untimed steps per setting")
+    parser.add_argument("--no_write",action="store_true",help="only print the results")
+    args = parser.parse_args()
+
+    tuner = Tuner(args.dirname,args.mode)
+    batch_sizes = args.batch_sizes
+    if batch_sizes == None:
+        batch_size  = tuner.cfg.g("batch_size")
+        batch_sizes = [b for b in [batch_size,batch_size//2,batch_size//4] if b > 0 and batch_size % b == 0] \
+                      if args.mode == "train" else [1,4,16]
+
+    results = tuner.sweep(args.intra,args.inter,batch_sizes,args.prefetch,args.steps,args.warmup)
+    if not results:
+        print("No setting could be measured")
+        sys.exit(1)
+
+    print("Best:",results[0])
+    if args.mode == "train" and results[0]["batch_size"] != tuner.cfg.g("batch_size"):
+        print("The fastest micro batch size is {}, set micro_batch_size: {} in ssd_config.yaml to train with "
+              "gradient accumulation (batch norm then sees micro batches)".format(results[0]["batch_size"],results[0]["batch_size"]))
+    if not args.no_write:
+        print("Wrote",tuner.write_profile(results[0]))
@@ -29,61 +29,103 @@ def iou(lx1,ly1,rx1,ry1,lx2,ly2,rx2,ry2):
     return intersection*1.0/union
 
 
-# Malisiewicz et al.
-def non_max_suppression_fast(boxes, overlapThresh):
-    # if there are no boxes, return an empty list
-    if len(boxes) == 0:
-        return []
-    
-    boxes = np.array(boxes, dtype=np.float32)
-    
-    # if the bounding boxes integers, convert them to floats --
-    # this is important since we'll be doing a bunch of divisions
-    if boxes.dtype.kind == "i":
-        boxes = boxes.astype("float")
- 
-    # initialize the list of picked indexes 
-    pick = []
- 
-    # grab the coordinates of the bounding boxes
-    x1 = boxes[:,0]
-    y1 = boxes[:,1]
-    x2 = boxes[:,2]
-    y2 = boxes[:,3]
- 
-    # compute the area of the bounding boxes and sort the bounding
-    # boxes by the bottom-right y-coordinate of the bounding box
-    area = (x2 - x1 + 1) * (y2 - y1 + 1)
-    idxs = np.argsort(y2)
- 
-    # keep looping while some indexes still remain in the indexes
-    # list
-    while len(idxs) > 0:
-        # grab the last index in the indexes list and add the
-        # index value to the list of picked indexes
-        last = len(idxs) - 1
-        i = idxs[last]
-        pick.append(i)
- 
-        # find the largest (x, y) coordinates for the start of
-        # the bounding box and the smallest (x, y) coordinates
-        # for the end of the bounding box
-        xx1 = np.maximum(x1[i], x1[idxs[:last]])
-        yy1 = np.maximum(y1[i], y1[idxs[:last]])
-        xx2 = np.minimum(x2[i], x2[idxs[:last]])
-        yy2 = np.minimum(y2[i], y2[idxs[:last]])
- 
-        # compute the width and height of the bounding box
-        w = np.maximum(0, xx2 - xx1 + 1)
-        h = np.maximum(0, yy2 - yy1 + 1)
- 
-        # compute the ratio of overlap
-        overlap = (w * h) / area[idxs[:last]]
- 
-        # delete all indexes from the index list that have
-        idxs = np.delete(idxs, np.concatenate(([last],
-            np.where(overlap > overlapThresh)[0])))
- 
-    # return only the bounding boxes that were picked using the
-    # integer data type
-    return boxes[pick].astype("int")
+def iou_matrix(boxes1, boxes2):
+    """ Vectorized version of iou() for every pair of boxes.
+
+    Args:
+    boxes1 - (N,4) array of left,top,right,bottom coordinates
+    boxes2 - (M,4) array of left,top,right,bottom coordinates
+
+    Returns:
+    (N,M) array where [i,j] is the intersection over union of boxes1[i] and boxes2[j]
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1,4)
+    boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(-1,4)
+
+    xL = np.maximum(boxes1[:,None,0], boxes2[None,:,0])
+    yL = np.maximum(boxes1[:,None,1], boxes2[None,:,1])
+    xR = np.minimum(boxes1[:,None,2], boxes2[None,:,2])
+    yR = np.minimum(boxes1[:,None,3], boxes2[None,:,3])
+
+    intersection = np.maximum(xR - xL, 0) * np.maximum(yR - yL, 0)
+
+    area1 = (boxes1[:,2] - boxes1[:,0]) * (boxes1[:,3] - boxes1[:,1])
+    area2 = (boxes2[:,2] - boxes2[:,0]) * (boxes2[:,3] - boxes2[:,1])
+    union = area1[:,None] + area2[None,:] - intersection
+
+    return intersection / union
+
+
+def decode_boxes(loc, conf, probs, default_boxes, threshold):
+    """ Decode the predictions of a batch of images into boxes, for the default boxes whose predicted
+    class is not background and whose probability is above threshold.
+
+    Args:
+    loc - (batch_size,num_preds*4) predicted cx,cy,w,h offsets relative to the default boxes
+    conf - (batch_size,num_preds) predicted class of each default box
+    probs - (batch_size,num_preds) probability of the predicted class
+    default_boxes - (num_preds,4) array of default box cx,cy,w,h, see SSDConfig.default_boxes()
+    threshold - minimum probability
+
+    Returns:
+    list with (boxes, scores, classes) for every image: (n,4) float32 left,top,right,bottom boxes,
+    (n,) float32 probabilities and (n,) int32 classes, in default box order
+    """
+    probs      = np.asarray(probs).reshape(len(probs),-1)
+    conf       = np.asarray(conf).reshape(probs.shape)
+    batch_size = probs.shape[0]
+
+    img_idx, box_idx = np.nonzero((probs > threshold) & (conf > 0))
+
+    enc     = np.asarray(loc, dtype=np.float32).reshape(batch_size,-1,4)[img_idx,box_idx]
+    dboxes  = np.asarray(default_boxes, dtype=np.float32)[box_idx]
+
+    cx      = enc[:,0]*dboxes[:,2] + dboxes[:,0]
+    cy      = enc[:,1]*dboxes[:,3] + dboxes[:,1]
+    half_w  = np.exp(enc[:,2])*dboxes[:,2]/2
+    half_h  = np.exp(enc[:,3])*dboxes[:,3]/2
+    boxes   = np.stack([cx - half_w, cy - half_h, cx + half_w, cy + half_h], axis=1)
+    scores  = probs[img_idx,box_idx].astype(np.float32)
+    classes = conf[img_idx,box_idx].astype(np.int32)
+
+    # np.nonzero goes image by image, so each image is one slice
+    splits  = np.searchsorted(img_idx, np.arange(1,batch_size))
+    return list(zip(np.split(boxes,splits), np.split(scores,splits), np.split(classes,splits)))
+
+
+def fold_batch_norm(weight, bias, gamma, beta, moving_mean, moving_variance, epsilon=0.001):
+    """ Weights and bias of a conv layer that computes batch_norm(conv(x,weight)+bias) at inference.
+
+    Args:
+    weight - (height,width,in_channels,out_channels) filter
+    bias, gamma, beta, moving_mean, moving_variance - (out_channels,) arrays
+    epsilon - the epsilon of the batch normalization, 0.001 for tf.contrib.layers.batch_norm
+
+    Returns:
+    folded weight and bias, float32
+    """
+    scale = np.asarray(gamma, dtype=np.float64) / np.sqrt(np.asarray(moving_variance, dtype=np.float64) + epsilon)
+    return ((np.asarray(weight, dtype=np.float64) * scale).astype(np.float32),
+            ((np.asarray(bias, dtype=np.float64) - moving_mean) * scale + beta).astype(np.float32))
+
+
+def match_detections(boxes1, classes1, boxes2, classes2, iou_threshold=0.5):
+    """ Greedily match two sets of detections of one image, e.g. of two models, the way detections
+    are matched to ground truth: each box of boxes1 (highest score first) takes the unmatched box of
+    boxes2 of the same class that it overlaps most, if that overlap is at least iou_threshold.
+
+    Returns:
+    number of matched pairs
+    """
+    if len(boxes1) == 0 or len(boxes2) == 0:
+        return 0
+    overlap = iou_matrix(boxes1, boxes2)
+    overlap[np.asarray(classes1)[:,None] != np.asarray(classes2)[None,:]] = -1
+
+    matches = 0
+    for row in overlap:
+        j = np.argmax(row)
+        if row[j] >= iou_threshold:
+            matches += 1
+            overlap[:,j] = -1
+    return matches